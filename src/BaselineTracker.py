@@ -0,0 +1,83 @@
+"""Running estimate of the ADC baseline and its RMS from idle samples.
+
+Replaces the one-shot calibrate_average_rms() at startup. The DAQ loop feeds
+it samples it has already read while no pulse is present, so tracking costs no
+dead time. The first `window` samples are averaged exactly (Welford), after that
+the estimate is an exponentially weighted moving average over about `window`
+samples, so it follows slow drifts (e.g. with temperature).
+
+retune() moves threshold and reset threshold with the baseline, keeping their
+offsets from it, so manual threshold changes are preserved. Moves smaller than
+`min_step` are ignored and the total drift since the start of the run is
+limited to `max_drift` ADC counts.
+"""
+
+class BaselineTracker:
+    def __init__(self, window=4096, clip=6., min_clip=30., min_step=5, max_drift=500):
+        self.window = window
+        self.clip = clip                # reject samples more than clip * rms from the mean
+        self.min_clip = min_clip        # ... but never reject within min_clip counts
+        self.min_step = min_step
+        self.max_drift = max_drift
+        self.n = 0
+        self.mean = 0.
+        self.var = 0.
+        self.rejected = 0
+        self.tuned_baseline = 0.        # baseline the thresholds were last set for
+        self.start_baseline = 0.        # baseline at the start of the run
+        self.retunes = 0
+
+    def seed(self, read, n=256):
+        """Quick start-up estimate from n back-to-back reads of `read()`.
+
+        Pulses are rare compared to n samples, so they barely bias the seed;
+        the running estimate converges to the idle baseline afterwards.
+        """
+        self.n = 0
+        self.mean = 0.
+        self.var = 0.
+        for _ in range(n):
+            self._add(read())
+        self.tuned_baseline = self.mean
+        self.start_baseline = self.mean
+        return self.mean, self.rms()
+
+    def _add(self, value):
+        if self.n < self.window:
+            # Welford: exact mean and variance of the first `window` samples
+            self.n += 1
+            delta = value - self.mean
+            self.mean += delta / self.n
+            self.var += (delta * (value - self.mean) - self.var) / self.n
+        else:
+            # exponentially weighted moving average and variance
+            alpha = 1. / self.window
+            delta = value - self.mean
+            self.mean += alpha * delta
+            self.var = (1. - alpha) * (self.var + alpha * delta * delta)
+
+    def update(self, value):
+        """Add one idle ADC sample, rejecting outliers such as pulse tails."""
+        if self.n > 16:
+            cut = self.clip * self.var ** 0.5
+            if cut < self.min_clip:
+                cut = self.min_clip
+            if abs(value - self.mean) > cut:
+                self.rejected += 1
+                return
+        self._add(value)
+
+    def rms(self):
+        return self.var ** 0.5
+
+    def retune(self, threshold, reset_threshold):
+        """Return (threshold, reset_threshold) shifted by the baseline drift since the last retune."""
+        shift = round(self.mean - self.tuned_baseline)
+        if abs(shift) < self.min_step:
+            return threshold, reset_threshold
+        target = self.tuned_baseline + shift
+        if abs(target - self.start_baseline) > self.max_drift:
+            return threshold, reset_threshold
+        self.tuned_baseline = target
+        self.retunes += 1
+        return threshold + shift, reset_threshold + shift
@@ -0,0 +1,302 @@
+"""Background compaction of closed run files (COMPACT_RUNS).
+
+Finished segments used to stay on the SD card as CSV, several times the size
+they compress to, and every later download moved all of it over Wi-Fi. The
+Compactor task looks for closed run files (muon_data_*.csv that RunFile no
+longer writes or renames, see RunFile.open_names()) every `scan_s` seconds and
+compresses them one at a time into <name>.csv.gz, a gzip file: deflate with a
+CRC-32 of the data. It works CHUNK bytes at a time and sleeps `pace_ms`
+between chunks, so the trigger loop and the web server keep most of the CPU,
+and it waits as long as busy() is true (the main program decides: trigger
+rate or web requests).
+
+The archive is written to <name>.csv.gz.tmp, then read back and inflated; only
+if the length and CRC-32 of the inflated data equal those of the CSV is it
+renamed to .csv.gz and the CSV removed. A file that changes or fails, or whose
+.csv.gz exists already, is left as it is and not tried again until the next
+boot.
+
+A file that a web response is sending is not touched: the routes wrap their
+bodies in Reading, and a compaction that finds its CSV being read when it is
+done drops the archive and tries again later.
+
+Compression needs a firmware built with deflate compression (MICROPY_PY_DEFLATE_COMPRESS);
+many builds can only decompress. can_compress() finds out once, and the main
+program leaves compaction and compressed archives off without it.
+
+open_gz() reads such an archive: /export filters it, while /download_file and
+/archive send the compressed bytes as they are.
+"""
+import asyncio
+import binascii
+import io
+import time
+
+try:
+    import uos as os
+    from micropython import const
+except ImportError:  # host
+    import os
+
+    def const(x):
+        return x
+
+try:
+    import deflate
+    gzip = None
+except ImportError:  # host
+    import gzip
+    deflate = None
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:  # host
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+CHUNK = const(1024)
+WBITS = const(10)         # 1 kB window; inflating needs no more than that either
+PREFIX = "muon_data_"
+SUFFIX = ".gz"
+SIDECARS = (".sd.json", ".slow.csv")    # as in RunFile.SIDECARS
+
+_compress = None        # can_compress(), once known
+reading = {}            # path -> number of responses sending it, see Reading
+last_read_ms = 0        # ticks_ms of the last chunk a Reading returned
+
+
+def open_gz(path):
+    """A binary stream of the inflated content of a .gz file (readinto, read, close)"""
+    if deflate is not None:
+        return deflate.DeflateIO(open(path, "rb"), deflate.GZIP, WBITS, True)
+    return gzip.open(path, "rb")
+
+
+def _gzip_writer(f):
+    if deflate is not None:
+        return deflate.DeflateIO(f, deflate.GZIP, WBITS)
+    return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6)
+
+
+def can_compress():
+    """True if this firmware can write deflate streams (checked once)"""
+    global _compress
+    if _compress is None:
+        try:
+            sink = io.BytesIO()
+            z = _gzip_writer(sink)
+            z.write(b"cuwatch")
+            z.close()
+            _compress = len(sink.getvalue()) > 0
+        except Exception as e:
+            print("deflate compression not available:", e)
+            _compress = False
+    return _compress
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class Reading:
+    """Response body that marks `paths` as being read until it ends or is closed.
+
+    The paths are marked when the body is created, as the route returns before
+    the first chunk is read, and unmarked when the body ends, raises or is closed
+    (Microdot closes it when the client goes away).
+    """
+    def __init__(self, paths, body):
+        self.paths = paths
+        self.body = body
+        for path in paths:
+            reading[path] = reading.get(path, 0) + 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        global last_read_ms
+        try:
+            chunk = next(self.body)
+        except BaseException:
+            self.close()
+            raise
+        last_read_ms = ticks_ms()
+        return chunk
+
+    def close(self):
+        if self.paths is None:
+            return
+        for path in self.paths:
+            n = reading.get(path, 0) - 1
+            if n > 0:
+                reading[path] = n
+            else:
+                reading.pop(path, None)
+        self.paths = None
+        close = getattr(self.body, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compactor:
+    def __init__(self, directory, open_names, busy=None, scan_s=60, pace_ms=20, backoff_s=5):
+        self.directory = directory
+        self.open_names = open_names      # returns the paths of run files still in use
+        self.busy = busy                  # returns True while compaction should wait
+        self.scan_s = scan_s
+        self.pace_ms = pace_ms
+        self.backoff_s = backoff_s
+        self.buf = bytearray(CHUNK)
+        self.current = None               # file being compacted
+        self.paused = False
+        self.compacted = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.skipped = []                 # names that failed or changed
+
+    def _names(self):
+        if hasattr(os, 'ilistdir'):
+            for entry in os.ilistdir(self.directory):
+                yield entry[0]
+        else:
+            for name in os.listdir(self.directory):
+                yield name
+
+    def cleanup(self):
+        """Remove the temporary files of a compaction cut short by a reset"""
+        for name in [name for name in self._names() if name.endswith(SUFFIX + ".tmp")]:
+            _remove(self.directory + "/" + name)
+
+    def next_name(self):
+        """The next closed run file to compact, or None"""
+        in_use = self.open_names()
+        for name in self._names():
+            if not name.startswith(PREFIX) or not name.endswith(".csv"):
+                continue
+            path = self.directory + "/" + name
+            if name in self.skipped or path in in_use or path in reading:
+                continue
+            sidecar = False
+            for suffix in SIDECARS:
+                if name.endswith(suffix):
+                    sidecar = True
+            if not sidecar:
+                return name
+        return None
+
+    async def _wait(self):
+        while self.busy is not None and self.busy():
+            self.paused = True
+            await asyncio.sleep(self.backoff_s)
+        self.paused = False
+
+    async def _crc(self, f):
+        """CRC-32 and length of what is left in the stream f, read in chunks"""
+        buf = self.buf
+        view = memoryview(buf)
+        crc = 0
+        size = 0
+        while True:
+            await self._wait()
+            n = f.readinto(buf)
+            if not n:
+                break
+            crc = binascii.crc32(view[:n], crc)
+            size += n
+            await sleep_ms(self.pace_ms)
+        return crc & 0xffffffff, size
+
+    async def compact(self, name):
+        """Compress one run file; True if it was replaced by its verified .gz, None if it
+        is being sent by a response and should be tried again later"""
+        path = self.directory + "/" + name
+        tmp = path + SUFFIX + ".tmp"
+        buf = self.buf
+        view = memoryview(buf)
+        t0 = ticks_ms()
+        try:
+            os.stat(path + SUFFIX)
+            print(f"compaction: {name + SUFFIX} exists, skipped")
+            return False
+        except OSError:
+            pass
+        crc = 0
+        size = 0
+        with open(path, "rb") as src, open(tmp, "wb") as raw:
+            z = _gzip_writer(raw)
+            while True:
+                await self._wait()
+                n = src.readinto(buf)
+                if not n:
+                    break
+                crc = binascii.crc32(view[:n], crc)
+                size += n
+                z.write(view[:n])
+                await sleep_ms(self.pace_ms)
+            z.close()
+        crc &= 0xffffffff
+        if os.stat(path)[6] != size:
+            print(f"compaction: {name} changed while compressing, skipped")
+            return False
+        with open_gz(tmp) as f:
+            check = await self._crc(f)
+        if check != (crc, size):
+            print(f"compaction: {name}: CRC or length of the archive do not match, skipped")
+            return False
+        if path in reading:
+            print(f"compaction: {name} is being sent, deferred")
+            return None
+        packed = os.stat(tmp)[6]
+        os.rename(tmp, path + SUFFIX)
+        os.remove(path)
+        self.compacted += 1
+        self.bytes_in += size
+        self.bytes_out += packed
+        print(f"compacted {name}: {size} -> {packed} bytes in {ticks_diff(ticks_ms(), t0) / 1000:.0f} s")
+        return True
+
+    async def run(self):
+        try:
+            self.cleanup()
+        except OSError:
+            pass
+        while True:
+            await self._wait()
+            try:
+                name = self.next_name()
+            except OSError as e:
+                print("compaction: cannot list", self.directory, e)
+                name = None
+            if name is None:
+                await asyncio.sleep(self.scan_s)
+                continue
+            self.current = name
+            try:
+                ok = await self.compact(name)
+            except Exception as e:
+                print(f"compaction of {name} failed:", e)
+                ok = False
+            self.current = None
+            if not ok:
+                if ok is not None:
+                    self.skipped.append(name)
+                _remove(self.directory + "/" + name + SUFFIX + ".tmp")
+            await asyncio.sleep(1)
+
+    def as_dict(self):
+        return {'current': self.current, 'paused': self.paused, 'compacted': self.compacted,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'skipped': len(self.skipped)}
@@ -0,0 +1,243 @@
+"""Trigger loop on the second core of the RP2040 (DUAL_CORE mode).
+
+In the normal mode the ADC polling loop shares one asyncio loop with the web
+server (or the MQTT client) on core 0, so every request is trigger dead time.
+With DUAL_CORE, start() runs trigger_loop() on core 1 with _thread. It does
+nothing but poll the ADC, wait out pulses and latch the coincidence, and hands
+each event to core 0 through an EventRing. Core 0 drains the ring and does
+everything that can block: SD writes, MQTT, the web pages, baseline tracking.
+
+EventRing is a single-producer/single-consumer ring of fixed-size records in
+one preallocated array. Only core 1 writes the head index and only core 0
+writes the tail index, each after the record it guards, so no lock is needed
+(the Cortex-M0+ has no cache and does not reorder stores). Numbers shared the
+other way (thresholds, counters, the run flag) live in a small array of
+control words, see control(). The ADC is polled in batches by
+TriggerKernel.scan, and nothing in trigger_loop allocates heap memory per
+sample, so core 0's garbage collection does not stall it.
+
+The module also runs under CPython, where _thread gives an ordinary thread;
+sim_daq.py uses that to exercise the handoff with a simulated ADC.
+"""
+import array
+import time
+import _thread
+
+import TriggerKernel
+
+try:
+    from micropython import const
+except ImportError:  # host
+    def const(x):
+        return x
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+    sleep_us = time.sleep_us
+except AttributeError:  # host
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def sleep_us(us):
+        time.sleep(us / 1000000)
+
+# event record fields
+MUON_COUNT = const(0)
+ADC = const(1)
+TEMPERATURE_ADC = const(2)
+DT = const(3)
+T = const(4)
+T_WAIT = const(5)
+COINC = const(6)
+FIELDS = const(7)
+
+# control words
+THRESHOLD = const(0)        # core 0 -> core 1
+RESET_THRESHOLD = const(1)  # core 0 -> core 1
+RUN = const(2)              # core 0 -> core 1: 0 stops the loop
+RUNNING = const(3)          # core 1 -> core 0: 1 while the loop runs
+BLOCKS = const(4)           # core 1 -> core 0: iterations / BLOCK (mod 2**30)
+WAITED = const(5)           # core 1 -> core 0: pulses that did not drop below reset_threshold
+OVERFLOWS = const(6)        # core 1 -> core 0: events dropped because the ring was full
+IDLE = const(7)             # core 1 -> core 0: latest idle sample for the baseline tracker
+IDLE_SEQ = const(8)         # core 1 -> core 0: incremented with each new idle sample
+LIVE_MS = const(9)          # core 1 -> core 0: ms spent polling the ADC (mod 2**30), the livetime
+N_CONTROL = const(10)
+
+BLOCK = const(1024)         # iterations between control word reads
+BATCH = const(64)           # ADC samples per TriggerKernel.scan() call
+
+
+def control(threshold, reset_threshold):
+    """Control words for trigger_loop, see the constants above"""
+    ctrl = array.array('i', [0] * N_CONTROL)
+    ctrl[THRESHOLD] = threshold
+    ctrl[RESET_THRESHOLD] = reset_threshold
+    ctrl[RUN] = 1
+    return ctrl
+
+
+class EventRing:
+    def __init__(self, size=256, extra=0):
+        self.size = size
+        self.width = FIELDS + extra   # extra: PulseCapture values after the FIELDS
+        self.buf = array.array('i', [0] * (size * self.width))
+        self.idx = array.array('i', [0, 0])   # head (producer), tail (consumer)
+
+    def push(self, muon_count, adc, temperature_adc, dt, t, t_wait, coinc, capture=None):
+        """Producer side. Returns False (and drops the event) if the ring is full."""
+        head = self.idx[0]
+        nxt = head + 1
+        if nxt == self.size:
+            nxt = 0
+        if nxt == self.idx[1]:
+            return False
+        buf = self.buf
+        b = head * self.width
+        buf[b] = muon_count
+        buf[b + 1] = adc
+        buf[b + 2] = temperature_adc
+        buf[b + 3] = dt
+        buf[b + 4] = t
+        buf[b + 5] = t_wait
+        buf[b + 6] = coinc
+        if capture is not None:
+            buf[b + 7] = capture.peak
+            buf[b + 8] = capture.tot_us
+            wave = capture.wave
+            for i in range(len(wave)):
+                buf[b + 9 + i] = wave[i]
+        self.idx[0] = nxt   # publish after the record is complete
+        return True
+
+    def pop_into(self, rec):
+        """Consumer side. Copy the oldest event into rec (width long); False if empty."""
+        tail = self.idx[1]
+        if tail == self.idx[0]:
+            return False
+        width = self.width
+        b = tail * width
+        buf = self.buf
+        for i in range(width):
+            rec[i] = buf[b + i]
+        tail += 1
+        if tail == self.size:
+            tail = 0
+        self.idx[1] = tail  # release the slot after it was read
+        return True
+
+    def __len__(self):
+        n = self.idx[0] - self.idx[1]
+        return n + self.size if n < 0 else n
+
+
+def trigger_loop(ring, ctrl, readout, read_temperature, coincidence_pin, is_leader, led=None, capture=None,
+                 housekeeping=None):
+    """ADC polling and trigger loop; runs until ctrl[RUN] is cleared.
+
+    housekeeping (e.g. SlowControl.sample) is called every BLOCK iterations, so
+    that all ADC reads happen on this core.
+    """
+    ctrl[RUNNING] = 1
+    try:
+        tmeas = ticks_ms
+        tus = ticks_us
+        tusleep = sleep_us
+        push = ring.push
+        scan = TriggerKernel.scan
+        out = array.array('i', [0, 0])
+        threshold = ctrl[THRESHOLD]
+        reset_threshold = ctrl[RESET_THRESHOLD]
+        muon_count = 0
+        coincidence = 0
+        start_time = tmeas()
+        count = 0
+        live_us = 0
+        while True:
+            t = tus()
+            count += scan(readout, threshold, BATCH, out)
+            live_us += ticks_diff(tus(), t)
+            if count >= BLOCK:
+                count -= BLOCK
+                ctrl[BLOCKS] = (ctrl[BLOCKS] + 1) & 0x3FFFFFFF
+                ctrl[LIVE_MS] = (ctrl[LIVE_MS] + live_us // 1000) & 0x3FFFFFFF
+                live_us %= 1000
+                threshold = ctrl[THRESHOLD]
+                reset_threshold = ctrl[RESET_THRESHOLD]
+                if not ctrl[RUN]:
+                    break
+                if housekeeping is not None:
+                    housekeeping()
+            adc_value = out[TriggerKernel.LAST]
+            if out[TriggerKernel.HIT]:
+                if led is not None:
+                    led.on()
+                end_time = tmeas()
+                muon_count += 1
+                wait_counts = 150
+                if not is_leader:
+                    coincidence_pin.value(1)
+                else:
+                    if coincidence_pin.value() == 1:
+                        coincidence = 1
+                    else:
+                        coincidence = 0
+                if capture is not None:
+                    capture.start(adc_value)
+                # wait to drop beneath reset threshold
+                while True:
+                    v = readout()
+                    if v <= reset_threshold:
+                        break
+                    if capture is not None:
+                        capture.add(v)
+                    wait_counts = wait_counts - 1
+                    tusleep(1)
+                    if is_leader and coincidence == 0:  # latch value of coincidence
+                        if coincidence_pin.value() == 1:
+                            coincidence = 1
+                    if wait_counts == 0:
+                        ctrl[WAITED] += 1
+                        break
+                if capture is not None:
+                    capture.finish(wait_counts == 0)
+                dt = ticks_diff(end_time, start_time)
+                start_time = end_time
+                if not push(muon_count, adc_value, read_temperature(), dt, end_time, wait_counts, coincidence,
+                            capture):
+                    ctrl[OVERFLOWS] += 1
+                if led is not None:
+                    led.off()
+                if not is_leader:
+                    coincidence_pin.value(0)
+            elif adc_value < reset_threshold:
+                # one idle sample per batch goes to the baseline tracker on core 0
+                ctrl[IDLE] = adc_value
+                ctrl[IDLE_SEQ] = (ctrl[IDLE_SEQ] + 1) & 0x3FFFFFFF
+    finally:
+        ctrl[RUNNING] = 0
+
+
+def start(ring, ctrl, readout, read_temperature, coincidence_pin, is_leader, led=None, capture=None,
+          housekeeping=None):
+    """Start trigger_loop on the second core (a thread under CPython)"""
+    ctrl[RUNNING] = 1
+    _thread.start_new_thread(trigger_loop, (ring, ctrl, readout, read_temperature, coincidence_pin,
+                                            is_leader, led, capture, housekeeping))
+
+
+def stop(ctrl, timeout_ms=2000):
+    """Ask trigger_loop to stop and wait for it; True if it stopped"""
+    ctrl[RUN] = 0
+    t0 = ticks_ms()
+    while ctrl[RUNNING] and ticks_diff(ticks_ms(), t0) < timeout_ms:
+        time.sleep(0.001)
+    return not ctrl[RUNNING]
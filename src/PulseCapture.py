@@ -0,0 +1,72 @@
+"""Pulse shape from the samples of the reset wait (PULSE_CAPTURE mode).
+
+After a trigger the loop keeps reading the ADC until the pulse drops below
+reset_threshold; those samples used to be thrown away. With a PulseCapture the
+loop hands each of them to add(), which keeps the peak amplitude and every
+`decimate`-th sample (starting with the trigger sample) in a preallocated
+waveform of `samples` values. finish() records the time over threshold: the
+microseconds from the trigger sample to the first sample below
+reset_threshold. If the pulse never dropped within the wait, tot_us is
+saturated and written negative: -tot_us, the time to the end of the wait, is
+only a lower bound. No ADC reads are added and nothing is allocated per sample.
+
+The capture is written as extra columns of the event line, see COLUMNS and
+csv(): peak, tot_us and w0, w1, ... (unused waveform slots are 0).
+"""
+import array
+import time
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+class PulseCapture:
+    def __init__(self, samples=8, decimate=4):
+        self.samples = samples
+        self.decimate = decimate
+        self.wave = array.array('H', [0] * samples)
+        self.fields = samples + 2   # values per event: peak, tot_us and the waveform
+        self.columns = ",peak,tot_us," + ",".join("w%d" % i for i in range(samples))
+        self.peak = 0
+        self.tot_us = 0
+        self.n = 0        # waveform samples stored
+        self.seen = 0     # samples since the trigger
+        self.t0 = 0
+
+    def start(self, first):
+        """Begin a capture with the sample that crossed the threshold"""
+        self.t0 = ticks_us()
+        self.peak = first
+        self.wave[0] = first
+        self.n = 1
+        self.seen = 1
+
+    def add(self, v):
+        if v > self.peak:
+            self.peak = v
+        k = self.seen
+        self.seen = k + 1
+        if k % self.decimate == 0 and self.n < self.samples:
+            self.wave[self.n] = v
+            self.n += 1
+
+    def finish(self, saturated=False):
+        """End the capture; saturated: the pulse was still above reset_threshold"""
+        tot = ticks_diff(ticks_us(), self.t0)
+        self.tot_us = -tot if saturated else tot
+        for i in range(self.n, self.samples):
+            self.wave[i] = 0
+
+    def csv(self):
+        """The capture as the end of an event line: ', peak, tot_us, w0, ...'"""
+        return ", %d, %d, " % (self.peak, self.tot_us) + ", ".join(str(v) for v in self.wave)
+
+    def as_dict(self):
+        return {'peak': self.peak, 'tot_us': self.tot_us, 'wave': list(self.wave)}
@@ -0,0 +1,274 @@
+"""Run files of the SD card as one streamed tar or zip archive.
+
+    body = RunArchive.stream(directory, select(directory, first=..., last=...), fmt="tar", compress=True)
+
+select() picks run files by name: an explicit list, and/or an inclusive range
+of names compared by prefix, so first="muon_data_20241101" and
+last="muon_data_20241107" are the runs of that week. Sidecars
+(<segment>.sd.json, <segment>.slow.csv) come along with their segment unless
+sidecars=False. Runs compacted by Compactor.py go in as their .csv.gz files,
+as they are on the card.
+
+stream() is a generator of the archive bytes, for a Microdot Response body. It
+never builds the archive or a file in memory: each file is read through one
+reused buffer of CHUNK bytes, so the memory used does not depend on the file
+sizes. A file that is still being written (the current segment) goes in as it
+was when its header was written; the tar header needs the size up front.
+
+  fmt="tar"                 ustar archive
+  fmt="tar", compress=True  the tar gzipped as a whole (.tar.gz)
+  fmt="zip"                 zip with stored entries; compress=True deflates each entry
+
+Zip entries use data descriptors (the CRC and sizes follow the data), so a
+file is read only once; only the name, CRC, sizes and offset of each entry are
+kept for the central directory at the end. The deflate window is 2**WBITS
+bytes, which any inflater reads. Compression uses the `deflate` module of
+MicroPython 1.21+ on the board and zlib on a laptop.
+"""
+import binascii
+import io
+import struct
+import time
+
+try:
+    import uos as os
+    from micropython import const
+except ImportError:  # host
+    import os
+
+    def const(x):
+        return x
+
+try:
+    import deflate
+    zlib = None
+except ImportError:  # host
+    import zlib
+    deflate = None
+
+CHUNK = const(1024)
+WBITS = const(10)
+PREFIX = "muon_data_"
+SIDECARS = (".sd.json", ".slow.csv")    # as in RunFile.SIDECARS
+
+
+def _names(directory):
+    if hasattr(os, 'ilistdir'):
+        for entry in os.ilistdir(directory):
+            yield entry[0]
+    else:
+        for name in os.listdir(directory):
+            yield name
+
+
+def is_sidecar(name):
+    for suffix in SIDECARS:
+        if name.endswith(suffix):
+            return True
+    return False
+
+
+def select(directory, names=None, first=None, last=None, sidecars=True):
+    """Sorted names of the run files in directory matching names and the range [first, last]"""
+    if names is not None:
+        bases = [n[:-4] if n.endswith(".csv") else n for n in names]
+    selected = []
+    for name in _names(directory):
+        if not name.startswith(PREFIX):
+            continue
+        sidecar = is_sidecar(name)
+        if sidecar and not sidecars:
+            continue
+        compacted = name.endswith(".csv.gz")
+        if not sidecar and not compacted and not name.endswith(".csv"):
+            continue
+        if names is not None and name not in names and not (compacted and name[:-3] in names):
+            if not sidecar or name[:name.index(".")] not in bases:
+                continue
+        if first is not None and name < first:
+            continue
+        if last is not None and name[:len(last)] > last:
+            continue
+        selected.append(name)
+    selected.sort()
+    return selected
+
+
+class _Sink(io.IOBase):
+    """Collects what DeflateIO writes until take()"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class Deflater:
+    """Streaming deflate: compress() and finish() return the compressed bytes produced so far.
+
+    gzip=True writes a gzip stream (header and CRC trailer), otherwise raw deflate.
+    """
+    def __init__(self, gzip=False):
+        if deflate is not None:
+            self.sink = _Sink()
+            self.d = deflate.DeflateIO(self.sink, deflate.GZIP if gzip else deflate.RAW, WBITS)
+        else:
+            self.d = zlib.compressobj(6, zlib.DEFLATED, 16 + WBITS if gzip else -WBITS)
+
+    def compress(self, data):
+        if deflate is None:
+            return self.d.compress(data)
+        self.d.write(data)
+        return self.sink.take()
+
+    def finish(self):
+        if deflate is None:
+            return self.d.flush()
+        self.d.close()
+        return self.sink.take()
+
+
+def _octal(value, width):
+    """Tar number field: zero-padded octal and a NUL"""
+    return ("%0*o" % (width - 1, value)).encode() + b"\0"
+
+
+def tar_header(name, size, mtime):
+    h = bytearray(512)
+    h[0:len(name)] = name.encode()[:100]
+    h[100:108] = _octal(0o644, 8)
+    h[108:116] = _octal(0, 8)
+    h[116:124] = _octal(0, 8)
+    h[124:136] = _octal(size, 12)
+    h[136:148] = _octal(max(mtime, 0), 12)
+    h[148:156] = b" " * 8
+    h[156] = 0x30                       # regular file
+    h[257:265] = b"ustar\x0000"
+    h[148:156] = _octal(sum(h), 7) + b" "
+    return h
+
+
+def _dos_time(mtime):
+    tm = time.gmtime(mtime)
+    if tm[0] < 1980:
+        return 0, (1 << 5) | 1
+    return (tm[3] << 11) | (tm[4] << 5) | (tm[5] // 2), ((tm[0] - 1980) << 9) | (tm[1] << 5) | tm[2]
+
+
+def _read(path, size, buf):
+    """Chunks of the first `size` bytes of path, zero-filled if the file is shorter"""
+    view = memoryview(buf)
+    left = size
+    try:
+        with open(path, "rb") as f:
+            while left > 0:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                n = min(n, left)
+                left -= n
+                yield view[:n]
+    except OSError as e:
+        print("archive: could not read", path, e)
+    while left > 0:
+        n = min(left, len(buf))
+        for i in range(n):
+            buf[i] = 0
+        left -= n
+        yield view[:n]
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st[6], st[8]
+    except OSError:
+        return None
+
+
+def _tar(directory, names, buf):
+    for name in names:
+        st = _stat(directory + "/" + name)
+        if st is None:
+            continue
+        size, mtime = st
+        yield tar_header(name, size, mtime)
+        yield from _read(directory + "/" + name, size, buf)
+        if size % 512:
+            yield bytes(512 - size % 512)
+    yield bytes(1024)                   # end of archive
+
+
+def _zip(directory, names, buf, compress):
+    entries = []
+    offset = 0
+    for name in names:
+        st = _stat(directory + "/" + name)
+        if st is None:
+            continue
+        method = 8 if compress and not name.endswith(".gz") else 0     # compacted runs are stored
+        size, mtime = st
+        dos_time, dos_date = _dos_time(mtime)
+        encoded = name.encode()
+        local = struct.pack("<IHHHHHIIIHH", 0x04034b50, 20, 0x0008, method, dos_time, dos_date,
+                            0, 0, 0, len(encoded), 0) + encoded
+        yield local
+        crc = 0
+        written = 0
+        deflater = Deflater() if method else None
+        for chunk in _read(directory + "/" + name, size, buf):
+            crc = binascii.crc32(chunk, crc)
+            if deflater is None:
+                written += len(chunk)
+                yield chunk
+            else:
+                out = deflater.compress(chunk)
+                if out:
+                    written += len(out)
+                    yield out
+        if deflater is not None:
+            out = deflater.finish()
+            written += len(out)
+            yield out
+        crc &= 0xffffffff
+        yield struct.pack("<IIII", 0x08074b50, crc, written, size)
+        entries.append((encoded, method, dos_time, dos_date, crc, written, size, offset))
+        offset += len(local) + written + 16
+    start = offset
+    for encoded, method, dos_time, dos_date, crc, written, size, at in entries:
+        entry = struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 20, 20, 0x0008, method, dos_time, dos_date,
+                            crc, written, size, len(encoded), 0, 0, 0, 0, 0, at) + encoded
+        offset += len(entry)
+        yield entry
+    yield struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, len(entries), len(entries), offset - start, start, 0)
+
+
+def stream(directory, names, fmt="tar", compress=False):
+    """Generator of the archive of the files `names` in directory"""
+    buf = bytearray(CHUNK)
+    if fmt == "zip":
+        yield from _zip(directory, names, buf, compress)
+        return
+    if fmt != "tar":
+        raise ValueError("format must be tar or zip")
+    if not compress:
+        yield from _tar(directory, names, buf)
+        return
+    deflater = Deflater(gzip=True)
+    for chunk in _tar(directory, names, buf):
+        out = deflater.compress(chunk)
+        if out:
+            yield out
+    yield deflater.finish()
+
+
+def filename(fmt="tar", compress=False):
+    if fmt == "zip":
+        return "cuwatch_runs.zip"
+    return "cuwatch_runs.tar.gz" if compress else "cuwatch_runs.tar"
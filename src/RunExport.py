@@ -0,0 +1,287 @@
+"""Filtered export of a run file: only the matching events cross the network.
+
+    cuts = RunExport.Cuts(coinc=1, wait_min=20)
+    body = RunExport.stream("/sd/muon_data_20241101_1806.csv", cuts)
+
+stream() yields the header lines of the file (metadata and column names) and
+then the event lines that pass every cut, unchanged, so the result loads with
+muon_data.py like the full file. The cuts are inclusive ranges on the columns
+of the SD card layout:
+
+    event_min, event_max   Muon Count
+    t_min, t_max           t (ms)
+    coinc                  coinc == value
+    wait_min, wait_max     t_wait
+    adc_min, adc_max       ADC
+
+The file is read through one buffer of BUF bytes and matching lines are copied
+into a second one, which is yielded when full; no line becomes a str. parse()
+(viper, like TriggerKernel) reads the first FIELDS integers of a line into an
+array and returns where the line ends.
+Muon Count and t increase through a segment, so an event or time range is
+found by bisecting the file on those columns, and reading stops after its
+end: the cost of such an export grows with the events returned, not with the
+file. Lines that do not parse (the NUL fill of a preallocated segment, a line
+cut by a reset) are skipped.
+"""
+import array
+
+try:
+    import micropython
+    from micropython import const
+except ImportError:  # host: the viper decorator and pointers are stand-ins, as in TriggerKernel
+    class micropython:
+        @staticmethod
+        def viper(f):
+            return f
+
+    def const(x):
+        return x
+
+    def ptr8(a):  # host: index the buffers directly
+        return a
+
+    def ptr32(a):
+        return a
+
+BUF = const(1024)
+OUT = const(1024)
+FIELDS = const(7)       # Muon Count, ADC, temperature_ADC, dt, t, t_wait, coinc
+COUNT = const(0)
+ADC = const(1)
+T = const(4)
+WAIT = const(5)
+COINC = const(6)
+HEADER_LINES = const(8)  # the column names come within this many lines
+
+
+@micropython.viper
+def parse_viper(buf, start: int, end: int, fields) -> int:
+    b = ptr8(buf)
+    o = ptr32(fields)
+    n = 0
+    v = 0
+    digits = 0
+    neg = 0
+    bad = 0
+    i = start
+    while i < end:
+        c = int(b[i])
+        if c == 10:
+            break
+        if bad == 0 and n < 7:
+            if c >= 48 and c <= 57:
+                v = v * 10 + c - 48
+                digits += 1
+            elif c == 44:
+                if digits == 0:
+                    bad = 1
+                else:
+                    if neg:
+                        v = 0 - v
+                    o[n] = v
+                    n += 1
+                    v = 0
+                    digits = 0
+                    neg = 0
+            elif c == 45 and digits == 0:
+                neg = 1
+            elif c != 32 and c != 13:
+                bad = 1
+        i += 1
+    if bad == 0 and n < 7 and digits:
+        if neg:
+            v = 0 - v
+        o[n] = v
+        n += 1
+    if bad:
+        n = -1
+    o[7] = n
+    if i < end:
+        return i
+    return -1
+
+
+def parse_py(buf, start, end, fields):
+    n = 0
+    v = 0
+    digits = 0
+    neg = 0
+    bad = 0
+    i = start
+    while i < end:
+        c = buf[i]
+        if c == 10:
+            break
+        if bad == 0 and n < 7:
+            if 48 <= c <= 57:
+                v = v * 10 + c - 48
+                digits += 1
+            elif c == 44:
+                if digits == 0:
+                    bad = 1
+                else:
+                    fields[n] = -v if neg else v
+                    n += 1
+                    v = 0
+                    digits = 0
+                    neg = 0
+            elif c == 45 and digits == 0:
+                neg = 1
+            elif c != 32 and c != 13:
+                bad = 1
+        i += 1
+    if bad == 0 and n < 7 and digits:
+        fields[n] = -v if neg else v
+        n += 1
+    fields[7] = n if bad == 0 else -1
+    return i if i < end else -1
+
+
+def _pick():
+    fields = array.array('i', [0] * (FIELDS + 1))
+    line = b"12, -3\n"
+    try:
+        if parse_viper(line, 0, len(line), fields) == 6 and fields[7] == 2 and fields[1] == -3:
+            return parse_viper
+    except Exception:
+        pass
+    return parse_py
+
+
+# parse(buf, start, end, fields) reads the line at buf[start:] into fields[0:FIELDS] and the number
+# of fields read into fields[FIELDS] (-1 if it is not integers); it returns the index of the newline
+# that ends the line, or -1 if there is none before end
+parse = _pick()
+
+
+class Cuts:
+    def __init__(self, event_min=None, event_max=None, t_min=None, t_max=None, coinc=None,
+                 wait_min=None, wait_max=None, adc_min=None, adc_max=None):
+        self.ranges = []        # (field, lo, hi) of every cut that is set
+        for field, lo, hi in ((COUNT, event_min, event_max), (T, t_min, t_max), (COINC, coinc, coinc),
+                              (WAIT, wait_min, wait_max), (ADC, adc_min, adc_max)):
+            if lo is not None or hi is not None:
+                self.ranges.append((field, -2 ** 31 if lo is None else int(lo), 2 ** 31 - 1 if hi is None else int(hi)))
+        # the increasing column to bisect on, and the value to stop after
+        self.key = None
+        for field, lo, hi in self.ranges:
+            if field in (COUNT, T):
+                self.key = (field, lo, hi)
+                break
+
+    def match(self, fields):
+        for field, lo, hi in self.ranges:
+            v = fields[field]
+            if v < lo or v > hi:
+                return False
+        return True
+
+
+def _header(f, buf):
+    """The header lines of the file as bytes, up to and with the column names, and the bytes read"""
+    n = f.readinto(buf) or 0
+    fields = array.array('i', [0] * (FIELDS + 1))
+    pos = 0
+    for _ in range(HEADER_LINES):
+        nl = parse(buf, pos, n, fields)
+        if nl < 0:
+            break
+        line = bytes(buf[pos:nl])
+        pos = nl + 1
+        if line.startswith(b"Muon Count") or line.startswith(b"adc_v"):
+            return bytes(buf[:pos]), n
+    return b"", n
+
+
+def _bisect(f, lo, hi, field, value, buf, fields):
+    """An offset at or before the first line whose `field` is >= value (the column increases)"""
+    while hi - lo > len(buf):
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        n = f.readinto(buf)
+        nl = parse(buf, 0, n, fields)       # skip the partial line
+        if nl < 0 or parse(buf, nl + 1, n, fields) < 0 or fields[FIELDS] <= field:
+            hi = mid                        # past the last event (NUL fill) or no full line here
+        elif fields[field] < value:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def stream(path, cuts, stats=None):
+    """Generator of the header and the matching event lines of the file at path.
+
+    A compacted run (.csv.gz) is inflated on the fly; it cannot be bisected, so a
+    range is found by reading from the start.
+
+    stats, a dict, gets the number of 'lines' read and 'matched'."""
+    buf = bytearray(BUF)
+    view = memoryview(buf)
+    out = bytearray(OUT)
+    fields = array.array('i', [0] * (FIELDS + 1))
+    lines = matched = 0
+    gz = path.endswith(".gz")
+    if gz:
+        import Compactor
+        f = Compactor.open_gz(path)
+    else:
+        f = open(path, "rb")
+    with f:
+        header, n = _header(f, buf)
+        if header:
+            yield header
+        start = len(header)
+        stop_field = -1
+        if cuts.key is not None:
+            stop_field, lo, stop = cuts.key
+        partial = False
+        if stop_field >= 0 and not gz:
+            f.seek(0, 2)
+            start = max(start, _bisect(f, start, f.tell(), stop_field, lo, buf, fields))
+            f.seek(start)
+            n = 0
+            partial = start > len(header)   # started inside a line: skip to its end
+        else:
+            buf[:n - start] = buf[start:n]  # the events _header() read already
+            n -= start
+        o = 0
+        done = False
+        while not done:
+            got = (f.readinto(view[n:]) or 0) if n < BUF else 0
+            n += got
+            pos = 0
+            while True:
+                nl = parse(buf, pos, n, fields)
+                if nl < 0:
+                    break
+                if partial:
+                    partial = False
+                elif fields[FIELDS] >= FIELDS:
+                    lines += 1
+                    if stop_field >= 0 and fields[stop_field] > stop:
+                        done = True
+                        break
+                    if cuts.match(fields):
+                        matched += 1
+                        length = nl + 1 - pos
+                        if o + length > OUT:
+                            yield memoryview(out)[:o]
+                            o = 0
+                        out[o:o + length] = view[pos:nl + 1]
+                        o += length
+                pos = nl + 1
+            if done or not got:
+                break
+            if pos == 0 and n == BUF:
+                n = 0                       # no newline in a full buffer: not an event line
+                partial = True
+            else:
+                buf[:n - pos] = buf[pos:n]
+                n -= pos
+        if o:
+            yield memoryview(out)[:o]
+    if stats is not None:
+        stats['lines'] = lines
+        stats['matched'] = matched
@@ -0,0 +1,325 @@
+"""Run data file on the SD card, written as a series of segment files.
+
+A run used to go into one ever-growing file, which after a few weeks is slow
+to list, download and analyze. RunFile starts a new segment when the current
+one reaches `rotate_bytes` or has been open for `rotate_s` seconds. Every
+segment starts with the full metadata header (with the baseline and thresholds
+at the time it was opened and its `segment` number), so each one loads on its
+own. Segments after the first are named like the first with _s001, _s002, ...
+in front of .csv; Muon Count and t continue across segments.
+
+The DAQ loop only writes to `run.f` and calls check(), which is cheap. The next
+segment is opened and its header written ahead of time by the task() coroutine,
+so rotating in the loop is a swap of file handles; the finished segment is
+flushed and closed by the task afterwards. With `preallocate`, the task also
+fills the next segment with NUL bytes up to `rotate_bytes`, a little at a time,
+so its FAT cluster chain already exists when data is written to it. The unused
+NUL tail is skipped by muon_data.py like the zero fill left after a reset.
+
+Every header also has segment_start_ticks_ms, the ticks_ms when the header was
+written (shortly before the segment's first event), and segment_start_time,
+its wall-clock time. They time the events of a segment that opens more than
+one ticks_ms period (2**30 ms, about 12.4 days) after the run start, which
+run_start_ticks_ms alone cannot.
+
+run_start_time, segment_start_time and time_sync are written as fixed-width
+placeholders when a segment is opened before the clock is synced and
+overwritten in place once it is. Segments closed after the sync get the
+time-based name.
+
+With `stats` (an SdStats.SdStats), the SD write latency statistics of each
+segment are saved next to it as <segment>.sd.json when it is closed, and reset.
+"""
+import asyncio
+import json
+import time
+
+try:
+    import uos as os
+    from micropython import const
+except ImportError:  # host
+    import os
+
+    def const(x):
+        return x
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:  # host
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+RUN_START_WIDTH = const(32)  # len("2024-11-01T18:06:41.482000+00:00")
+TIME_SYNC_WIDTH = const(40)
+KEYS = ("baseline,stddev,threshold,reset_threshold,run_start_time,is_leader,run_start_ticks_ms,time_sync,segment,"
+        "segment_start_time,segment_start_ticks_ms\n")
+EVENT_HEADER = "Muon Count,ADC,temperature_ADC,dt,t,t_wait,coinc\n"
+FILL = "\x00" * 512
+SIDECARS = (".sd.json", ".slow.csv")   # files next to a segment that are renamed with it
+
+
+def pad(text, width):
+    """text cut or padded with spaces to exactly width characters"""
+    text = text[:width]
+    return text + " " * (width - len(text))
+
+
+class Segment:
+    def __init__(self, f, name, number):
+        self.f = f
+        self.name = name
+        self.number = number
+        self.start_ticks = 0
+        self.header_ticks = 0       # segment_start_ticks_ms: ticks_ms when the header was written
+        self.header_pos = -1        # byte offset of run_start_time, -1 before the header is written
+        self.sync_pos = 0           # byte offset of time_sync
+        self.start_pos = 0          # byte offset of segment_start_time
+        self.patched = False
+        self.stats_saved = False
+
+
+class RunFile:
+    def __init__(self, directory, clock, header, rotate_bytes=16_000_000, rotate_s=86400,
+                 preallocate=False, buffering=10240, lead_s=60, stats=None, extra_columns=""):
+        self.directory = directory
+        self.clock = clock
+        self.header = header              # returns (baseline, rms, threshold, reset_threshold, is_leader)
+        self.rotate_bytes = rotate_bytes  # 0: no size limit
+        self.rotate_s = rotate_s          # 0: no time limit; keep below 6 days (ticks_ms wrap)
+        self.preallocate = preallocate
+        self.buffering = buffering
+        self.lead_s = lead_s              # write the next header this long before rotation is due
+        self.stats = stats
+        self.event_header = EVENT_HEADER[:-1] + extra_columns + "\n"   # e.g. PulseCapture columns
+        self.start_ticks = 0
+        self.start_iso = None             # run_start_time, kept once known (see _run_start)
+        self.unsynced_base = None
+        self.current = None
+        self.next = None
+        self.retired = []
+        self.unsynced = []                # segments closed before the clock sync
+        self.rotations = 0
+        self.f = None
+
+    # -- names --------------------------------------------------------------
+    def base_name(self):
+        """Segment name without suffix, from the run start time once the clock is synced"""
+        if self.clock.synced:
+            t = self._run_start()       # 2024-11-01T18:06:41.482000+00:00
+            return f"{self.directory}/muon_data_{t[0:4]}{t[5:7]}{t[8:10]}_{t[11:13]}{t[14:16]}"
+        if self.unsynced_base is None:
+            n = 0
+            while True:
+                base = f"{self.directory}/muon_data_unsynced_{n:03d}"
+                try:
+                    os.stat(base + ".csv")
+                except OSError:
+                    try:
+                        os.stat(base + ".csv.gz")     # compacted
+                    except OSError:
+                        break
+                n += 1
+            self.unsynced_base = base
+        return self.unsynced_base
+
+    def segment_name(self, number):
+        if number:
+            return f"{self.base_name()}_s{number:03d}.csv"
+        return self.base_name() + ".csv"
+
+    @property
+    def name(self):
+        return self.current.name if self.current else None
+
+    # -- segments -----------------------------------------------------------
+    def _open(self, number):
+        name = self.segment_name(number)
+        return Segment(open(name, "w", buffering=self.buffering, encoding='utf-8'), name, number)
+
+    def _run_start(self):
+        """run_start_time, or None before the sync. It is worked out once: the clock maps
+        ticks_ms to time with ticks_diff, which is wrong for ticks more than ~6 days old."""
+        if self.start_iso is None:
+            self.start_iso = self.clock.iso8601(self.start_ticks, "+00:00")
+        return self.start_iso
+
+    def _write_header(self, seg):
+        baseline, rms, threshold, reset_threshold, is_leader = self.header()
+        seg.header_ticks = ticks_ms()
+        run_start = self._run_start() or "unsynced"
+        seg_start = self.clock.iso8601(seg.header_ticks, "+00:00") or "unsynced"
+        prefix = f"{baseline:.1f}, {rms:.1f}, {threshold}, {reset_threshold}, "
+        middle = f", {1 if is_leader else 0}, {self.start_ticks}, "
+        number = f", {seg.number}, "
+        f = seg.f
+        f.seek(0)
+        f.write(KEYS)
+        f.write(prefix)
+        f.write(pad(run_start, RUN_START_WIDTH))
+        f.write(middle)
+        f.write(pad(self.clock.quality(), TIME_SYNC_WIDTH))
+        f.write(number)
+        f.write(pad(seg_start, RUN_START_WIDTH))
+        f.write(f", {seg.header_ticks}\n")
+        f.write(self.event_header)
+        seg.header_pos = len(KEYS) + len(prefix)
+        seg.sync_pos = seg.header_pos + RUN_START_WIDTH + len(middle)
+        seg.start_pos = seg.sync_pos + TIME_SYNC_WIDTH + len(number)
+        seg.patched = self.clock.synced
+
+    def _patch(self, seg):
+        """Back-fill run_start_time, time_sync and segment_start_time once the clock is synced"""
+        seg.patched = True
+        try:
+            end = seg.f.tell()
+            seg.f.seek(seg.header_pos)
+            seg.f.write(pad(self._run_start(), RUN_START_WIDTH))
+            seg.f.seek(seg.sync_pos)
+            seg.f.write(pad(self.clock.quality(), TIME_SYNC_WIDTH))
+            seg.f.seek(seg.start_pos)
+            seg.f.write(pad(self.clock.iso8601(seg.header_ticks, "+00:00"), RUN_START_WIDTH))
+            seg.f.seek(end)
+            print(f"{seg.name}: header updated with synced start time")
+        except OSError as e:
+            print(f"{seg.name}: could not update header:", e)
+
+    def _save_stats(self, seg):
+        if self.stats is None or seg.stats_saved:
+            return
+        seg.stats_saved = True
+        try:
+            with open(seg.name[:-4] + ".sd.json", "w") as fp:
+                json.dump(self.stats.as_dict(), fp)
+        except OSError as e:
+            print(f"{seg.name}: could not save SD statistics:", e)
+        self.stats.reset()
+
+    def _close(self, seg):
+        """Close a segment; give one opened before the clock sync its time-based name"""
+        if not seg.patched and self.clock.synced:
+            self._patch(seg)    # retired before the sync, closed after it
+        seg.f.close()
+        self._save_stats(seg)
+        if not self.clock.synced:
+            self.unsynced.append(seg)
+        elif "unsynced" in seg.name:
+            name = self.segment_name(seg.number)
+            try:
+                os.stat(name)
+                print(f"{name} exists, keeping {seg.name}")
+            except OSError:
+                os.rename(seg.name, name)
+                print(f"renamed {seg.name} -> {name}")
+                for suffix in SIDECARS:
+                    try:
+                        os.rename(seg.name[:-4] + suffix, name[:-4] + suffix)
+                    except OSError:
+                        pass
+
+    def _due(self, lead_bytes=0, lead_ms=0):
+        seg = self.current
+        if self.rotate_bytes and seg.f.tell() >= self.rotate_bytes - lead_bytes:
+            return True
+        return bool(self.rotate_s) and ticks_diff(ticks_ms(), seg.start_ticks) >= self.rotate_s * 1000 - lead_ms
+
+    def open_names(self):
+        """Names of the segments this run still writes, closes or renames"""
+        names = [seg.name for seg in self.retired + self.unsynced]
+        for seg in (self.current, self.next):
+            if seg is not None:
+                names.append(seg.name)
+        return names
+
+    # -- used by the DAQ ----------------------------------------------------
+    def start(self, start_ticks):
+        """Open the first segment of a run and write its header"""
+        self.start_ticks = start_ticks
+        self.start_iso = None
+        self.unsynced_base = None
+        seg = self._open(0)
+        self._write_header(seg)
+        seg.start_ticks = start_ticks
+        self.current = seg
+        self.f = seg.f
+        print(f"run file {seg.name}")
+        return seg.f
+
+    def check(self):
+        """Called from the DAQ loop now and then: patch the header, switch to the next segment when due"""
+        seg = self.current
+        if not seg.patched and self.clock.synced:
+            self._patch(seg)
+        nxt = self.next
+        if nxt is not None and nxt.header_pos >= 0 and self._due():
+            nxt.start_ticks = ticks_ms()
+            self.current = nxt
+            self.f = nxt.f
+            self.next = None
+            self.retired.append(seg)
+            self.rotations += 1
+
+    async def task(self):
+        """Prepare the next segment and close finished ones. Run as a task."""
+        while True:
+            while self.retired:
+                seg = self.retired.pop(0)
+                try:
+                    self._close(seg)
+                    print(f"closed segment {seg.name}, now writing {self.name}")
+                except OSError as e:
+                    print(f"closing {seg.name} failed:", e)
+            if self.unsynced and self.clock.synced:
+                # segments finished before the sync: back-fill the header and rename
+                seg = self.unsynced.pop(0)
+                try:
+                    seg.f = open(seg.name, "r+")
+                    self._patch(seg)
+                    self._close(seg)
+                except OSError as e:
+                    print(f"updating {seg.name} failed:", e)
+            if self.current is not None and (self.rotate_bytes or self.rotate_s):
+                try:
+                    await self._prepare()
+                except OSError as e:
+                    print("preparing the next segment failed:", e)
+            await asyncio.sleep(1)
+
+    async def _prepare(self):
+        if self.next is None and (self.preallocate or self._due(self.rotate_bytes >> 6, self.lead_s * 1000)):
+            self.next = self._open(self.current.number + 1)
+            if self.preallocate and self.rotate_bytes:
+                write = self.next.f.write
+                for _ in range(self.rotate_bytes // len(FILL)):
+                    write(FILL)
+                    await sleep_ms(0)
+        nxt = self.next
+        if nxt is None:
+            return
+        if nxt.header_pos < 0:
+            if self._due(self.rotate_bytes >> 6, self.lead_s * 1000):
+                self._write_header(nxt)
+        elif not nxt.patched and self.clock.synced:
+            self._patch(nxt)
+
+    def close(self):
+        """Close all segments at the end of the run; an unused next segment is removed"""
+        for seg in self.retired:
+            self._close(seg)
+        self.retired = []
+        if self.next is not None:
+            self.next.f.close()
+            os.remove(self.next.name)
+            self.next = None
+        if self.current is not None:
+            self._close(self.current)
+            self.current = None
@@ -0,0 +1,135 @@
+"""Latency histograms of SD card writes, flushes and syncs.
+
+The DAQ loop writes through SdStats instead of calling f.write(), f.flush()
+and os.sync() directly. Each call is timed with ticks_us and counted in a
+histogram with power-of-two bins (bin i holds calls that took 2**(i-1) to
+2**i - 1 us, bin 0 calls under 1 us), together with the count, the total and
+the longest call and when it happened. These costs are dead time of the
+trigger loop, so the numbers tell which SD card and buffer size to use.
+
+as_dict() is what RunFile saves next to each segment (<segment>.sd.json) and
+what run_summary.py reads; the web page and the MQTT status use it as well.
+"""
+import array
+import time
+
+try:
+    import uos as os
+    from micropython import const
+except ImportError:  # host
+    import os
+
+    def const(x):
+        return x
+
+try:
+    ticks_us = time.ticks_us
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_us():
+        return int(time.monotonic() * 1000000)
+
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+NBINS = const(24)  # the last bin also holds everything above 2**22 us (4.2 s)
+
+
+class Latency:
+    def __init__(self):
+        self.hist = array.array('I', [0] * NBINS)
+        self.reset()
+
+    def reset(self):
+        for i in range(NBINS):
+            self.hist[i] = 0
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+        self.max_ticks = 0      # ticks_ms of the longest call
+
+    def add(self, us):
+        b = 0
+        while us >> b and b < NBINS - 1:
+            b += 1
+        self.hist[b] += 1
+        self.count += 1
+        self.total_us += us
+        if us > self.max_us:
+            self.max_us = us
+            self.max_ticks = ticks_ms()
+
+    def mean_us(self):
+        return self.total_us / self.count if self.count else 0.
+
+    def percentile_us(self, q):
+        """Upper edge of the bin holding the q-th percentile (an upper bound in us)"""
+        if not self.count:
+            return 0
+        need = self.count * q / 100.
+        seen = 0
+        for b in range(NBINS):
+            seen += self.hist[b]
+            if seen >= need:
+                return min(1 << b, self.max_us)
+        return self.max_us
+
+    def as_dict(self):
+        return {'count': self.count, 'total_us': self.total_us, 'max_us': self.max_us,
+                'hist': list(self.hist)}
+
+
+class SdStats:
+    def __init__(self):
+        self.writes = Latency()
+        self.flushes = Latency()
+        self.syncs = Latency()
+        self.reset()
+
+    def reset(self):
+        self.writes.reset()
+        self.flushes.reset()
+        self.syncs.reset()
+        self.bytes = 0
+        self.start = ticks_ms()
+
+    def write(self, f, text):
+        t = ticks_us()
+        f.write(text)
+        self.writes.add(ticks_diff(ticks_us(), t))
+        self.bytes += len(text)
+
+    def flush(self, f):
+        t = ticks_us()
+        f.flush()
+        self.flushes.add(ticks_diff(ticks_us(), t))
+
+    def sync(self):
+        t = ticks_us()
+        os.sync()
+        self.syncs.add(ticks_diff(ticks_us(), t))
+
+    def worst(self):
+        """(kind, us, ticks_ms) of the longest call of any kind"""
+        worst = ('write', self.writes)
+        for kind, latency in (('flush', self.flushes), ('sync', self.syncs)):
+            if latency.max_us > worst[1].max_us:
+                worst = (kind, latency)
+        return worst[0], worst[1].max_us, worst[1].max_ticks
+
+    def seconds(self):
+        return ticks_diff(ticks_ms(), self.start) / 1000
+
+    def bytes_per_s(self):
+        seconds = self.seconds()
+        return self.bytes / seconds if seconds > 0 else 0.
+
+    def as_dict(self):
+        kind, us, _ = self.worst()
+        return {'seconds': self.seconds(), 'bytes': self.bytes, 'bytes_per_s': self.bytes_per_s(),
+                'worst': kind, 'worst_us': us, 'write': self.writes.as_dict(),
+                'flush': self.flushes.as_dict(), 'sync': self.syncs.as_dict()}
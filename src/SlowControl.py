@@ -0,0 +1,148 @@
+"""Slow-control channel: housekeeping ADC values at a fixed cadence.
+
+The temperature changes over minutes, yet the trigger loop used to read the
+temperature ADC for every event. SlowControl samples the housekeeping channels
+(the temperature sensor on the carrier board, the RP2040 die temperature, ...)
+every `interval_s` seconds, averaging `samples` reads of each, and keeps the
+latest averages in `latest`. Events take their temperature from there, which
+removes an ADC conversion from every trigger.
+
+Each average is also appended, with the ticks_ms it was taken at and a
+sequence number, to a compact CSV stream next to the current data segment
+(<segment>.slow.csv, flushed every `flush_s` seconds), and as_dict() is part
+of the status.
+
+run() is the asyncio task. In single-core mode it does the reads itself. With
+DUAL_CORE the ADC belongs to core 1, so the trigger loop calls sample() between
+batches (external=True) and the task only averages what has accumulated. The
+sums are double-buffered: the task switches core 1 to the other bank and waits
+a few ms before it reads the finished one.
+"""
+import array
+import asyncio
+import time
+
+try:
+    import uos as os
+except ImportError:  # host
+    import os
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:  # host
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+
+def die_celsius(adc_value):
+    """RP2040 internal temperature sensor reading (ADC 4) in degrees C"""
+    return 27 - (adc_value * 3.3 / 65535 - 0.706) / 0.001721
+
+
+class SlowControl:
+    def __init__(self, channels, path, interval_s=10, samples=16, flush_s=60, external=False):
+        self.names = [name for name, _ in channels]
+        self.reads = [read for _, read in channels]
+        self.path = path                  # returns the name of the stream file to append to
+        self.interval_s = interval_s
+        self.samples = samples
+        self.flush_s = flush_s
+        self.external = external          # sample() is called by the DUAL_CORE trigger loop
+        n = len(channels)
+        self.sums = array.array('i', [0] * (2 * n))   # two banks of n sums
+        self.counts = array.array('i', [0, 0])
+        self.bank = 0                     # bank sample() adds to
+        self.latest = array.array('i', [0] * n)
+        self.t = 0                        # ticks_ms of the latest averages
+        self.seq = 0                      # number of averages so far
+        self.pending = []                 # stream lines not yet written
+        self.header = "t,seq," + ",".join(self.names) + "\n"
+
+    def sample(self):
+        """Read every channel once and add it to the current average"""
+        reads = self.reads
+        sums = self.sums
+        bank = self.bank
+        n = len(reads)
+        b = bank * n
+        for i in range(n):
+            sums[b + i] += reads[i]()
+        self.counts[bank] += 1
+
+    def prime(self):
+        """Fill `latest` before the run starts, so the first events have a value"""
+        for _ in range(self.samples):
+            self.sample()
+        self._average(self.bank)
+
+    def _average(self, bank):
+        count = self.counts[bank]
+        if not count:
+            return
+        n = len(self.latest)
+        b = bank * n
+        for i in range(n):
+            self.latest[i] = self.sums[b + i] // count
+            self.sums[b + i] = 0
+        self.counts[bank] = 0
+        self.t = ticks_ms()
+        self.seq += 1
+        self.pending.append(f"{self.t},{self.seq}," + ",".join([str(v) for v in self.latest]) + "\n")
+
+    def flush(self):
+        if not self.pending:
+            return
+        name = self.path()
+        if not name:
+            return
+        try:
+            try:
+                os.stat(name)
+                new = False
+            except OSError:
+                new = True
+            with open(name, "a") as f:
+                if new:
+                    f.write(self.header)
+                for line in self.pending:
+                    f.write(line)
+            self.pending = []
+        except OSError as e:
+            print("slow control: could not write", name, e)
+            if len(self.pending) > 100:
+                del self.pending[:len(self.pending) - 100]
+
+    def value(self, name):
+        return self.latest[self.names.index(name)]
+
+    def as_dict(self):
+        d = {'t_ms': self.t, 'seq': self.seq}
+        for i in range(len(self.names)):
+            d[self.names[i]] = self.latest[i]
+        return d
+
+    async def run(self):
+        last_flush = ticks_ms()
+        while True:
+            if not self.external:
+                for _ in range(self.samples):
+                    self.sample()
+                    await sleep_ms(1)
+            bank = self.bank
+            self.bank = bank ^ 1
+            await sleep_ms(5)     # let a sample() in progress on core 1 finish
+            self._average(bank)
+            if ticks_diff(ticks_ms(), last_flush) >= self.flush_s * 1000:
+                self.flush()
+                last_flush = ticks_ms()
+            await asyncio.sleep(self.interval_s)
@@ -0,0 +1,166 @@
+"""Automated threshold scan (plateau measurement).
+
+A ThresholdScan steps the trigger threshold from `start` to `stop` (inclusive)
+in steps of `step` ADC counts, dwells `dwell_s` seconds of livetime at each
+value and records the counts and coincidences seen there. Steps at or below the reset
+threshold are skipped. Each finished step is appended to a small CSV file on
+the SD card, threshold_scan_NNN.csv:
+
+    scan_start_time,baseline,reset_threshold,dwell_s
+    2025-10-19T14:02:11Z, 812.3, 862, 60
+    threshold,seconds,live_s,counts,coincidences,rate_hz,rate_err_hz,coinc_rate_hz
+    1000, 61.375, 60.012, 1432, 51, 23.862, 0.631, 0.850
+
+as_dict() has the same numbers for the web endpoint and MQTT. The scan only
+sets the threshold through the set_threshold callback; the firmware turns
+AUTO_RETUNE off while it runs and restores the threshold afterwards.
+
+The livetime is the time the trigger loop spent polling the ADC, a counter in
+ms modulo 2**30 that the firmware passes with the counts; time spent on
+pulses, SD writes or the web server is dead time and not counted. A step lasts
+until it has `dwell_s` of livetime (or LIVE_TIMEOUT times that in wall time,
+if the loop hardly runs). `seconds` is the wall time of the step, `live_s`
+its livetime, and the rates are per live second.
+"""
+import asyncio
+import time
+
+try:
+    import uos as os
+except ImportError:  # host
+    import os
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:  # host
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+MAX_STEPS = 200
+LIVE_TIMEOUT = 10       # a step ends after this many times dwell_s of wall time in any case
+LIVE_MASK = 0x3FFFFFFF  # the livetime counter wraps like ticks_ms
+COLUMNS = "threshold,seconds,live_s,counts,coincidences,rate_hz,rate_err_hz,coinc_rate_hz\n"
+
+
+class ThresholdScan:
+    def __init__(self, start, stop, step, dwell_s, directory, clock=None, baseline=0.):
+        start, stop, step, dwell_s = int(start), int(stop), int(step), float(dwell_s)
+        if step == 0 or (stop - start) * step < 0:
+            raise ValueError("step must go from start towards stop")
+        if not 0 <= start <= 65535 or not 0 <= stop <= 65535:
+            raise ValueError("thresholds must be 0 .. 65535")
+        if dwell_s <= 0:
+            raise ValueError("dwell_s must be positive")
+        if (stop - start) // step + 1 > MAX_STEPS:
+            raise ValueError(f"more than {MAX_STEPS} steps")
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.dwell_s = dwell_s
+        self.directory = directory
+        self.clock = clock
+        self.baseline = baseline
+        self.state = "pending"          # running, done, cancelled, failed
+        self.current = None             # threshold of the step in progress
+        self.steps = []                 # (threshold, ms, live_ms, counts, coincidences)
+        self.name = None
+        self.cancelled = False
+
+    def values(self):
+        return range(self.start, self.stop + (1 if self.step > 0 else -1), self.step)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _new_file(self, reset_threshold):
+        n = 0
+        while True:
+            name = f"{self.directory}/threshold_scan_{n:03d}.csv"
+            try:
+                os.stat(name)
+            except OSError:
+                break
+            n += 1
+        started = (self.clock.iso8601(ticks_ms()) if self.clock is not None else None) or "unsynced"
+        with open(name, "w") as f:
+            f.write("scan_start_time,baseline,reset_threshold,dwell_s\n")
+            f.write(f"{started}, {self.baseline:.1f}, {reset_threshold}, {self.dwell_s:g}\n")
+            f.write(COLUMNS)
+        self.name = name
+
+    @staticmethod
+    def _rates(live_ms, counts, coincidences):
+        seconds = live_ms / 1000
+        if seconds <= 0:
+            return 0., 0., 0.
+        return counts / seconds, counts ** 0.5 / seconds, coincidences / seconds
+
+    def _record(self, threshold, ms, live_ms, counts, coincidences):
+        self.steps.append((threshold, ms, live_ms, counts, coincidences))
+        rate, err, coinc_rate = self._rates(live_ms, counts, coincidences)
+        line = (f"{threshold}, {ms / 1000:.3f}, {live_ms / 1000:.3f}, {counts}, {coincidences}, "
+                f"{rate:.3f}, {err:.3f}, {coinc_rate:.3f}\n")
+        try:
+            with open(self.name, "a") as f:
+                f.write(line)
+        except OSError as e:
+            print("threshold scan: could not write", self.name, e)
+
+    async def run(self, set_threshold, counts, reset_threshold):
+        """Do the scan. counts() returns (muon_count, coincidences, livetime ms mod 2**30);
+        reset_threshold() the current value."""
+        self.state = "running"
+        try:
+            self._new_file(reset_threshold())
+            print(f"threshold scan {self.start} .. {self.stop} step {self.step}, {self.dwell_s:g} s per step "
+                  f"-> {self.name}")
+            dwell_ms = int(self.dwell_s * 1000)
+            for value in self.values():
+                if self.cancelled:
+                    break
+                if value <= reset_threshold():
+                    print(f"threshold scan: skipping {value} (reset threshold {reset_threshold()})")
+                    continue
+                set_threshold(value)
+                self.current = value
+                await sleep_ms(100)   # let the trigger loop pick up the new value
+                c0, k0, l0 = counts()
+                t0 = ticks_ms()
+                live = 0
+                while live < dwell_ms and not self.cancelled:
+                    if ticks_diff(ticks_ms(), t0) >= LIVE_TIMEOUT * dwell_ms:
+                        print(f"threshold scan: only {live} ms livetime at {value}")
+                        break
+                    await sleep_ms(min(dwell_ms - live, 250))
+                    live = (counts()[2] - l0) & LIVE_MASK
+                if self.cancelled:
+                    break
+                c1, k1, l1 = counts()
+                self._record(value, ticks_diff(ticks_ms(), t0), (l1 - l0) & LIVE_MASK, c1 - c0, k1 - k0)
+            self.state = "cancelled" if self.cancelled else "done"
+        except Exception as e:
+            self.state = "failed"
+            print("threshold scan failed:", e)
+        finally:
+            self.current = None
+        print(f"threshold scan {self.state}, {len(self.steps)} steps")
+
+    def as_dict(self):
+        rows = []
+        for threshold, ms, live_ms, counts, coincidences in self.steps:
+            rate, err, coinc_rate = self._rates(live_ms, counts, coincidences)
+            rows.append({'threshold': threshold, 'seconds': ms / 1000, 'live_s': live_ms / 1000, 'counts': counts,
+                         'coincidences': coincidences, 'rate_hz': rate, 'rate_err_hz': err,
+                         'coinc_rate_hz': coinc_rate})
+        return {'state': self.state, 'start': self.start, 'stop': self.stop, 'step': self.step,
+                'dwell_s': self.dwell_s, 'current': self.current, 'file': self.name, 'steps': rows}
@@ -0,0 +1,184 @@
+"""Clock synchronization that runs as an asyncio task next to the DAQ.
+
+init_RTC() used to block for up to a minute (NTP retries with time.sleep, then
+urequests) before data taking could start. TimeSync instead lets the DAQ start
+at once on ticks_ms and queries NTP in the background with a non-blocking UDP
+socket, so the event loop is never held up by a slow or absent server. The
+name of each NTP host is resolved once and kept until the next periodic
+resync (getaddrinfo blocks); the worldtimeapi.org fallback blocks as well, for
+at most `http_timeout_s`.
+
+Once synced, TimeSync maps any ticks_ms value to wall-clock time, so times of
+events recorded before the sync (run start, first events) can be back-filled.
+It also sets the RTC, and resyncs every `resync_s` seconds to follow drift and
+keep the ticks reference well inside the ticks_ms wrap-around.
+"""
+import asyncio
+import socket
+import struct
+import time
+
+try:
+    from machine import RTC
+except ImportError:  # host
+    RTC = None
+
+try:
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_ms():
+        return int(time.monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+try:
+    sleep_ms = asyncio.sleep_ms
+except AttributeError:  # host
+    def sleep_ms(ms):
+        return asyncio.sleep(ms / 1000)
+
+# seconds from the NTP epoch (1900) to the epoch of this port (1970 or 2000)
+if time.gmtime(0)[0] == 2000:
+    NTP_DELTA = 3155673600
+else:
+    NTP_DELTA = 2208988800
+
+
+class TimeSync:
+    def __init__(self, hosts, timeout_ms=2000, backoff_s=(2, 4, 8, 16, 32, 60), resync_s=3600,
+                 http_fallback=True, http_timeout_s=5):
+        self.hosts = hosts
+        self.timeout_ms = timeout_ms
+        self.backoff_s = backoff_s
+        self.resync_s = resync_s
+        self.http_fallback = http_fallback
+        self.http_timeout_s = http_timeout_s
+        self._addrs = {}            # host -> resolved NTP address
+        self.synced = False
+        self.source = "none"
+        self.rtt_ms = -1
+        self.attempts = 0
+        self.last_step_ms = 0       # correction applied by the latest resync
+        self._ref_ticks = 0
+        self._ref_epoch_ms = 0
+
+    # -- queries ------------------------------------------------------------
+    async def ntp_query(self, host):
+        """One NTP request; returns (server epoch ms at receipt, round trip ms)."""
+        addr = self._addrs.get(host)
+        if addr is None:
+            addr = socket.getaddrinfo(host, 123)[0][-1]
+            self._addrs[host] = addr
+        packet = bytearray(48)
+        packet[0] = 0x1B  # LI 0, version 3, client mode
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.setblocking(False)
+            sent = ticks_ms()
+            s.sendto(packet, addr)
+            while True:
+                try:
+                    reply = s.recv(48)
+                    break
+                except OSError:
+                    if ticks_diff(ticks_ms(), sent) > self.timeout_ms:
+                        raise OSError("NTP timeout")
+                    await sleep_ms(20)
+            received = ticks_ms()
+        finally:
+            s.close()
+        if len(reply) < 48:
+            raise OSError("short NTP reply")
+        seconds, fraction = struct.unpack("!II", reply[40:48])
+        if seconds == 0:
+            raise OSError("NTP server not synchronized")
+        rtt = ticks_diff(received, sent)
+        epoch_ms = (seconds - NTP_DELTA) * 1000 + ((fraction * 1000) >> 32) + rtt // 2
+        return received, epoch_ms, rtt
+
+    def http_query(self):
+        """Blocking fallback via worldtimeapi.org, 1 s resolution, at most http_timeout_s."""
+        import urequests
+        response = urequests.get('http://worldtimeapi.org/api/ip', timeout=self.http_timeout_s)
+        try:
+            data = response.json()
+        finally:
+            response.close()
+        received = ticks_ms()
+        stamp = data['utc_datetime']
+        tm = (int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10]),
+              int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19]), 0, 0)
+        return received, time.mktime(tm) * 1000, -1
+
+    # -- state --------------------------------------------------------------
+    def _apply(self, ticks, epoch_ms, rtt, source):
+        if self.synced:
+            self.last_step_ms = epoch_ms - self.epoch_ms(ticks)
+        self._ref_ticks = ticks
+        self._ref_epoch_ms = epoch_ms
+        self.rtt_ms = rtt
+        self.source = source
+        self.synced = True
+        if RTC is not None:
+            tm = time.gmtime(epoch_ms // 1000)
+            RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], 0))
+
+    async def sync_once(self):
+        for host in self.hosts:
+            self.attempts += 1
+            try:
+                ticks, epoch_ms, rtt = await self.ntp_query(host)
+                self._apply(ticks, epoch_ms, rtt, "ntp " + host)
+                print(f"NTP sync with {host}: rtt {rtt} ms, step {self.last_step_ms} ms")
+                return True
+            except Exception as e:
+                print(f"NTP sync with {host} failed: {e}")
+        return False
+
+    async def run(self):
+        """Sync with backoff, then resync periodically. Run as a task."""
+        tries = 0
+        while not self.synced:
+            if await self.sync_once():
+                break
+            if tries >= len(self.backoff_s) - 1 and self.http_fallback:
+                try:
+                    ticks, epoch_ms, rtt = self.http_query()
+                    self._apply(ticks, epoch_ms, rtt, "http worldtimeapi")
+                    print("time set from worldtimeapi.org")
+                    break
+                except Exception as e:
+                    print(f"worldtimeapi.org failed: {e}")
+            await asyncio.sleep(self.backoff_s[min(tries, len(self.backoff_s) - 1)])
+            tries += 1
+        while self.resync_s:
+            await asyncio.sleep(self.resync_s)
+            self._addrs = {}        # follow address changes of pool servers
+            await self.sync_once()
+
+    # -- conversions --------------------------------------------------------
+    def epoch_ms(self, ticks):
+        """Wall-clock time of a ticks_ms value, in ms since the epoch of this port."""
+        return self._ref_epoch_ms + ticks_diff(ticks, self._ref_ticks)
+
+    def iso8601(self, ticks, suffix="Z"):
+        """ISO-8601 UTC time of a ticks_ms value, or None before the first sync."""
+        if not self.synced:
+            return None
+        seconds, ms = divmod(self.epoch_ms(ticks), 1000)
+        tm = time.gmtime(seconds)
+        return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:06d}{}".format(
+            tm[0], tm[1], tm[2], tm[3], tm[4], tm[5], ms * 1000, suffix)
+
+    def gmtime(self, ticks):
+        return time.gmtime(self.epoch_ms(ticks) // 1000)
+
+    def quality(self):
+        """Short description of the sync for run headers (no commas)."""
+        if not self.synced:
+            return "none"
+        if self.rtt_ms < 0:
+            return self.source
+        return f"{self.source} rtt {self.rtt_ms} ms"
@@ -0,0 +1,110 @@
+"""Compiled ADC polling kernel of the trigger loop.
+
+The trigger loop used to do its bookkeeping (iteration counter, modulo checks
+for the periodic work, the shutdown flags) on every ADC sample, so most of each
+iteration was interpreter overhead rather than sampling. scan() instead polls
+the ADC up to `budget` times in one call and returns early at the first sample
+above `threshold`; the loop does its bookkeeping once per call.
+
+    n = scan(readout, threshold, budget, out)
+
+returns the number of samples read. out is an array('i', [0, 0]): out[HIT] is
+the sample above threshold (0 if the budget ran out first) and out[LAST] the
+last sample read, which is an idle sample for the baseline tracker when there
+was no hit.
+
+There are three versions with the same behavior: scan_viper (machine-word
+integers, fastest), scan_native and scan_py (plain Python). scan is the
+fastest one that passes a check on a dummy readout. Under CPython the
+decorators and ptr32 are stand-ins, so all three run on a laptop;
+bench_trigger.py compares them.
+
+The emitters are compiler features: MicroPython only recognizes them written
+as @micropython.viper and @micropython.native, and a firmware built without
+them cannot compile this module at all (SyntaxError on import of the .py,
+an incompatible .mpy for the precompiled one), so there is nothing to catch at
+run time. Every rp2 (Pico W) build has them.
+"""
+try:
+    import micropython
+    from micropython import const
+except ImportError:  # host
+    class micropython:
+        @staticmethod
+        def native(f):
+            return f
+
+        viper = native
+
+    def const(x):
+        return x
+
+    def ptr32(a):  # host: index the array directly
+        return a
+
+HIT = const(0)
+LAST = const(1)
+
+
+@micropython.viper
+def scan_viper(readout, threshold: int, budget: int, out) -> int:
+    o = ptr32(out)
+    n = 0
+    v = 0
+    while n < budget:
+        v = int(readout())
+        n += 1
+        if v > threshold:
+            o[0] = v
+            o[1] = v
+            return n
+    o[0] = 0
+    o[1] = v
+    return n
+
+
+@micropython.native
+def scan_native(readout, threshold, budget, out):
+    n = 0
+    v = 0
+    while n < budget:
+        v = readout()
+        n += 1
+        if v > threshold:
+            out[0] = v
+            out[1] = v
+            return n
+    out[0] = 0
+    out[1] = v
+    return n
+
+
+def scan_py(readout, threshold, budget, out):
+    n = 0
+    v = 0
+    while n < budget:
+        v = readout()
+        n += 1
+        if v > threshold:
+            out[0] = v
+            out[1] = v
+            return n
+    out[0] = 0
+    out[1] = v
+    return n
+
+
+def _pick():
+    # the compiled versions are checked once, so a wrong result from one falls back to the next
+    import array
+    out = array.array('i', [0, 0])
+    for f in (scan_viper, scan_native):
+        try:
+            if f(lambda: 1, 0, 2, out) == 1 and out[0] == 1:
+                return f
+        except Exception:
+            pass
+    return scan_py
+
+
+scan = _pick()
@@ -0,0 +1,545 @@
+# pylint: disable=missing-function-docstring,line-too-long,unused-argument
+"""Web pages of asynchio4.py with large HTML/JS bodies.
+
+asynchio4.py imports this module on the first request for one of these pages,
+so its code and strings take no heap until the web interface is used. Install
+it precompiled (WebPages.mpy) to skip compiling it on the board as well.
+Pages that need the DAQ state get the globals() of the main module as `g`.
+"""
+import gc
+import time
+import uos as os
+from micropython import const
+from microdot import Response
+
+PREFIX = "muon_data_"
+SIDECARS = (".sd.json", ".slow.csv")    # as in RunFile.SIDECARS
+
+
+def is_run(name):
+    """Whether name is a run segment (.csv or compacted .csv.gz), not a sidecar or scan result"""
+    if not name.startswith(PREFIX) or not (name.endswith('.csv') or name.endswith('.csv.gz')):
+        return False
+    for suffix in SIDECARS:
+        if name.endswith(suffix):
+            return False
+    return True
+
+
+def _put(buf, n, data):
+    """Copy data into buf at n, replacing buf by a larger one if it does not fit"""
+    end = n + len(data)
+    if end > len(buf):
+        bigger = bytearray(end + 256)
+        bigger[:n] = buf[:n]
+        buf = bigger
+    buf[n:end] = data
+    return buf, end
+
+
+class Template:
+    """An HTML page as bytes constants with {{field}} slots.
+
+    The template is split into its static parts once, when WebPages is imported.
+    render() copies those and the values into one reusable buffer and keeps the
+    result as bytes, the page that responses send; it is reused for `ttl_ms`
+    without calling values() at all. A response holds its own page, so a new
+    render never changes what a response still sends, even one that is never
+    finished or closed.
+    """
+    def __init__(self, text, ttl_ms=0, slack=64):
+        parts = text.split(b"{{")
+        self.static = [parts[0]]
+        self.fields = []
+        for part in parts[1:]:
+            name, rest = part.split(b"}}", 1)
+            self.fields.append(name.decode())
+            self.static.append(rest)
+        self.ttl_ms = ttl_ms
+        self.buf = bytearray(sum([len(s) for s in self.static]) + slack * len(self.fields))
+        self.page = b""
+        self.t = None       # ticks_ms of the cached render
+
+    def _render(self, buf, values):
+        if len(values) != len(self.fields):
+            raise ValueError("expected values for " + ", ".join(self.fields))
+        static = self.static
+        n = 0
+        for i in range(len(values)):
+            buf, n = _put(buf, n, static[i])
+            v = values[i]
+            buf, n = _put(buf, n, v if isinstance(v, bytes) else str(v).encode())
+        return _put(buf, n, static[-1])
+
+    def render(self, values):
+        """The page as bytes; values() returns the field values in template order"""
+        now = time.ticks_ms()
+        if self.t is not None and time.ticks_diff(now, self.t) < self.ttl_ms:
+            return self.page
+        self.buf, n = self._render(self.buf, values())
+        self.page = bytes(memoryview(self.buf)[:n])
+        self.t = now
+        return self.page
+
+    def send(self, values):
+        """Response body: the rendered page"""
+        yield self.render(values)
+
+
+INDEX = Template(b"""<!doctype html>
+    <html>
+      <head>
+        <meta charset="utf-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <title>CuWatch</title>
+        <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
+        <link rel="stylesheet" href="/styles.css">
+      </head>
+      <body class="bg-light">
+        <div class="d-flex">
+          <div class="sidebar">
+            <h2 class="text-center">CuWatch</h2>
+            <ul class="nav flex-column">
+              <li class="nav-item"><a class="nav-link active" href="/">Home</a></li>
+              <li class="nav-item"><a class="nav-link" href="/download">Download Data</a></li>
+              <li class="nav-item"><a class="nav-link" href="/technical">Technical</a></li>
+              <li class="nav-item"><button class="btn btn-secondary" onclick="invokeMicrocontrollerMethod()">Stop Run</button></li>
+              <li class="nav-item"><button class="btn btn-secondary" onclick="restartRequest()">Restart Run</button></li>
+              <li class="nav-item">
+                <input type="number" id="thresholdInput" class="form-control" placeholder="Enter new threshold">
+                <button class="btn btn-primary mt-2" onclick="updateThreshold()">Update Threshold</button>
+              </li>
+            <li class="nav-item">
+                <small class="form-text text-muted mt-1">
+                    Threshold should be an integer greater than the reset threshold.
+                </small>
+            </li>
+            </ul>
+            <p id="time" class="text-center mt-4"></p>
+          </div>
+          <div class="content">
+            <h1 class="my-4 text-center">CuWatch Status and Configuration</h1>
+            <table class="table table-striped table-bordered">
+              <thead class="thead-dark">
+                <tr><th>Variable</th><th>Value</th></tr>
+              </thead>
+              <tbody>
+                <tr><td>Rate (Hz)</td><td id="rate">{{rate}}</td></tr>
+                <tr><td>Muon Count</td><td id="muon_count">{{muon_count}}</td></tr>
+                <tr><td>Baseline (ADC counts)</td><td id="baseline">{{baseline}}</td></tr>
+                <tr><td>Threshold (ADC counts)</td><td id="threshold">{{threshold}}</td></tr>
+                <tr><td>Reset threshold (ADC counts)</td><td id="reset_threshold">{{reset_threshold}}</td></tr>
+                <tr><td>Runtime (s)</td><td id="runtime">{{runtime}}</td></tr>
+              </tbody>
+            </table>
+            <p id="last_updated" class="text-muted small text-right mb-0">Last updated: &mdash;</p>
+            <h3 class="my-4 text-center">Rate vs Time</h3>
+            <canvas id="rateChart"></canvas>
+          </div>
+        </div>
+        <footer class="text-center mt-5"><p class="text-muted">Powered by MicroPython and Microdot</p></footer>
+        <script src="/boot.js?v=1"></script>
+      </body>
+    </html>
+""", ttl_ms=1000)
+
+
+# Home page body; boot.js refreshes the values from /data, so a page up to a second old is fine
+def index_stream(myrate, muon_count, baseline, threshold, reset_threshold, runtime):
+    return INDEX.send(lambda: (myrate, muon_count, baseline, threshold, reset_threshold, runtime))
+
+
+def download_page(request, directory):
+    files = []
+    FILE_LIMIT = const(30)
+    filecount = 0
+
+    # Get the run files in the /sd directory, without sidecars and threshold scans
+    try:
+        if os.stat(directory):  # Check if directory exists
+            ring = []
+            # Prefer iterator on MicroPython to avoid a large list
+            if hasattr(os, 'ilistdir'):
+                for entry in os.ilistdir(directory):
+                    try:
+                        name = entry[0] if isinstance(entry, tuple) else entry
+                    except Exception:
+                        name = entry
+                    if isinstance(name, bytes):
+                        try:
+                            name = name.decode()
+                        except Exception:
+                            name = str(name)
+                    if isinstance(name, str) and is_run(name):
+                        filecount += 1
+                        ring.append(name)
+                        if len(ring) > FILE_LIMIT:
+                            del ring[0]
+            else:
+                try:
+                    names = os.listdir(directory)
+                except Exception:
+                    names = []
+                for name in names:
+                    if is_run(name):
+                        filecount += 1
+                        ring.append(name)
+                        if len(ring) > FILE_LIMIT:
+                            del ring[0]
+            files = ring
+        # Sort files by modification time (most recent first). This does not work
+        # as it requires too much memory when the list of files gets long
+        #files = sorted(files, key=lambda x: get_file_mtime(join_path(directory, x)), reverse=True)
+    except OSError:
+        files = []  # Handle case where SD card is not mounted or directory doesn't exist
+    # 
+    gc.collect()
+
+    import Compactor    # loaded by the main program already
+    compress = Compactor.can_compress()
+
+    # Stream HTML to reduce memory usage
+    def _stream():
+        yield "<!doctype html>\n<html>\n  <head>\n    <title>Download CSV Files</title>\n"
+        yield "    <link rel=\"stylesheet\" href=\"https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css\">\n"
+        yield "    <link rel=\"stylesheet\" href=\"/styles.css\">\n  </head>\n  <body class=\"bg-light\">\n    <div class=\"container\">\n      <h1 class=\"my-4 text-center\">Download CSV Files</h1>\n      <div class=\"btn-group\" role=\"group\" aria-label=\"Navigation Link\">\n        <button type=\"button\" class=\"btn btn-primary\" onclick=\"window.location.href='/'\">Return home</button>\n      </div>\n"
+        yield "      <h3 class=\"my-4 text-center\">Total number of files (showing %d): %d</h3>\n" % (FILE_LIMIT, filecount)
+        if compress:
+            yield "      <p>All runs in one file: <a href=\"/archive?compress=1\">tar.gz</a> | <a href=\"/archive\">tar</a> | <a href=\"/archive?format=zip&amp;compress=1\">zip</a></p>\n"
+        else:
+            yield "      <p>All runs in one file: <a href=\"/archive\">tar</a> | <a href=\"/archive?format=zip\">zip</a></p>\n"
+        yield "      <ul class=\"list-group\">\n"
+        for fname in files[::-1]:
+            yield "        <li class=\"list-group-item\"><a href=\"/download_file?file=%s\">%s</a></li>\n" % (fname, fname)
+        yield "      </ul>\n      <a href=\"/\">Back to Home</a>\n    </div>\n  </body>\n</html>\n"
+    return Response(body=_stream(), headers={'Content-Type': 'text/html'})
+
+
+TECHNICAL_HEAD = b"""<!doctype html>
+<html>
+  <head>
+    <title>CuWatch Technical Information</title>
+    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
+    <link rel="stylesheet" href="/styles.css">
+    <script>
+      function displayTime(){var now=new Date();var e=document.getElementById('time'); if(e){e.textContent=now.toLocaleTimeString();}}
+      setInterval(displayTime,1000);
+      function makeLeader(){fetch('/make-leader',{method:'POST'}).then(r=>r.json()).then(_=>reloadTable()).catch(()=>{});}
+      function makeFollower(){fetch('/make-follower',{method:'POST'}).then(r=>r.json()).then(_=>reloadTable()).catch(()=>{});}
+      function reloadTable(){fetch('/technical/table').then(r=>r.text()).then(function(h){var t=document.getElementById('table-container'); if(t){t.innerHTML=h;}}).catch(()=>{});}
+    </script>
+  </head>
+  <body class="bg-light">
+    <div class="d-flex">
+      <div class="sidebar bg-light p-3">
+        <h2 class="text-center">CuWatch</h2>
+        <ul class="nav flex-column">
+          <li class="nav-item"><a class="nav-link active" href="/">Home</a></li>
+          <li class="nav-item"><a class="nav-link" href="/download">Download Data</a></li>
+          <li class="nav-item"><button class="btn btn-secondary my-2" onclick="makeLeader()">Make Leader</button></li>
+          <li class="nav-item"><button class="btn btn-secondary my-2" onclick="makeFollower()">Make Follower</button></li>
+        </ul>
+        <div class="static-text bg-secondary text-white p-3 rounded mt-3">
+          <p>Leader and follower changes take effect on next new run.</p>
+        </div>
+        <p id="time" class="text-center mt-4"></p>
+      </div>
+      <div class="content flex-grow-1 p-3">
+        <h1 class="my-4 text-center">CuWatch Technical Information</h1>
+        <div id="table-container">
+"""
+
+TECHNICAL_TAIL = b"""        </div>
+      </div>
+    </div>
+  </body>
+</html>
+"""
+
+
+def technical_page(request, g):
+    def _stream():
+        yield TECHNICAL_HEAD
+        try:
+            yield from table_stream(g)
+        except Exception:
+            yield b"<p>Error loading table.</p>"
+        yield TECHNICAL_TAIL
+    return Response(body=_stream(), headers={'Content-Type': 'text/html'})
+
+
+def sd_rows(sd):
+    """Table rows with the SD card latencies of the current segment"""
+    rows = []
+    for kind, latency in (('write', sd.writes), ('flush', sd.flushes), ('sync', sd.syncs)):
+        rows.append(f"""<tr><td>SD {kind} (calls: mean / p99 / max)</td>
+            <td>{latency.count}: {latency.mean_us():.0f} / {latency.percentile_us(99)} / {latency.max_us} &micro;s</td></tr>""")
+    kind, us, _ = sd.worst()
+    rows.append(f"""<tr><td>SD bytes/s (worst stall)</td>
+            <td>{sd.bytes_per_s():.0f} ({kind} {us / 1000:.1f} ms)</td></tr>""")
+    return "".join(rows)
+
+def slow_row(slow):
+    """Table row with the latest slow-control averages"""
+    if slow is None:
+        return ""
+    import SlowControl
+    return f"""<tr><td>Temperature ADC / RP2040 die (slow control #{slow.seq})</td>
+            <td>{slow.value('temperature_adc')} / {SlowControl.die_celsius(slow.value('die_temperature_adc')):.1f} &deg;C</td></tr>"""
+
+def scan_status(scan):
+    if scan is None:
+        return "none"
+    if scan.current is not None:
+        return f"{scan.state}: threshold {scan.current}, {len(scan.steps)} steps done"
+    return f"{scan.state}, {len(scan.steps)} steps ({scan.name})"
+
+def compaction_status(compactor):
+    if compactor is None:
+        return "off"
+    state = "paused" if compactor.paused else (compactor.current or "idle")
+    saved = (compactor.bytes_in - compactor.bytes_out) / 1e6
+    return f"{state}; {compactor.compacted} runs compacted, {saved:.1f} MB saved"
+
+
+TABLE = Template(b"""
+    <table class="table table-striped table-bordered">
+        <thead class="thead-dark">
+            <tr>
+                <th>Parameter</th>
+                <th>Value</th>
+            </tr>
+        </thead>
+        <tbody>
+            <tr>
+                <td>Loop time (ms)</td>
+                <td>{{avg_time}}</td>
+            </tr>
+            <tr>
+                <td>Waited</td>
+                <td>{{waited}}</td>
+            </tr>
+            <tr>
+                <td>Leader</td>
+                <td>{{is_leader}}</td>
+            </tr>
+            <tr>
+                <td>Iteration Count</td>
+                <td>{{iteration_count}}</td>
+            </tr>
+            <tr>
+                <td>Baseline / RMS (ADC counts)</td>
+                <td>{{baseline}}</td>
+            </tr>
+            <tr>
+                <td>Time sync</td>
+                <td>{{time_sync}}</td>
+            </tr>
+            <tr>
+                <td>Data file (segment rotations)</td>
+                <td>{{data_file}}</td>
+            </tr>
+            {{sd_rows}}
+            {{slow_row}}
+            <tr>
+                <td>Threshold scan (<a href="/scan">results</a>)</td>
+                <td>{{scan}}</td>
+            </tr>
+            <tr>
+                <td>Auto retune (retunes, rejected samples)</td>
+                <td>{{auto_retune}}</td>
+            </tr>
+            <tr>
+                <td>Run compaction</td>
+                <td>{{compaction}}</td>
+            </tr>
+        </tbody>
+    </table>
+""", ttl_ms=2000, slack=128)
+
+
+def table_values(g):
+    tracker = g['tracker']
+    run = g['run']
+    return (g['avg_time'], g['waited'], g['is_leader'], g['iteration_count'],
+            f"{tracker.mean:.1f} / {tracker.rms():.1f}",
+            g['clock'].quality(),
+            f"{run.name if run else '-'} ({run.rotations if run else 0})",
+            sd_rows(g['sd']), slow_row(g['slow']), scan_status(g['scan']),
+            f"{g['AUTO_RETUNE']} ({tracker.retunes}, {tracker.rejected})",
+            compaction_status(g['compactor']))
+
+
+def table_stream(g):
+    """The technical table, re-rendered at most every 2 s"""
+    return TABLE.send(lambda: table_values(g))
+
+
+def stylesheet(request):
+    try:
+        with open('styles.css', 'r') as f:
+            css_content = f.read()
+            return Response(body=css_content, 
+                headers={'Content-Type': 'text/css', 'Cache-Control': 'max-age=604800'})
+    except OSError:
+        return Response('/* Stylesheet not found */', headers={'Content-Type': 'text/css'})
+
+
+def debug_page(request):
+    # Stream HTML to minimize single large allocations
+    def _stream():
+        yield "<!doctype html>\n<html>\n  <head>\n    <meta charset=\"utf-8\">\n    <meta name=\"viewport\" content=\"width=device-width, initial-scale=1\">\n    <title>CuWatch Debug Log</title>\n"
+        yield "    <link rel=\"stylesheet\" href=\"https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css\">\n"
+        yield "    <style>body{background:#f7f9fc}.wrap{max-width:960px;margin:20px auto}pre{background:#111;color:#0f0;padding:12px;border-radius:6px;height:60vh;overflow:auto}.controls{display:flex;gap:8px;align-items:center}</style>\n  </head>\n  <body class=\"bg-light\">\n    <div class=\"wrap\">\n      <div class=\"d-flex justify-content-between align-items-center mb-2\">\n        <h3 class=\"mb-0\">Debug Log</h3>\n        <div class=\"controls\">\n          <button class=\"btn btn-sm btn-secondary\" id=\"clearBtn\">Clear</button>\n          <label class=\"mb-0\"><input type=\"checkbox\" id=\"follow\" checked> Follow</label>\n        </div>\n      </div>\n      <pre id=\"log\">Loading…</pre>\n      <p class=\"text-muted small\">Updates every 10 seconds. Shows last 200 lines.</p>\n      <a href=\"/\" class=\"btn btn-link p-0\">Back to Home</a>\n    </div>\n    <script>\n"
+        yield "(function(){var pre=document.getElementById('log');var follow=document.getElementById('follow');function fetchLog(){fetch('/debug/log').then(function(r){return r.text();}).then(function(t){var atBottom=(pre.scrollTop+pre.clientHeight)>=(pre.scrollHeight-8);pre.textContent=t||'';if(follow&&follow.checked&&atBottom){pre.scrollTop=pre.scrollHeight;}}).catch(function(e){});}setInterval(fetchLog,10000);fetchLog();var c=document.getElementById('clearBtn');if(c){c.onclick=function(){fetch('/debug/clear',{method:'POST'}).then(fetchLog);};}})();\n"
+        yield "    </script>\n  </body>\n</html>\n"
+    return Response(body=_stream(), headers={'Content-Type': 'text/html', 'Cache-Control': 'no-cache'})
+
+
+# Serve a lightweight bootstrap JS that defers loading of app.js
+def boot_js(request):
+    js = """
+    (function(){
+      function displayTime(){
+        var now=new Date();
+        var el=document.getElementById('time');
+        if(el){ el.textContent=now.toLocaleTimeString(); }
+      }
+      setInterval(displayTime,1000);
+
+      // Lightweight initial populate so the page shows data fast
+      function populateOnce(){
+        fetch('/data').then(r=>r.json()).then(function(d){
+          var set=function(id,v){var e=document.getElementById(id); if(e){ e.textContent=v; }};
+          set('rate', d.rate); set('muon_count', d.muon_count); set('baseline', d.baseline);
+          set('threshold', d.threshold);
+          set('reset_threshold', d.reset_threshold); set('runtime', d.runtime);
+          var lu=document.getElementById('last_updated');
+          if(lu){ lu.textContent='Last updated: '+(new Date()).toLocaleTimeString(); }
+        }).catch(function(e){console.log('boot populate err', e);});
+      }
+
+      // Basic button handlers available immediately
+      window.invokeMicrocontrollerMethod=function(){
+        fetch('/request-shutdown',{method:'POST'}).then(r=>r.json()).catch(function(e){console.log(e);});
+      };
+      window.restartRequest=function(){
+        fetch('/request-restart',{method:'POST'}).then(r=>r.json()).catch(function(e){console.log(e);});
+      };
+      window.updateThreshold=function(){
+        var v=document.getElementById('thresholdInput'); if(!v||!v.value){alert('Enter threshold'); return;}
+        var xhr=new XMLHttpRequest(); xhr.open('POST','/submit',true);
+        xhr.setRequestHeader('Content-Type','application/x-www-form-urlencoded');
+        xhr.onreadystatechange=function(){
+          if(xhr.readyState===4){
+            if(xhr.status===200){
+              // Success, reload page
+              window.location.reload();
+            }else{
+              // Show actual error message from server
+              var msg = xhr.responseText || 'Failed to update threshold';
+              alert(msg);
+            }
+          }
+        };
+        xhr.send('threshold='+encodeURIComponent(v.value));
+      };
+
+      // Defer loading of heavier logic
+      function loadAppJs(){
+        var s=document.createElement('script'); s.src='/app.js?v=1'; s.defer=true; document.head.appendChild(s);
+      }
+
+      window.addEventListener('load', function(){ populateOnce(); loadAppJs(); });
+    })();
+    """
+    return Response(body=js, headers={'Content-Type':'application/javascript','Cache-Control':'max-age=604800'})
+
+
+# Serve the main JS as a static resource (charts, periodic updates, lazy loads Chart.js)
+def app_js(request):
+    js = """
+    (function(){
+      function loadScript(src){
+        return new Promise(function(resolve, reject){
+          var s=document.createElement('script'); s.src=src; s.onload=resolve; s.onerror=reject; document.head.appendChild(s);
+        });
+      }
+
+      var rateChart;
+      function initChart(){
+        var canvas=document.getElementById('rateChart');
+        if(!canvas){ return; }
+        var ctx=canvas.getContext('2d');
+        rateChart=new Chart(ctx,{
+          type:'line',
+          data:{labels:[],datasets:[{label:'Rate vs Time',data:[],borderWidth:2,fill:false}]},
+          options:{responsive:true,maintainAspectRatio:true,scales:{x:{type:'time',time:{unit:'second'}},y:{beginAtZero:true}}}
+        });
+      }
+
+      function saveGraphData(){
+        try{
+          localStorage.setItem('rateLabels',JSON.stringify(rateChart.data.labels));
+          localStorage.setItem('rateData',JSON.stringify(rateChart.data.datasets[0].data));
+        }catch(e){}
+      }
+      function loadGraphData(){
+        try{
+          var a=JSON.parse(localStorage.getItem('rateLabels')||'null');
+          var b=JSON.parse(localStorage.getItem('rateData')||'null');
+          if(a&&b&&rateChart){ rateChart.data.labels=a; rateChart.data.datasets[0].data=b; rateChart.update(); }
+        }catch(e){}
+      }
+
+      function fetchHistoricalData(){
+        fetch('/refresh_data').then(r=>r.json()).then(function(data){
+          var now=new Date();
+          rateChart.data.labels=[]; rateChart.data.datasets[0].data=[];
+          for(var i=0;i<data.length;i++){
+            var ts=new Date(now.getTime()-i*30000);
+            rateChart.data.labels.unshift(ts);
+            rateChart.data.datasets[0].data.unshift(data[i]);
+          }
+          rateChart.update(); saveGraphData();
+        }).catch(function(e){console.log('hist err',e);});
+      }
+
+      function fetchData(){
+        fetch('/data').then(r=>r.json()).then(function(d){
+          var now=new Date();
+          var set=function(id,v){var e=document.getElementById(id); if(e){ e.textContent=v; }};
+          set('rate', d.rate); set('muon_count', d.muon_count); set('threshold', d.threshold);
+          set('reset_threshold', d.reset_threshold); set('runtime', d.runtime);
+          var lu=document.getElementById('last_updated');
+          if(lu){ lu.textContent='Last updated: '+now.toLocaleTimeString(); }
+          if(rateChart){
+            rateChart.data.labels.push(now);
+            rateChart.data.datasets[0].data.push(d.rate);
+            var limit=new Date(now.getTime()-3600*1000);
+            while(rateChart.data.labels.length>0 && rateChart.data.labels[0]<limit){
+              rateChart.data.labels.shift(); rateChart.data.datasets[0].data.shift();
+            }
+            rateChart.update(); saveGraphData();
+          }
+        }).catch(function(e){console.log('data err',e);});
+      }
+
+      // Initialize after loading Chart.js and the date adapter
+      function start(){
+        initChart();
+        loadGraphData();
+        fetchHistoricalData();
+        fetchData();
+        setInterval(fetchData,30000);
+      }
+
+      // Lazy-load heavy libs, then start
+      Promise.resolve()
+        .then(function(){ return loadScript('https://cdn.jsdelivr.net/npm/chart.js'); })
+        .then(function(){ return loadScript('https://cdn.jsdelivr.net/npm/chartjs-adapter-date-fns'); })
+        .then(start)
+        .catch(function(e){ console.log('chart libs failed', e); });
+    })();
+    """
+    return Response(body=js, headers={'Content-Type':'application/javascript','Cache-Control':'max-age=604800'})
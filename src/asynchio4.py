@@ -1,7 +1,7 @@
 # pylint: disable=missing-function-docstring,missing-class-docstring,missing-module-docstring
 # pylint: disable=too-many-locals,too-many-statements,too-many-arguments, invalid-name, global-statement
 # pylint: disable=consider-using-f-string, line-too-long, unused-argument
-from machine import ADC, Pin, RTC
+from machine import ADC, Pin
 import asyncio
 import machine
 import sdcard
@@ -10,9 +10,8 @@ import time
 import io
 import uos as os
 import gc
-import urequests
+import array
 import ujson as json
-import ntptime
 
 import micropython
 from micropython import const
@@ -20,8 +19,17 @@ from microdot import Microdot, Response
 import network
 
 import RingBuffer
-import urandom
-
+import BaselineTracker
+import TimeSync
+import RunFile
+import SdStats
+import TriggerKernel
+import SlowControl
+import Compactor
+# DaqCore, PulseCapture and ThresholdScan are imported when their feature is first used
+
+gc.collect()
+print(f"[boot] imports done {time.ticks_ms()} ms after reset, {gc.mem_free()} bytes free")
 
 shutdown_request = False
 app = Microdot()
@@ -54,27 +62,6 @@ if _bi is not None and hasattr(_bi, 'print'):
                 pass
     _bi.print = _tee_print
 
-@micropython.native
-def calibrate_average_rms(n: int) -> tuple:
-    """calibrate the threshold value by taking the average of n samples. Assumes no muons are present"""
-    led2 = Pin(15, Pin.OUT) # local LED on pepper carrier board
-    adc = ADC(0)  # Pin 26 is GP26, which is ADC0
-    sumval = 0
-    sum_squared = 0
-    print("Calibrating with", n, "samples...")
-    for _ in range(n):
-        value = adc.read_u16()
-        sumval += value
-        sum_squared += value ** 2
-        led2.toggle()
-        time.sleep_ms(10) # wait 
-    mean = sumval / n
-    variance = (sum_squared / n) - (mean ** 2)
-    standard_deviation = variance ** 0.5
-    led2.value(0)
-    return mean, standard_deviation
-
-
 def init_sdcard():
     """ Initialize the SD card interface on the base board"""
     # Define SPI pins -- see schematic for Pepper V2 board
@@ -98,91 +85,6 @@ def unmount_sdcard():
     os.umount(SD_DIRECTORY)
     print("SD card unmounted.")
 
-def init_RTC():
-    """set RTC to UTC. Uses NTP and falls back to worldtimeapi.org if NTP fails"""
-    import random
-    server = random.choice(['0.pool.ntp.org', '1.pool.ntp.org', '2.pool.ntp.org', '3.pool.ntp.org'])
-    ntptime.host = server
-    ntptime.timeout = 2
-    print(f"NTP host is {ntptime.host}")
-    wait_time = 2
-    success = False
-    rtc = RTC()
-    led2 = Pin(15, Pin.OUT) # local LED on pepper carrier board
-    for _ in range(5):
-        print("waiting for NTP time")
-        try:
-            led2.toggle()
-            ntptime.settime()
-            # if we get here, assume it succeeded (above throws exception on fail)
-            print("NTP success: ", rtc.datetime())
-            success = True
-            break
-        except OSError as e:
-            print(f"NTP time setting failed. Check network connection. {e}")
-        except Exception as e:
-            print(f"unexpected error: {e}")
-        time.sleep(wait_time)
-        wait_time = wait_time * 2
-    if not success:
-        # fall back to urequests method
-        print("NTP failed, trying worldtimeapi.org")
-        try:
-            response = urequests.get('http://worldtimeapi.org/api/ip')
-            data = response.json()
-            datetime_str = data['utc_datetime']
-            print("datetime_str: ", datetime_str)
-            year, month, day, hour, minute, second = map(int, datetime_str.split('T')[0].split('-') + datetime_str.split('T')[1].split(':'))
-            rtc.datetime((year, month, day, 0, hour, minute, second, 0))
-            success = True
-            print("RTC set to: ", rtc.datetime())
-        except Exception as e:
-            print(f"Failed to set RTC time: {e}")
-    
-    if not success:
-        print("Failed to set RTC time")
-        random_hour = urandom.getrandbits(5) % 24  # Generate a random hour (0-23)
-        random_minute = urandom.getrandbits(6) % 60  # Generate a random minute (0-59)
-        # Set RTC to a random time on 1/1/2020
-        rtc.datetime((2020, 1, 1, 0, random_hour, random_minute, 0, 0))
-    return get_iso8601_timestamp()
-
-
-def get_iso8601_timestamp(timezone_offset="+00:00"):
-    """return RTC time as an ISO8601 string, default to UTC TZ"""
-    rtc = RTC()
-    dt = rtc.datetime()
-
-    # NOTE: no microsecond support in RTC, so we use 000000
-    timestamp = "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:06d}{}".format(
-        dt[0], dt[1], dt[2], dt[4], dt[5], dt[6], 0, timezone_offset
-    )
-
-    return timestamp
-
-def init_file(baseline, rms, threshold, reset_threshold, now, is_leader) -> io.TextIOWrapper:
-    """ open file for writing, with date and time in the filename. write metadata. return filehandle """
-    now2 = time.localtime()
-    year = now2[0]
-    month = now2[1]
-    day = now2[2]
-    hour = now2[3]
-    minute = now2[4]
-    suffix = f"{year}{month:02d}{day:02d}_{hour:02d}{minute:02d}"
-    # data file
-    filename = f"/sd/muon_data_{suffix}.csv"
-    f = open(filename, "w", buffering=10240, encoding='utf-8')
-    f.write("baseline,stddev,threshold,reset_threshold,run_start_time,is_leader\n")
-    if is_leader:
-        leader = 1
-    else:
-        leader = 0
-    f.write(f"{baseline:.1f}, {rms:.1f}, {threshold}, {reset_threshold}, {now}, {leader}\n")
-    f.write("Muon Count,ADC,temperature_ADC,dt,t,t_wait,coinc\n")
-    return f
-
-
-
 # Set default content type
 Response.default_content_type = 'text/html'
 
@@ -190,77 +92,22 @@ Response.default_content_type = 'text/html'
 SD_DIRECTORY = '/sd'
 
 
-# Streamed HTML generator for the home page (keeps memory usage low)
-def _index_stream(myrate, muon_count, baseline, threshold, reset_threshold, runtime):
-    yield """
-    <!doctype html>
-    <html>
-      <head>
-        <meta charset="utf-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <title>CuWatch</title>
-        <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css">
-        <link rel="stylesheet" href="/styles.css">
-      </head>
-      <body class="bg-light">
-        <div class="d-flex">
-          <div class="sidebar">
-            <h2 class="text-center">CuWatch</h2>
-            <ul class="nav flex-column">
-              <li class="nav-item"><a class="nav-link active" href="/">Home</a></li>
-              <li class="nav-item"><a class="nav-link" href="/download">Download Data</a></li>
-              <li class="nav-item"><a class="nav-link" href="/technical">Technical</a></li>
-              <li class="nav-item"><button class="btn btn-secondary" onclick="invokeMicrocontrollerMethod()">Stop Run</button></li>
-              <li class="nav-item"><button class="btn btn-secondary" onclick="restartRequest()">Restart Run</button></li>
-              <li class="nav-item">
-                <input type="number" id="thresholdInput" class="form-control" placeholder="Enter new threshold">
-                <button class="btn btn-primary mt-2" onclick="updateThreshold()">Update Threshold</button>
-              </li>
-            <li class="nav-item">
-                <small class="form-text text-muted mt-1">
-                    Threshold should be an integer greater than the reset threshold.
-                </small>
-            </li>
-            </ul>
-            <p id="time" class="text-center mt-4"></p>
-          </div>
-          <div class="content">
-            <h1 class="my-4 text-center">CuWatch Status and Configuration</h1>
-            <table class="table table-striped table-bordered">
-              <thead class="thead-dark">
-                <tr><th>Variable</th><th>Value</th></tr>
-              </thead>
-              <tbody>
-                <tr><td>Rate (Hz)</td><td id="rate">"""
-    yield str(myrate)
-    yield """</td></tr>
-                <tr><td>Muon Count</td><td id="muon_count">"""
-    yield str(muon_count)
-    yield """</td></tr>
-                <tr><td>Baseline (ADC counts)</td><td id="baseline">"""
-    yield str(baseline)
-    yield """</td></tr>
-                <tr><td>Threshold (ADC counts)</td><td id="threshold">"""
-    yield str(threshold)
-    yield """</td></tr>
-                <tr><td>Reset threshold (ADC counts)</td><td id="reset_threshold">"""
-    yield str(reset_threshold)
-    yield """</td></tr>
-                <tr><td>Runtime (s)</td><td id="runtime">"""
-    yield str(runtime)
-    yield """</td></tr>
-              </tbody>
-            </table>
-            <p id="last_updated" class="text-muted small text-right mb-0">Last updated: —</p>
-            <h3 class="my-4 text-center">Rate vs Time</h3>
-            <canvas id="rateChart"></canvas>
-          </div>
-        </div>
-        <footer class="text-center mt-5"><p class="text-muted">Powered by MicroPython and Microdot</p></footer>
-        <script src="/boot.js?v=1"></script>
-      </body>
-    </html>
-    """
+# Pages with large HTML/JS bodies live in WebPages.py and are imported on the
+# first request, so they cost no heap at boot or while nobody uses the web pages
+_pages = None
+
+def pages():
+    global _pages
+    if _pages is None:
+        gc.collect()
+        free = gc.mem_free()
+        t0 = time.ticks_ms()
+        import WebPages
+        _pages = WebPages
+        gc.collect()
+        print(f"[web] WebPages loaded in {time.ticks_diff(time.ticks_ms(), t0)} ms, "
+              f"{free - gc.mem_free()} bytes of heap")
+    return _pages
 
 @app.route('/', methods=['GET'])
 def index(request):
@@ -269,7 +116,7 @@ def index(request):
     if myrate is None:
         myrate = 0.
     runtime = time.time() - start_time_sec
-    return Response(body=_index_stream(myrate, muon_count, baseline, threshold, reset_threshold, runtime),
+    return Response(body=pages().index_stream(myrate, muon_count, baseline, threshold, reset_threshold, runtime),
                     headers={'Content-Type': 'text/html', 'Cache-Control': 'no-cache'})
 
 @app.before_request
@@ -294,7 +141,8 @@ def data(request):
         'threshold': threshold,
         'reset_threshold': reset_threshold,
         'runtime': runtime,
-        'baseline': baseline
+        'baseline': baseline,
+        'rms': rms
     }), headers={'Content-Type': 'application/json'})
 
 # Lightweight health endpoint: if this responds, the server is active
@@ -323,6 +171,56 @@ def submit(request):
     except ValueError:
         return 'Invalid input. Please enter a valid integer.', 400
 
+# Threshold scan: POST start, stop, step and dwell_s (form or JSON) to start one,
+# or cancel=1 to stop it; GET returns the progress and the results so far
+@app.route('/scan', methods=['GET', 'POST'])
+def threshold_scan(request):
+    if request.method == 'POST':
+        params = request.json or request.form or {}
+        if params.get('cancel'):
+            if scan is not None:
+                scan.cancel()
+        else:
+            try:
+                start_scan(params)
+            except ValueError as e:
+                return {'error': str(e)}, 400
+    return scan.as_dict() if scan is not None else {'state': 'none'}
+
+
+def _set_threshold(value):
+    global threshold
+    threshold = value
+
+def _scan_counts():
+    return muon_count, coincidences, live_ms
+
+async def run_scan(s):
+    """Run a threshold scan with retuning off, then restore the threshold and AUTO_RETUNE"""
+    global threshold, AUTO_RETUNE
+    saved = threshold, AUTO_RETUNE
+    AUTO_RETUNE = False
+    try:
+        await s.run(_set_threshold, _scan_counts, lambda: reset_threshold)
+    finally:
+        threshold, AUTO_RETUNE = saved
+        print(f"threshold back to {threshold}")
+
+def start_scan(params):
+    """Start a threshold scan from a dict with start, stop, step and dwell_s; raises ValueError"""
+    global scan
+    if scan is not None and scan.state in ("pending", "running"):
+        raise ValueError("a threshold scan is already running")
+    import ThresholdScan
+    try:
+        s = ThresholdScan.ThresholdScan(params["start"], params["stop"], params.get("step", 50),
+                                        params.get("dwell_s", 60), SD_DIRECTORY, clock, tracker.mean)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"bad scan parameters: {e}")
+    scan = s
+    asyncio.create_task(run_scan(s))
+    return s
+
 # Route to handle shutdown request
 @app.route('/request-shutdown', methods=['POST'])
 async def request_shutdown(request):
@@ -378,67 +276,12 @@ def join_path(directory, filename):
 # Route to list and allow downloads of CSV files from the /sd directory
 @app.route('/download', methods=['GET'])
 def download_page(request):
-    files = []
-    FILE_LIMIT = const(30)
-    filecount = 0
-
-    # Get list of .csv files in the /sd directory
-    try:
-        if os.stat(SD_DIRECTORY):  # Check if directory exists
-            ring = []
-            # Prefer iterator on MicroPython to avoid a large list
-            if hasattr(os, 'ilistdir'):
-                for entry in os.ilistdir(SD_DIRECTORY):
-                    try:
-                        name = entry[0] if isinstance(entry, tuple) else entry
-                    except Exception:
-                        name = entry
-                    if isinstance(name, bytes):
-                        try:
-                            name = name.decode()
-                        except Exception:
-                            name = str(name)
-                    if isinstance(name, str) and name.endswith('.csv'):
-                        filecount += 1
-                        ring.append(name)
-                        if len(ring) > FILE_LIMIT:
-                            del ring[0]
-            else:
-                try:
-                    names = os.listdir(SD_DIRECTORY)
-                except Exception:
-                    names = []
-                for name in names:
-                    if name.endswith('.csv'):
-                        filecount += 1
-                        ring.append(name)
-                        if len(ring) > FILE_LIMIT:
-                            del ring[0]
-            files = ring
-        # Sort files by modification time (most recent first). This does not work
-        # as it requires too much memory when the list of files gets long
-        #files = sorted(files, key=lambda x: get_file_mtime(join_path(SD_DIRECTORY, x)), reverse=True)
-    except OSError:
-        files = []  # Handle case where SD card is not mounted or directory doesn't exist
-    # 
-    gc.collect()
-
-    # Stream HTML to reduce memory usage
-    def _stream():
-        yield "<!doctype html>\n<html>\n  <head>\n    <title>Download CSV Files</title>\n"
-        yield "    <link rel=\"stylesheet\" href=\"https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css\">\n"
-        yield "    <link rel=\"stylesheet\" href=\"/styles.css\">\n  </head>\n  <body class=\"bg-light\">\n    <div class=\"container\">\n      <h1 class=\"my-4 text-center\">Download CSV Files</h1>\n      <div class=\"btn-group\" role=\"group\" aria-label=\"Navigation Link\">\n        <button type=\"button\" class=\"btn btn-primary\" onclick=\"window.location.href='/'\">Return home</button>\n      </div>\n"
-        yield "      <h3 class=\"my-4 text-center\">Total number of files (showing %d): %d</h3>\n" % (FILE_LIMIT, filecount)
-        yield "      <ul class=\"list-group\">\n"
-        for fname in files[::-1]:
-            yield "        <li class=\"list-group-item\"><a href=\"/download_file?file=%s\">%s</a></li>\n" % (fname, fname)
-        yield "      </ul>\n      <a href=\"/\">Back to Home</a>\n    </div>\n  </body>\n</html>\n"
-    return Response(body=_stream(), headers={'Content-Type': 'text/html'})
+    return pages().download_page(request, SD_DIRECTORY)
 
 # Helper function to stream file content in chunks
 def file_stream_generator(file_path, chunk_size=512):
     try:
-        with open(file_path, 'r') as f:
+        with open(file_path, 'rb') as f:
             while True:
                 data = f.read(chunk_size)
                 if not data:
@@ -446,18 +289,29 @@ def file_stream_generator(file_path, chunk_size=512):
                 yield data
     except OSError:
         yield ''  # If file cannot be read, return empty content
-# Route to serve a specific CSV file for download via streaming
+
+def compacted_name(file_name):
+    """file_name, or its .csv.gz if the run was compacted"""
+    if file_name.endswith('.csv'):
+        try:
+            os.stat(join_path(SD_DIRECTORY, file_name))
+        except OSError:
+            return file_name + '.gz'
+    return file_name
+
+# Route to serve a specific CSV file for download via streaming; a compacted
+# run is sent as its .csv.gz, as it is on the card
 @app.route('/download_file', methods=['GET'])
 def download_file(request):
-    file_name = request.args.get('file')
+    file_name = compacted_name(request.args.get('file'))
     file_path = join_path(SD_DIRECTORY, file_name)
     try:
         st = os.stat(file_path)
-        if st and file_name.endswith('.csv'): # Check if the file has non-zero length
+        if st and (file_name.endswith('.csv') or file_name.endswith('.csv.gz')): # Check if the file has non-zero length
             if st[6] > 0:  # `st_size` is the 7th element in the tuple (index 6)
                 # Stream the file content using the generator function
-                return Response(body=file_stream_generator(file_path), headers={
-                    'Content-Type': 'text/csv',
+                return Response(body=Compactor.Reading([file_path], file_stream_generator(file_path)), headers={
+                    'Content-Type': 'application/gzip' if file_name.endswith('.gz') else 'text/csv',
                     'Content-Disposition': f'attachment; filename="{file_name}"'
                 })
             else:
@@ -465,89 +319,82 @@ def download_file(request):
     except OSError:
         return Response('File not found', 404)
 
+# Route to stream several runs as one tar or zip archive, e.g.
+# /archive?from=muon_data_20241101&to=muon_data_20241107&format=tar&compress=1
+# or /archive?files=a.csv,b.csv; all runs without arguments
+@app.route('/archive', methods=['GET'])
+def archive(request):
+    import RunArchive   # only loaded when an archive is requested
+    args = request.args
+    fmt = args.get('format', 'tar')
+    if fmt not in ('tar', 'zip'):
+        return Response('format must be tar or zip', 400)
+    compress = args.get('compress', '0') in ('1', 'true', 'yes')
+    if compress and not Compactor.can_compress():
+        return Response('compress=1 needs deflate compression, which this firmware lacks', 400)
+    files = args.get('files')
+    try:
+        names = RunArchive.select(SD_DIRECTORY, files.split(',') if files else None,
+                                  args.get('from'), args.get('to'), args.get('sidecars', '1') != '0')
+    except OSError:
+        names = []
+    if not names:
+        return Response('No matching run files', 404)
+    print(f"archive of {len(names)} files ({fmt}{', compressed' if compress else ''})")
+    body = RunArchive.stream(SD_DIRECTORY, names, fmt, compress)
+    return Response(body=Compactor.Reading([join_path(SD_DIRECTORY, name) for name in names], body), headers={
+        'Content-Type': 'application/zip' if fmt == 'zip' else ('application/gzip' if compress else 'application/x-tar'),
+        'Content-Disposition': f'attachment; filename="{RunArchive.filename(fmt, compress)}"'
+    })
+
+# Route to stream the events of a run file that pass the given cuts, e.g.
+# /export?file=muon_data_20241101_1806.csv&coinc=1&event_min=1000&wait_min=20
+EXPORT_CUTS = ('event_min', 'event_max', 't_min', 't_max', 'coinc', 'wait_min', 'wait_max', 'adc_min', 'adc_max')
+
+@app.route('/export', methods=['GET'])
+def export(request):
+    import RunExport    # only loaded when an export is requested
+    file_name = request.args.get('file')
+    if not file_name or '/' in file_name or not (file_name.endswith('.csv') or file_name.endswith('.csv.gz')):
+        return Response('file=<run file>.csv is required', 400)
+    file_name = compacted_name(file_name)
+    file_path = join_path(SD_DIRECTORY, file_name)
+    try:
+        os.stat(file_path)
+    except OSError:
+        return Response('File not found', 404)
+    cuts = {}
+    for key in EXPORT_CUTS:
+        value = request.args.get(key)
+        if value is not None:
+            try:
+                cuts[key] = int(value)
+            except ValueError:
+                return Response(f'{key} must be an integer', 400)
+    body = RunExport.stream(file_path, RunExport.Cuts(**cuts))
+    return Response(body=Compactor.Reading([file_path], body), headers={
+        'Content-Type': 'text/csv',
+        'Content-Disposition': f'attachment; filename="{file_name[:file_name.index(".csv")]}_export.csv"'
+    })
+
 @app.route('/technical')
 def technical_page(request):
-    # Streamed version to avoid MemoryError on large f-strings
-    def _stream():
-        yield "<!doctype html>\n<html>\n  <head>\n    <title>CuWatch Technical Information</title>\n"
-        yield "    <link rel=\"stylesheet\" href=\"https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css\">\n"
-        yield "    <link rel=\"stylesheet\" href=\"/styles.css\">\n"
-        yield "    <script>\n"
-        yield "      function displayTime(){var now=new Date();var e=document.getElementById('time'); if(e){e.textContent=now.toLocaleTimeString();}}\n"
-        yield "      setInterval(displayTime,1000);\n"
-        yield "      function makeLeader(){fetch('/make-leader',{method:'POST'}).then(r=>r.json()).then(_=>reloadTable()).catch(()=>{});}\n"
-        yield "      function makeFollower(){fetch('/make-follower',{method:'POST'}).then(r=>r.json()).then(_=>reloadTable()).catch(()=>{});}\n"
-        yield "      function reloadTable(){fetch('/technical/table').then(r=>r.text()).then(function(h){var t=document.getElementById('table-container'); if(t){t.innerHTML=h;}}).catch(()=>{});}\n"
-        yield "    </script>\n  </head>\n  <body class=\"bg-light\">\n    <div class=\"d-flex\">\n      <div class=\"sidebar bg-light p-3\">\n        <h2 class=\"text-center\">CuWatch</h2>\n        <ul class=\"nav flex-column\">\n"
-        yield "          <li class=\"nav-item\"><a class=\"nav-link active\" href=\"/\">Home</a></li>\n"
-        yield "          <li class=\"nav-item\"><a class=\"nav-link\" href=\"/download\">Download Data</a></li>\n"
-        yield "          <li class=\"nav-item\"><button class=\"btn btn-secondary my-2\" onclick=\"makeLeader()\">Make Leader</button></li>\n"
-        yield "          <li class=\"nav-item\"><button class=\"btn btn-secondary my-2\" onclick=\"makeFollower()\">Make Follower</button></li>\n"
-        yield "        </ul>\n        <div class=\"static-text bg-secondary text-white p-3 rounded mt-3\">\n          <p>Leader and follower changes take effect on next new run.</p>\n        </div>\n        <p id=\"time\" class=\"text-center mt-4\"></p>\n      </div>\n      <div class=\"content flex-grow-1 p-3\">\n        <h1 class=\"my-4 text-center\">CuWatch Technical Information</h1>\n        <div id=\"table-container\">\n"
-        try:
-            yield generate_table()
-        except Exception:
-            yield "<p>Error loading table.</p>"
-        yield "        </div>\n      </div>\n    </div>\n  </body>\n</html>\n"
-    return Response(body=_stream(), headers={'Content-Type': 'text/html'})
-
-def generate_table():
-    return f"""
-    <table class="table table-striped table-bordered">
-        <thead class="thead-dark">
-            <tr>
-                <th>Parameter</th>
-                <th>Value</th>
-            </tr>
-        </thead>
-        <tbody>
-            <tr>
-                <td>Loop time (ms)</td>
-                <td>{avg_time}</td>
-            </tr>
-            <tr>
-                <td>Waited</td>
-                <td>{waited}</td>
-            </tr>
-            <tr>
-                <td>Leader</td>
-                <td>{is_leader}</td>
-            </tr>
-            <tr>
-                <td>Iteration Count</td>
-                <td>{iteration_count}</td>
-            </tr>
-        </tbody>
-    </table>
-    """
+    return pages().technical_page(request, globals())
 
 @app.route('/technical/table')
 def technical_table(request):
-    return Response(generate_table(), headers={'Content-Type': 'text/html'})
+    return Response(body=pages().table_stream(globals()), headers={'Content-Type': 'text/html'})
 
 
 @app.route('/styles.css')
 def stylesheet(request):
-    try:
-        with open('styles.css', 'r') as f:
-            css_content = f.read()
-            return Response(body=css_content, 
-                headers={'Content-Type': 'text/css', 'Cache-Control': 'max-age=604800'})
-    except OSError:
-        return Response('/* Stylesheet not found */', headers={'Content-Type': 'text/css'})
+    return pages().stylesheet(request)
 
 
 # --- Debug log viewer routes ---
 @app.route('/debug')
 def debug_page(request):
-    # Stream HTML to minimize single large allocations
-    def _stream():
-        yield "<!doctype html>\n<html>\n  <head>\n    <meta charset=\"utf-8\">\n    <meta name=\"viewport\" content=\"width=device-width, initial-scale=1\">\n    <title>CuWatch Debug Log</title>\n"
-        yield "    <link rel=\"stylesheet\" href=\"https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css\">\n"
-        yield "    <style>body{background:#f7f9fc}.wrap{max-width:960px;margin:20px auto}pre{background:#111;color:#0f0;padding:12px;border-radius:6px;height:60vh;overflow:auto}.controls{display:flex;gap:8px;align-items:center}</style>\n  </head>\n  <body class=\"bg-light\">\n    <div class=\"wrap\">\n      <div class=\"d-flex justify-content-between align-items-center mb-2\">\n        <h3 class=\"mb-0\">Debug Log</h3>\n        <div class=\"controls\">\n          <button class=\"btn btn-sm btn-secondary\" id=\"clearBtn\">Clear</button>\n          <label class=\"mb-0\"><input type=\"checkbox\" id=\"follow\" checked> Follow</label>\n        </div>\n      </div>\n      <pre id=\"log\">Loading…</pre>\n      <p class=\"text-muted small\">Updates every 10 seconds. Shows last 200 lines.</p>\n      <a href=\"/\" class=\"btn btn-link p-0\">Back to Home</a>\n    </div>\n    <script>\n"
-        yield "(function(){var pre=document.getElementById('log');var follow=document.getElementById('follow');function fetchLog(){fetch('/debug/log').then(function(r){return r.text();}).then(function(t){var atBottom=(pre.scrollTop+pre.clientHeight)>=(pre.scrollHeight-8);pre.textContent=t||'';if(follow&&follow.checked&&atBottom){pre.scrollTop=pre.scrollHeight;}}).catch(function(e){});}setInterval(fetchLog,10000);fetchLog();var c=document.getElementById('clearBtn');if(c){c.onclick=function(){fetch('/debug/clear',{method:'POST'}).then(fetchLog);};}})();\n"
-        yield "    </script>\n  </body>\n</html>\n"
-    return Response(body=_stream(), headers={'Content-Type': 'text/html', 'Cache-Control': 'no-cache'})
+    return pages().debug_page(request)
 
 
 @app.route('/debug/log')
@@ -580,155 +427,14 @@ def debug_clear(request):
     return Response(body='ok', headers={'Content-Type': 'text/plain', 'Cache-Control': 'no-cache'})
 
 
-# Serve a lightweight bootstrap JS that defers loading of app.js
 @app.route('/boot.js')
 def boot_js(request):
-    js = """
-    (function(){
-      function displayTime(){
-        var now=new Date();
-        var el=document.getElementById('time');
-        if(el){ el.textContent=now.toLocaleTimeString(); }
-      }
-      setInterval(displayTime,1000);
-
-      // Lightweight initial populate so the page shows data fast
-      function populateOnce(){
-        fetch('/data').then(r=>r.json()).then(function(d){
-          var set=function(id,v){var e=document.getElementById(id); if(e){ e.textContent=v; }};
-          set('rate', d.rate); set('muon_count', d.muon_count); set('baseline', d.baseline);
-          set('threshold', d.threshold);
-          set('reset_threshold', d.reset_threshold); set('runtime', d.runtime);
-          var lu=document.getElementById('last_updated');
-          if(lu){ lu.textContent='Last updated: '+(new Date()).toLocaleTimeString(); }
-        }).catch(function(e){console.log('boot populate err', e);});
-      }
-
-      // Basic button handlers available immediately
-      window.invokeMicrocontrollerMethod=function(){
-        fetch('/request-shutdown',{method:'POST'}).then(r=>r.json()).catch(function(e){console.log(e);});
-      };
-      window.restartRequest=function(){
-        fetch('/request-restart',{method:'POST'}).then(r=>r.json()).catch(function(e){console.log(e);});
-      };
-      window.updateThreshold=function(){
-        var v=document.getElementById('thresholdInput'); if(!v||!v.value){alert('Enter threshold'); return;}
-        var xhr=new XMLHttpRequest(); xhr.open('POST','/submit',true);
-        xhr.setRequestHeader('Content-Type','application/x-www-form-urlencoded');
-        xhr.onreadystatechange=function(){
-          if(xhr.readyState===4){
-            if(xhr.status===200){
-              // Success, reload page
-              window.location.reload();
-            }else{
-              // Show actual error message from server
-              var msg = xhr.responseText || 'Failed to update threshold';
-              alert(msg);
-            }
-          }
-        };
-        xhr.send('threshold='+encodeURIComponent(v.value));
-      };
-
-      // Defer loading of heavier logic
-      function loadAppJs(){
-        var s=document.createElement('script'); s.src='/app.js?v=1'; s.defer=true; document.head.appendChild(s);
-      }
-
-      window.addEventListener('load', function(){ populateOnce(); loadAppJs(); });
-    })();
-    """
-    return Response(body=js, headers={'Content-Type':'application/javascript','Cache-Control':'max-age=604800'})
-
-
-# Serve the main JS as a static resource (charts, periodic updates, lazy loads Chart.js)
+    return pages().boot_js(request)
+
+
 @app.route('/app.js')
 def app_js(request):
-    js = """
-    (function(){
-      function loadScript(src){
-        return new Promise(function(resolve, reject){
-          var s=document.createElement('script'); s.src=src; s.onload=resolve; s.onerror=reject; document.head.appendChild(s);
-        });
-      }
-
-      var rateChart;
-      function initChart(){
-        var canvas=document.getElementById('rateChart');
-        if(!canvas){ return; }
-        var ctx=canvas.getContext('2d');
-        rateChart=new Chart(ctx,{
-          type:'line',
-          data:{labels:[],datasets:[{label:'Rate vs Time',data:[],borderWidth:2,fill:false}]},
-          options:{responsive:true,maintainAspectRatio:true,scales:{x:{type:'time',time:{unit:'second'}},y:{beginAtZero:true}}}
-        });
-      }
-
-      function saveGraphData(){
-        try{
-          localStorage.setItem('rateLabels',JSON.stringify(rateChart.data.labels));
-          localStorage.setItem('rateData',JSON.stringify(rateChart.data.datasets[0].data));
-        }catch(e){}
-      }
-      function loadGraphData(){
-        try{
-          var a=JSON.parse(localStorage.getItem('rateLabels')||'null');
-          var b=JSON.parse(localStorage.getItem('rateData')||'null');
-          if(a&&b&&rateChart){ rateChart.data.labels=a; rateChart.data.datasets[0].data=b; rateChart.update(); }
-        }catch(e){}
-      }
-
-      function fetchHistoricalData(){
-        fetch('/refresh_data').then(r=>r.json()).then(function(data){
-          var now=new Date();
-          rateChart.data.labels=[]; rateChart.data.datasets[0].data=[];
-          for(var i=0;i<data.length;i++){
-            var ts=new Date(now.getTime()-i*30000);
-            rateChart.data.labels.unshift(ts);
-            rateChart.data.datasets[0].data.unshift(data[i]);
-          }
-          rateChart.update(); saveGraphData();
-        }).catch(function(e){console.log('hist err',e);});
-      }
-
-      function fetchData(){
-        fetch('/data').then(r=>r.json()).then(function(d){
-          var now=new Date();
-          var set=function(id,v){var e=document.getElementById(id); if(e){ e.textContent=v; }};
-          set('rate', d.rate); set('muon_count', d.muon_count); set('threshold', d.threshold);
-          set('reset_threshold', d.reset_threshold); set('runtime', d.runtime);
-          var lu=document.getElementById('last_updated');
-          if(lu){ lu.textContent='Last updated: '+now.toLocaleTimeString(); }
-          if(rateChart){
-            rateChart.data.labels.push(now);
-            rateChart.data.datasets[0].data.push(d.rate);
-            var limit=new Date(now.getTime()-3600*1000);
-            while(rateChart.data.labels.length>0 && rateChart.data.labels[0]<limit){
-              rateChart.data.labels.shift(); rateChart.data.datasets[0].data.shift();
-            }
-            rateChart.update(); saveGraphData();
-          }
-        }).catch(function(e){console.log('data err',e);});
-      }
-
-      // Initialize after loading Chart.js and the date adapter
-      function start(){
-        initChart();
-        loadGraphData();
-        fetchHistoricalData();
-        fetchData();
-        setInterval(fetchData,30000);
-      }
-
-      // Lazy-load heavy libs, then start
-      Promise.resolve()
-        .then(function(){ return loadScript('https://cdn.jsdelivr.net/npm/chart.js'); })
-        .then(function(){ return loadScript('https://cdn.jsdelivr.net/npm/chartjs-adapter-date-fns'); })
-        .then(start)
-        .catch(function(e){ console.log('chart libs failed', e); });
-    })();
-    """
-    return Response(body=js, headers={'Content-Type':'application/javascript','Cache-Control':'max-age=604800'})
+    return pages().app_js(request)
 
 def usr_switch_pressed(pin):
     """interrupt handler for the user switch"""
@@ -761,6 +467,8 @@ def check_leader_status():
 shutdown_request = False
 restart_request = False
 muon_count = 0
+coincidences = 0  # events with the coincidence flag set
+live_ms = 0  # ms spent polling the ADC (mod 2**30): the livetime, for the threshold scan
 iteration_count = 0
 rate = 0.
 waited = 0
@@ -772,7 +480,46 @@ rates = RingBuffer.RingBuffer(120,'f')
 start_time_sec = 0
 last_req_ms = 0
 baseline = 0
-f = None  # File handle for data logging
+rms = 0.
+run = None  # RunFile of the current run
+slow = None  # SlowControl: temperatures every SLOW_INTERVAL_S
+scan = None  # ThresholdScan: the current or last threshold scan
+compactor = None  # Compactor: compresses closed run files (COMPACT_RUNS)
+sd = SdStats.SdStats()  # SD write/flush/sync latencies, saved with each segment
+# baseline and RMS are tracked from idle samples during the run. With
+# AUTO_RETUNE the thresholds follow baseline drifts of up to max_drift counts.
+# Off by default: a retune is not recorded in the run file, so the thresholds
+# in the segment header no longer match the data after it.
+AUTO_RETUNE = False
+tracker = BaselineTracker.BaselineTracker(window=4096, max_drift=500)
+# the clock is synced in the background while data taking runs on ticks_ms
+clock = TimeSync.TimeSync(['0.pool.ntp.org', '1.pool.ntp.org', '2.pool.ntp.org', '3.pool.ntp.org'])
+# the data file is split into segments of at most ROTATE_BYTES bytes or
+# ROTATE_INTERVAL_S seconds (0: no limit); with PREALLOCATE the next segment's
+# space is reserved on the SD card in the background before it is needed
+ROTATE_BYTES = 16_000_000
+ROTATE_INTERVAL_S = 86400
+PREALLOCATE = False
+# with PULSE_CAPTURE every event line also gets the pulse peak, the time over
+# threshold in us and every WAVE_DECIMATE-th sample of the reset wait, up to
+# WAVE_SAMPLES samples (columns peak, tot_us, w0, w1, ...)
+PULSE_CAPTURE = False
+WAVE_SAMPLES = 8
+WAVE_DECIMATE = 4
+# with DUAL_CORE the trigger loop runs on the second core (DaqCore.py) and this
+# core only drains its events, so web requests and SD writes cause no dead time
+DUAL_CORE = False
+# housekeeping ADCs (temperatures) are averaged every SLOW_INTERVAL_S seconds;
+# events get the latest temperature instead of reading the ADC themselves
+SLOW_INTERVAL_S = 10
+# with COMPACT_RUNS closed run files are compressed to <name>.csv.gz in the
+# background; it waits while the rate is above COMPACT_MAX_RATE_HZ or a web
+# request came in or a download sent data during the last COMPACT_QUIET_MS,
+# and never removes a file that a download is still sending. Off by default:
+# without DUAL_CORE the compression runs on the trigger core and adds dead time
+COMPACT_RUNS = False
+COMPACT_MAX_RATE_HZ = 20
+COMPACT_QUIET_MS = 10_000
 ##################################################################
 
 ##################################################################
@@ -804,13 +551,23 @@ if not wlan.active():
         led2.toggle()
         time.sleep(0.1)
 
-now = init_RTC()
-print(f"current time is {now}")
 init_sdcard()
 gc.collect() # early heap consolidation
 
 server_task = None  # global handle to the running server task
 
+def compaction_busy():
+    """Compaction waits while the rate is high, the web server is in use or a threshold scan runs"""
+    myrate = rates.get_tail()
+    if myrate is not None and myrate > COMPACT_MAX_RATE_HZ:
+        return True
+    if scan is not None and scan.state in ("pending", "running"):
+        return True
+    if Compactor.reading and time.ticks_diff(time.ticks_ms(), Compactor.last_read_ms) < COMPACT_QUIET_MS:
+        return True
+    return time.ticks_diff(time.ticks_ms(), last_req_ms) < COMPACT_QUIET_MS
+
+
 async def server_monitor():
     global server_task
     while True:
@@ -830,11 +587,12 @@ async def server_monitor():
 
 
 async def main():
-    global muon_count, iteration_count, rate, waited, switch_pressed, avg_time
+    global muon_count, coincidences, live_ms, iteration_count, rate, waited, switch_pressed, avg_time
     global rates, threshold, reset_threshold, is_leader, start_time_sec, baseline
-    global server_task, f
+    global server_task, run, rms, slow, compactor
     server_task = asyncio.create_task(app.start_server(host='0.0.0.0', port=80, debug=False))
     mon_task = asyncio.create_task(server_monitor())
+    sync_task = asyncio.create_task(clock.run())
     try:
         ip = wlan.ifconfig()[0]
         print("[server] listening on http://%s:80" % ip)
@@ -846,11 +604,16 @@ async def main():
     l2off = led2.off
     adc = ADC(Pin(26))       # create ADC object on ADC pin, Pin 26
     temperature_adc = ADC(Pin(27))  # create ADC object on ADC pin Pin 27
+    slow = SlowControl.SlowControl([("temperature_adc", temperature_adc.read_u16),
+                                    ("die_temperature_adc", ADC(4).read_u16)],
+                                   lambda: run.name[:-4] + ".slow.csv" if run.name else None,
+                                   interval_s=SLOW_INTERVAL_S, external=DUAL_CORE)
+    slow.prime()
 
     readout = adc.read_u16
     # # calibrate the threshold with HV off
     # hv_power_enable.off()
-    # baseline, rms = calibrate_average_rms(500)
+    # baseline, rms = tracker.seed(readout)
 
     # # 100 counts correspond to roughly (100/(2^16))*3.3V = 0.005V. So 1000 counts
     # # is 50 mV above threshold. the signal in Sally is about 0.5V.
@@ -862,9 +625,9 @@ async def main():
     hv_power_enable = Pin(19, Pin.OUT)
     hv_power_enable.on()
 
-    await asyncio.sleep_ms(0)
-    baseline, rms = calibrate_average_rms(500)
-    await asyncio.sleep_ms(0)
+    # quick seed from back-to-back reads; the estimate is refined from idle
+    # samples in the loop below, so there is no calibration dead time
+    baseline, rms = tracker.seed(readout)
     # 100 counts correspond to roughly (100/(2^16))*3.3V = 0.005V. So 1000 counts
     # is 50 mV above threshold. the signal in Sally is about 0.5V.
     threshold = int(round(baseline + 1000.))
@@ -879,10 +642,33 @@ async def main():
         coincidence_pin = Pin(14, Pin.OUT)
     print("is_leader is ", is_leader)
 
-    f = init_file(baseline, rms, threshold, reset_threshold, now, is_leader)
-
-    start_time_sec = time.time() # used for calculating runtime
+    def header_values():
+        # written at the top of every segment
+        return baseline, rms, threshold, reset_threshold, is_leader
+
+    run_start_ticks = time.ticks_ms()
+    capture = None
+    if PULSE_CAPTURE:
+        import PulseCapture
+        capture = PulseCapture.PulseCapture(WAVE_SAMPLES, WAVE_DECIMATE)
+    run = RunFile.RunFile(SD_DIRECTORY, clock, header_values, rotate_bytes=ROTATE_BYTES,
+                          rotate_s=ROTATE_INTERVAL_S, preallocate=PREALLOCATE, stats=sd, buffering=10240,
+                          extra_columns=capture.columns if capture is not None else "")
+    run.start(run_start_ticks)
+    sd.reset()
+    run_task = asyncio.create_task(run.task())
+    slow_task = asyncio.create_task(slow.run())
+    compact_task = None
+    if COMPACT_RUNS and not Compactor.can_compress():
+        print("COMPACT_RUNS needs deflate compression, which this firmware lacks: compaction off")
+    elif COMPACT_RUNS:
+        compactor = Compactor.Compactor(SD_DIRECTORY, run.open_names, compaction_busy)
+        compact_task = asyncio.create_task(compactor.run())
+    time_corrected = clock.synced
+
+    start_time_sec = time.time() # used for calculating runtime, corrected at the clock sync
     tmeas = time.ticks_ms
+    tus = time.ticks_us
     tusleep = time.sleep_us
     start_time = tmeas()
     end_time = start_time
@@ -899,102 +685,218 @@ async def main():
     INNER_ITER_LIMIT = const(400_000)
     OUTER_ITER_LIMIT = const(20*INNER_ITER_LIMIT)
     YIELD_PERIOD_MS = const(50)  # tune: 20–50 ms to taste
+    SCAN_BATCH = const(64)   # ADC samples per TriggerKernel.scan() call
+    kernel_scan = TriggerKernel.scan
+    scan_out = array.array('i', [0, 0])
+    live_us = 0
+    next_report = INNER_ITER_LIMIT
+    next_flush = OUTER_ITER_LIMIT
+    next_yield = 3_000
 
     dts = RingBuffer.RingBuffer(50)
     coincidence = 0
+    track = tracker.update
+    gc.collect()
+    print(f"[boot] data taking starts {time.ticks_ms()} ms after reset, {gc.mem_free()} bytes free")
     print("[main]: start of data taking loop")
     loop_timer_time = tmeas()
     last_yield = loop_timer_time
-    while True:
-        iteration_count += 1
-        if iteration_count % INNER_ITER_LIMIT == 0:
-            avg_dt = dts.calculate_average()
-            if avg_dt == 0.:
-                rate = 0.
-            else:
-                rate = 1000./avg_dt
-            tdiff = time.ticks_diff(tmeas(), loop_timer_time)
-            avg_time = tdiff/INNER_ITER_LIMIT
-            loop_timer_time = tmeas()
-            try:
-                delta_req = time.ticks_diff(loop_timer_time, last_req_ms)
-            except Exception:
-                delta_req = -1
-            print(f"iter {iteration_count}, # {muon_count}, {rate:.1f} Hz, {gc.mem_free()} free, "
-                f"avg time {avg_time:.3f} ms, last_req_delta={delta_req} ms, "
-                f"last_yield_delta={time.ticks_diff(loop_timer_time, last_yield)} ms")
-            l1t()
-            # update rates ring buffer every half minute. this time needs to be synched with the web server
-            if time.ticks_diff(loop_timer_time, tlast) >= 30000:  # 30,000 ms = 30 seconds
-                rates.append(round(rate, 2))
-                tlast = loop_timer_time
-            if iteration_count % OUTER_ITER_LIMIT == 0:
-                print("flush file, iter ", iteration_count, gc.mem_free())
-                f.flush()
-                os.sync()
-                gc.collect()
-        adc_value = readout()  # Read the ADC value (0 - 65535)
-        #print(adc_value)
-        if adc_value > threshold:
-            l2on()
-            # Get the current time in milliseconds again
-            end_time = tmeas()
-            muon_count += 1
-            wait_counts = 150
-            if not is_leader:
-                coincidence_pin.value(1)
-            else:
-                if coincidence_pin.value() == 1:
-                    coincidence = 1
+    if DUAL_CORE:
+        # core 1 polls the ADC and queues the events; here they are written out
+        import DaqCore
+        ring = DaqCore.EventRing(256, capture.fields if capture is not None else 0)
+        ctrl = DaqCore.control(threshold, reset_threshold)
+        DaqCore.start(ring, ctrl, readout, lambda: slow.latest[0], coincidence_pin, is_leader, led2, capture,
+                      slow.sample)
+        rec = [0] * ring.width
+        blocks = 0
+        idle_seq = 0
+        flushed = loop_timer_time
+        while not (shutdown_request or switch_pressed or restart_request):
+            while ring.pop_into(rec):
+                muon_count = rec[DaqCore.MUON_COUNT]
+                coincidences += rec[DaqCore.COINC]
+                dts.append(rec[DaqCore.DT])
+                sd.write(run.f, ", ".join([str(v) for v in rec]) + "\n")
+            live_ms = ctrl[DaqCore.LIVE_MS]
+            if ctrl[DaqCore.IDLE_SEQ] != idle_seq:
+                idle_seq = ctrl[DaqCore.IDLE_SEQ]
+                track(ctrl[DaqCore.IDLE])
+            # thresholds may have been changed on the web page or by retuning
+            ctrl[DaqCore.THRESHOLD] = threshold
+            ctrl[DaqCore.RESET_THRESHOLD] = reset_threshold
+            now = tmeas()
+            if time.ticks_diff(now, loop_timer_time) >= 5000:
+                n = ((ctrl[DaqCore.BLOCKS] - blocks) & 0x3FFFFFFF) * DaqCore.BLOCK
+                blocks = ctrl[DaqCore.BLOCKS]
+                iteration_count += n
+                avg_time = time.ticks_diff(now, loop_timer_time) / n if n else 0.
+                loop_timer_time = now
+                waited = ctrl[DaqCore.WAITED]
+                avg_dt = dts.calculate_average()
+                rate = 1000./avg_dt if avg_dt else 0.
+                print(f"iter {iteration_count}, # {muon_count}, {rate:.1f} Hz, {gc.mem_free()} free, "
+                    f"avg time {avg_time:.4f} ms, queued {len(ring)}, ring overflows {ctrl[DaqCore.OVERFLOWS]}")
+                l1t()
+                if not time_corrected and clock.synced:
+                    time_corrected = True
+                    start_time_sec = clock.epoch_ms(run_start_ticks) // 1000
+                run.check()  # header back-fill, switch to the next segment
+                baseline = tracker.mean
+                rms = tracker.rms()
+                if AUTO_RETUNE:
+                    new_threshold, new_reset = tracker.retune(threshold, reset_threshold)
+                    if new_threshold != threshold:
+                        print(f"baseline {baseline:.1f} rms {rms:.1f}: threshold {threshold} -> {new_threshold}, "
+                              f"reset_threshold {reset_threshold} -> {new_reset}")
+                        threshold, reset_threshold = new_threshold, new_reset
+                if time.ticks_diff(now, tlast) >= 30000:  # rates ring buffer, every 30 seconds
+                    rates.append(round(rate, 2))
+                    tlast = now
+                if time.ticks_diff(now, flushed) >= 100000:
+                    print("flush file, iter ", iteration_count, gc.mem_free())
+                    sd.flush(run.f)
+                    sd.sync()
+                    gc.collect()
+                    flushed = now
+            await asyncio.sleep_ms(10)
+        if not DaqCore.stop(ctrl):
+            print("core 1 trigger loop did not stop")
+        while ring.pop_into(rec):
+            sd.write(run.f, ", ".join([str(v) for v in rec]) + "\n")
+        print("dual core loop shutdown, waited is ", ctrl[DaqCore.WAITED], ", ring overflows ", ctrl[DaqCore.OVERFLOWS])
+    else:
+        while True:
+            # poll until a sample crosses the threshold or SCAN_BATCH samples were read
+            t = tus()
+            n = kernel_scan(readout, threshold, SCAN_BATCH, scan_out)
+            live_us += time.ticks_diff(tus(), t)
+            if live_us >= 1000:
+                live_ms = (live_ms + live_us // 1000) & 0x3FFFFFFF
+                live_us %= 1000
+            iteration_count += n
+            if iteration_count >= next_report:
+                avg_dt = dts.calculate_average()
+                if avg_dt == 0.:
+                    rate = 0.
+                else:
+                    rate = 1000./avg_dt
+                tdiff = time.ticks_diff(tmeas(), loop_timer_time)
+                avg_time = tdiff/(iteration_count - next_report + INNER_ITER_LIMIT)
+                next_report = iteration_count + INNER_ITER_LIMIT
+                loop_timer_time = tmeas()
+                try:
+                    delta_req = time.ticks_diff(loop_timer_time, last_req_ms)
+                except Exception:
+                    delta_req = -1
+                print(f"iter {iteration_count}, # {muon_count}, {rate:.1f} Hz, {gc.mem_free()} free, "
+                    f"avg time {avg_time:.3f} ms, last_req_delta={delta_req} ms, "
+                    f"last_yield_delta={time.ticks_diff(loop_timer_time, last_yield)} ms")
+                l1t()
+                if not time_corrected and clock.synced:
+                    time_corrected = True
+                    start_time_sec = clock.epoch_ms(run_start_ticks) // 1000
+                run.check()  # header back-fill, switch to the next segment
+                baseline = tracker.mean
+                rms = tracker.rms()
+                if AUTO_RETUNE:
+                    new_threshold, new_reset = tracker.retune(threshold, reset_threshold)
+                    if new_threshold != threshold:
+                        print(f"baseline {baseline:.1f} rms {rms:.1f}: threshold {threshold} -> {new_threshold}, "
+                              f"reset_threshold {reset_threshold} -> {new_reset}")
+                        threshold, reset_threshold = new_threshold, new_reset
+                # update rates ring buffer every half minute. this time needs to be synched with the web server
+                if time.ticks_diff(loop_timer_time, tlast) >= 30000:  # 30,000 ms = 30 seconds
+                    rates.append(round(rate, 2))
+                    tlast = loop_timer_time
+                if iteration_count >= next_flush:
+                    next_flush = iteration_count + OUTER_ITER_LIMIT
+                    print("flush file, iter ", iteration_count, gc.mem_free())
+                    sd.flush(run.f)
+                    sd.sync()
+                    gc.collect()
+            adc_value = scan_out[TriggerKernel.LAST]  # last ADC value read (0 - 65535)
+            if scan_out[TriggerKernel.HIT]:
+                l2on()
+                # Get the current time in milliseconds again
+                end_time = tmeas()
+                muon_count += 1
+                wait_counts = 150
+                if not is_leader:
+                    coincidence_pin.value(1)
                 else:
-                    coincidence = 0
-            # wait to drop beneath reset threshold
-            # time.sleep_us(3)
-            while readout() > reset_threshold:
-                wait_counts = wait_counts - 1
-                tusleep(1)
-                if is_leader and coincidence == 0: # latch value of coincidence
                     if coincidence_pin.value() == 1:
                         coincidence = 1
+                    else:
+                        coincidence = 0
+                if capture is not None:
+                    capture.start(adc_value)
+                # wait to drop beneath reset threshold
+                while True:
+                    v = readout()
+                    if v <= reset_threshold:
+                        break
+                    if capture is not None:
+                        capture.add(v)
+                    wait_counts = wait_counts - 1
+                    tusleep(1)
+                    if is_leader and coincidence == 0: # latch value of coincidence
+                        if coincidence_pin.value() == 1:
+                            coincidence = 1
+                    if wait_counts == 0:
+                        waited += 1 
+                        break
+                if capture is not None:
+                    capture.finish(wait_counts == 0)
                 if wait_counts == 0:
-                    waited += 1 
                     # we yield here to let the web server run. Most of the time if we get here something
                     # has gone wrong.
                     await asyncio.sleep_ms(5) # yield to the web server running in the other thread
-                    break
-            # Calculate elapsed time in milliseconds
-            dt = time.ticks_diff(end_time,start_time) # what about wraparound
-            dts.append(dt)
-            temperature_adc_value = temperature_adc.read_u16()
-            start_time = end_time
-            # write to the SD card
-            f.write(f"{muon_count}, {adc_value}, {temperature_adc_value}, {dt}, {end_time}, {wait_counts}, {coincidence}\n")
-            l2off()
-            if not is_leader:
-                coincidence_pin.value(0)
-        if iteration_count % 3_000 == 0:
-            last_yield = tmeas()
-            await asyncio.sleep_ms(0) # yield to the web server running in the other thread
-            # now_ticks = tmeas()
-            # if time.ticks_diff(now_ticks, last_yield) >= YIELD_PERIOD_MS:
-            #     await asyncio.sleep_ms(0) # this yields to the web server running in the other thread
-            #     last_yield = now_ticks
-        # # Cooperative yield with a budget: only when idle and at most every YIELD_PERIOD_MS
-        # if adc_value <= threshold:
-        #     now_ticks = tmeas()
-        #     if time.ticks_diff(now_ticks, last_yield) >= YIELD_PERIOD_MS:
-        #         await asyncio.sleep_ms(0)
-        #         last_yield = now_ticks
-        if shutdown_request or switch_pressed or restart_request:
-            print("tight loop shutdown, waited is ", waited)
-            break
+                # Calculate elapsed time in milliseconds
+                dt = time.ticks_diff(end_time,start_time) # what about wraparound
+                dts.append(dt)
+                temperature_adc_value = slow.latest[0]  # latest slow-control average
+                coincidences += coincidence
+                start_time = end_time
+                # write to the SD card
+                sd.write(run.f, f"{muon_count}, {adc_value}, {temperature_adc_value}, {dt}, {end_time}, {wait_counts}, {coincidence}"
+                         f"{capture.csv() if capture is not None else ''}\n")
+                l2off()
+                if not is_leader:
+                    coincidence_pin.value(0)
+            elif adc_value < reset_threshold:
+                # idle sample already in hand: one per batch goes to the baseline tracker
+                track(adc_value)
+            if iteration_count >= next_yield:
+                next_yield = iteration_count + 3_000
+                last_yield = tmeas()
+                await asyncio.sleep_ms(0) # yield to the web server running in the other thread
+                # now_ticks = tmeas()
+                # if time.ticks_diff(now_ticks, last_yield) >= YIELD_PERIOD_MS:
+                #     await asyncio.sleep_ms(0) # this yields to the web server running in the other thread
+                #     last_yield = now_ticks
+            # # Cooperative yield with a budget: only when idle and at most every YIELD_PERIOD_MS
+            # if adc_value <= threshold:
+            #     now_ticks = tmeas()
+            #     if time.ticks_diff(now_ticks, last_yield) >= YIELD_PERIOD_MS:
+            #         await asyncio.sleep_ms(0)
+            #         last_yield = now_ticks
+            if shutdown_request or switch_pressed or restart_request:
+                print("tight loop shutdown, waited is ", waited)
+                break
     try:
         mon_task.cancel()
+        sync_task.cancel()
+        run_task.cancel()
+        slow_task.cancel()
+        if compact_task is not None:
+            compact_task.cancel()
     except Exception:
         pass
     # Microdot's shutdown() is synchronous; do not await it on MicroPython
     app.shutdown()
-    f.close()
+    slow.flush()
+    run.close()
     await server_task
     # f.close()
     # await server
@@ -1005,7 +907,7 @@ try:
 except KeyboardInterrupt:
     print("keyboard interrupt")
     try:
-        f.close()
+        run.close()
     except Exception:
         pass
     unmount_sdcard()
@@ -1013,7 +915,7 @@ except KeyboardInterrupt:
 except Exception as e:
     sys.print_exception(e)
     try:
-        f.close()
+        run.close()
     except Exception:
         pass
     unmount_sdcard()
@@ -1,7 +1,7 @@
 """MQTT client version of the code, where the Pico-W is an MQTT client and sends 
 the data to an MQTT broker running on a remote server based on the raspberry Pi."""
 
-from machine import ADC, Pin, RTC
+from machine import ADC, Pin
 import asyncio
 import machine
 import sdcard
@@ -10,9 +10,8 @@ import time
 import io
 import uos as os
 import gc
-import urequests
+import array
 import ujson as json
-import ntptime
 
 from micropython import const
 from umqtt.simple import MQTTClient
@@ -20,32 +19,18 @@ import network
 
 import my_secrets
 import RingBuffer
-import urandom
+import BaselineTracker
+import TimeSync
+import RunFile
+import SdStats
+import TriggerKernel
+import SlowControl
+import Compactor
+# DaqCore, PulseCapture and ThresholdScan are imported when their feature is first used
 
 import micropython
 
 
-@micropython.native
-async def calibrate_average_rms(n: int) -> tuple:
-    """calibrate the threshold value by taking the average of n samples. Assumes no 
-       muons are present"""
-    local_led2 = Pin(15, Pin.OUT) # local LED on pepper carrier board
-    adc = ADC(0)  # Pin 26 is GP26, which is ADC0
-    sumval = 0
-    sum_squared = 0
-    for _ in range(n):
-        value = adc.read_u16()
-        sumval += value
-        sum_squared += value ** 2
-        local_led2.toggle()
-        await asyncio.sleep_ms(10) # wait 
-    mean = sumval / n
-    variance = (sum_squared / n) - (mean ** 2)
-    standard_deviation = variance ** 0.5
-    local_led2.value(0)
-    return mean, standard_deviation
-
-
 def init_sdcard():
     """ Initialize the SD card interface on the base board"""
 # Define SPI pins -- see schematic for Pepper V2 board
@@ -69,89 +54,6 @@ def unmount_sdcard():
     os.umount(SD_DIRECTORY)
     print("SD card unmounted.")
 
-def init_RTC():
-    """set RTC to UTC. Uses NTP and falls back to worldtimeapi.org if NTP fails"""
-    ntptime.host = 'ntp3.cornell.edu'
-    ntptime.timeout = 2
-    print(f"NTP host is {ntptime.host}")
-    wait_time = 2
-    success = False
-    rtc = RTC()
-    for _ in range(5):
-        print("waiting for NTP time")
-        try:
-            led2.toggle()
-            ntptime.settime()
-            # if we get here, assume it succeeded (above throws exception on fail)
-            print("NTP success: ", rtc.datetime())
-            success = True
-            break
-        except OSError as e:
-            print(f"NTP time setting failed. Check network connection. {e}")
-        except Exception as e:
-            print(f"unexpected error: {e}")
-        time.sleep(wait_time)
-        wait_time = wait_time * 2
-    if not success:
-        # fall back to urequests method
-        print("NTP failed, trying worldtimeapi.org")
-        try:
-            response = urequests.get('http://worldtimeapi.org/api/ip')
-            data = response.json()
-            datetime_str = data['utc_datetime']
-            print("datetime_str: ", datetime_str)
-            year, month, day, hour, minute, second = map(int,
-                                                         [datetime_str[0:4], datetime_str[5:7],
-                                                          datetime_str[8:10], datetime_str[11:13],
-                                                          datetime_str[14:16], datetime_str[17:19]])
-            rtc.datetime((year, month, day, 0, hour, minute, second, 0))
-            success = True
-            print("RTC set to: ", rtc.datetime())
-        except Exception as e:
-            print(f"Failed to set RTC time: {e}")
-
-    if not success:
-        print("Failed to set RTC time")
-        random_hour = urandom.getrandbits(5) % 24  # Generate a random hour (0-23)
-        random_minute = urandom.getrandbits(6) % 60  # Generate a random minute (0-59)
-        # Set RTC to a random time on 1/1/2024
-        rtc.datetime((2024, 1, 1, 0, random_hour, random_minute, 0, 0))
-    return get_iso8601_timestamp()
-
-
-def get_iso8601_timestamp():
-    """Return RTC time as an ISO8601 string in UTC with trailing 'Z'."""
-    rtc = RTC()
-    y, m, d, _, hh, mm, ss, _ = rtc.datetime()
-    # No microsecond support in RTC; emit 000000 and mark as Z (UTC)
-    return f"{y:04d}-{m:02d}-{d:02d}T{hh:02d}:{mm:02d}:{ss:02d}.000000Z"
-
-def init_file(baseline, rms, threshold, reset_threshold, now, is_leader) -> io.TextIOWrapper:
-    """ open file for writing, with date and time in the filename. write metadata. 
-        return filehandle """
-    now2 = time.localtime()
-    year = now2[0]
-    month = now2[1]
-    day = now2[2]
-    hour = now2[3]
-    minute = now2[4]
-    suffix = f"{year}{month:02d}{day:02d}_{hour:02d}{minute:02d}"
-    # data file
-    filename = f"/sd/muon_data_{suffix}.csv"
-    # Reduce buffering to minimize RAM usage
-    f = open(filename, "w", buffering=512, encoding='utf-8')
-    f.write("baseline,stddev,threshold,reset_threshold,run_start_time,is_leader\n")
-    if is_leader:
-        leader = 1
-    else:
-        leader = 0
-    f.write(f"{baseline:.1f}, {rms:.1f}, {threshold}, {reset_threshold}, {now}, {leader}\n")
-    f.write("Muon Count,ADC,temperature_ADC,dt,t,t_wait,coinc\n")
-    return f
-
-
-
-
 # Path to the SD card directory where CSV files are located
 SD_DIRECTORY = '/sd'
 
@@ -179,6 +81,8 @@ def check_leader_status():
 shutdown_request = False
 restart_request = False
 muon_count = 0
+coincidences = 0  # events with the coincidence flag set
+live_ms = 0  # ms spent polling the ADC (mod 2**30): the livetime, for the threshold scan
 iteration_count = 0
 rate = 0.
 waited = 0
@@ -190,6 +94,43 @@ rates = RingBuffer.RingBuffer(120,'f')
 start_time_sec = 0
 # Track last control message (raw bytes) to avoid re-processing retained/duplicate commands
 last_control_msg = None
+# baseline and RMS are tracked from idle samples during the run. With
+# AUTO_RETUNE the thresholds follow baseline drifts of up to max_drift counts.
+# Off by default: a retune is not recorded in the run file, so the thresholds
+# in the segment header no longer match the data after it.
+AUTO_RETUNE = False
+tracker = BaselineTracker.BaselineTracker(window=4096, max_drift=500)
+# the clock is synced in the background while data taking runs on ticks_ms
+clock = TimeSync.TimeSync(['ntp3.cornell.edu', '0.pool.ntp.org'])
+run = None  # RunFile of the current run
+slow = None  # SlowControl: temperatures every SLOW_INTERVAL_S
+scan = None  # ThresholdScan: the current or last threshold scan
+compactor = None  # Compactor: compresses closed run files (COMPACT_RUNS)
+sd = SdStats.SdStats()  # SD write/flush/sync latencies, saved with each segment
+# the data file is split into segments of at most ROTATE_BYTES bytes or
+# ROTATE_INTERVAL_S seconds (0: no limit); with PREALLOCATE the next segment's
+# space is reserved on the SD card in the background before it is needed
+ROTATE_BYTES = 16_000_000
+ROTATE_INTERVAL_S = 86400
+PREALLOCATE = False
+# with PULSE_CAPTURE every event line also gets the pulse peak, the time over
+# threshold in us and every WAVE_DECIMATE-th sample of the reset wait, up to
+# WAVE_SAMPLES samples (columns peak, tot_us, w0, w1, ...)
+PULSE_CAPTURE = False
+WAVE_SAMPLES = 8
+WAVE_DECIMATE = 4
+# with DUAL_CORE the trigger loop runs on the second core (DaqCore.py) and this
+# core only drains its events, so MQTT publishing and SD writes cause no dead time
+DUAL_CORE = False
+# housekeeping ADCs (temperatures) are averaged every SLOW_INTERVAL_S seconds;
+# events get the latest temperature instead of reading the ADC themselves
+SLOW_INTERVAL_S = 10
+# with COMPACT_RUNS closed run files are compressed to <name>.csv.gz in the
+# background; it waits while the rate is above COMPACT_MAX_RATE_HZ. Off by
+# default: without DUAL_CORE the compression runs on the trigger core and adds
+# dead time
+COMPACT_RUNS = False
+COMPACT_MAX_RATE_HZ = 20
 ##################################################################
 # MQTT configuration
 MQTT_BROKER = getattr(my_secrets, 'MQTT_BROKER', 'pepper.physics.cornell.edu')
@@ -224,8 +165,6 @@ if not wlan.active():
         led2.toggle()
         time.sleep(0.1)
 
-now = init_RTC()
-print(f"current time is {now}")
 init_sdcard()
 
 
@@ -247,6 +186,7 @@ MQTT_CLIENT_ID = f"cuwatch_{device_id:03d}".encode()
 MQTT_TOPIC = f"telemetry/{device_id:03d}".encode()
 MQTT_STATUS_TOPIC = f"status/{device_id:03d}".encode()
 MQTT_CONTROL_TOPIC = f"control/{device_id:03d}/set".encode()
+MQTT_SCAN_TOPIC = f"scan/{device_id:03d}".encode()
 
 mqtt_client = None  # global MQTT client instance
 
@@ -340,6 +280,20 @@ def mqtt_message_callback(topic, msg):
                 global reset_threshold
                 reset_threshold = int(data["reset_threshold"])
                 print(f"Reset threshold updated via MQTT: {reset_threshold}")
+            # {"scan": {"start": 900, "stop": 3000, "step": 100, "dwell_s": 60}} or {"scan": "cancel"}
+            if "scan" in data:
+                if data["scan"] == "cancel":
+                    if scan is not None:
+                        scan.cancel()
+                else:
+                    try:
+                        start_scan(data["scan"])
+                    except ValueError as e:
+                        print("Threshold scan not started:", e)
+            if "auto_retune" in data:
+                global AUTO_RETUNE
+                AUTO_RETUNE = bool(data["auto_retune"])
+                print(f"Auto retune set via MQTT: {AUTO_RETUNE}")
             # Accept either {"new_run": true}, {"shutdown": true} or legacy string payloads
             if (isinstance(data, dict) and data.get("new_run")) or (isinstance(data, str) and data == "new_run"):
                 print("Received new_run command via MQTT")
@@ -370,6 +324,57 @@ def mqtt_message_callback(topic, msg):
         finally:
             gc.collect()
 
+def _set_threshold(value):
+    global threshold
+    threshold = value
+
+def _scan_counts():
+    return muon_count, coincidences, live_ms
+
+async def run_scan(s):
+    """Run a threshold scan with retuning off, then restore the threshold and AUTO_RETUNE"""
+    global threshold, AUTO_RETUNE
+    saved = threshold, AUTO_RETUNE
+    AUTO_RETUNE = False
+    try:
+        await s.run(_set_threshold, _scan_counts, lambda: reset_threshold)
+    finally:
+        threshold, AUTO_RETUNE = saved
+        print(f"threshold back to {threshold}")
+
+def start_scan(params):
+    """Start a threshold scan from a dict with start, stop, step and dwell_s; raises ValueError"""
+    global scan
+    if scan is not None and scan.state in ("pending", "running"):
+        raise ValueError("a threshold scan is already running")
+    import ThresholdScan
+    try:
+        s = ThresholdScan.ThresholdScan(params["start"], params["stop"], params.get("step", 50),
+                                        params.get("dwell_s", 60), SD_DIRECTORY, clock, tracker.mean)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"bad scan parameters: {e}")
+    scan = s
+    asyncio.create_task(run_scan(s))
+    return s
+
+async def scan_publish_loop():
+    """Publish the threshold scan results after every step and at the end"""
+    published = None
+    while True:
+        if scan is not None:
+            key = (id(scan), len(scan.steps), scan.state)
+            if key != published and ensure_mqtt_connected():
+                if safe_publish(MQTT_SCAN_TOPIC, json.dumps(scan.as_dict())):
+                    published = key
+        await asyncio.sleep(5)
+
+def compaction_busy():
+    """Compaction waits while the rate is high or a threshold scan runs"""
+    myrate = rates.get_tail()
+    if myrate is not None and myrate > COMPACT_MAX_RATE_HZ:
+        return True
+    return scan is not None and scan.state in ("pending", "running")
+
 async def mqtt_check_loop():
     """Periodically call check_msg and attempt reconnect on errors."""
     global mqtt_client
@@ -404,8 +409,8 @@ async def status_publish_loop(get_status_msg):
         await asyncio.sleep(30)
 
 async def main():
-    global muon_count, iteration_count, rate, waited, switch_pressed, avg_time
-    global rates, threshold, reset_threshold, is_leader, start_time_sec
+    global muon_count, coincidences, live_ms, iteration_count, rate, waited, switch_pressed, avg_time
+    global rates, threshold, reset_threshold, is_leader, start_time_sec, slow, compactor
     print("main() started")
     gc.collect()
     l1t = led1.toggle
@@ -413,11 +418,16 @@ async def main():
     l2off = led2.off
     adc = ADC(Pin(26))       # create ADC object on ADC pin, Pin 26
     temperature_adc = ADC(Pin(27))  # create ADC object on ADC pin Pin 27
+    slow = SlowControl.SlowControl([("temperature_adc", temperature_adc.read_u16),
+                                    ("die_temperature_adc", ADC(4).read_u16)],
+                                   lambda: run.name[:-4] + ".slow.csv" if run.name else None,
+                                   interval_s=SLOW_INTERVAL_S, external=DUAL_CORE)
+    slow.prime()
 
     readout = adc.read_u16
     # # calibrate the threshold with HV off
     # hv_power_enable.off()
-    # baseline, rms = calibrate_average_rms(500)
+    # baseline, rms = tracker.seed(readout)
 
     # # 100 counts correspond to roughly (100/(2^16))*3.3V = 0.005V. So 1000 counts
     # # is 50 mV above threshold. the signal in Sally is about 0.5V.
@@ -428,7 +438,9 @@ async def main():
     # calibrate the threshold with HV on
     hv_power_enable = Pin(19, Pin.OUT)
     hv_power_enable.on()
-    baseline, rms = await calibrate_average_rms(500)
+    # quick seed from back-to-back reads; the estimate is refined from idle
+    # samples in the loop below, so there is no calibration dead time
+    baseline, rms = tracker.seed(readout)
     # 100 counts correspond to roughly (100/(2^16))*3.3V = 0.005V. So 1000 counts
     # is 50 mV above threshold. the signal in Sally is about 0.5V.
     threshold = int(round(baseline + 1000.))
@@ -443,11 +455,36 @@ async def main():
         coincidence_pin = Pin(14, Pin.OUT)
     print("is_leader is ", is_leader)
 
-    global f
-    f = init_file(baseline, rms, threshold, reset_threshold, now, is_leader)
-
-    start_time_sec = time.time() # used for calculating runtime
+    global run
+    sync_task = asyncio.create_task(clock.run())
+
+    def header_values():
+        # written at the top of every segment
+        return baseline, rms, threshold, reset_threshold, is_leader
+
+    run_start_ticks = time.ticks_ms()
+    capture = None
+    if PULSE_CAPTURE:
+        import PulseCapture
+        capture = PulseCapture.PulseCapture(WAVE_SAMPLES, WAVE_DECIMATE)
+    run = RunFile.RunFile(SD_DIRECTORY, clock, header_values, rotate_bytes=ROTATE_BYTES,
+                          rotate_s=ROTATE_INTERVAL_S, preallocate=PREALLOCATE, stats=sd, buffering=512,
+                          extra_columns=capture.columns if capture is not None else "")
+    run.start(run_start_ticks)
+    sd.reset()
+    run_task = asyncio.create_task(run.task())
+    slow_task = asyncio.create_task(slow.run())
+    compact_task = None
+    if COMPACT_RUNS and not Compactor.can_compress():
+        print("COMPACT_RUNS needs deflate compression, which this firmware lacks: compaction off")
+    elif COMPACT_RUNS:
+        compactor = Compactor.Compactor(SD_DIRECTORY, run.open_names, compaction_busy)
+        compact_task = asyncio.create_task(compactor.run())
+    time_corrected = clock.synced
+
+    start_time_sec = time.time() # used for calculating runtime, corrected at the clock sync
     tmeas = time.ticks_ms
+    tus = time.ticks_us
     tusleep = time.sleep_us
     start_time = tmeas()
     end_time = start_time
@@ -464,9 +501,17 @@ async def main():
     INNER_ITER_LIMIT = const(400_000)
     OUTER_ITER_LIMIT = const(20*INNER_ITER_LIMIT)
     YIELD_PERIOD_MS = const(25)  # tune: 20–50 ms works well
+    SCAN_BATCH = const(64)   # ADC samples per TriggerKernel.scan() call
+    kernel_scan = TriggerKernel.scan
+    scan_out = array.array('i', [0, 0])
+    live_us = 0
+    next_report = INNER_ITER_LIMIT
+    next_flush = OUTER_ITER_LIMIT
+    next_collect = 1_000
 
     dts = RingBuffer.RingBuffer(50)
     coincidence = 0
+    track = tracker.update
     print("start of data taking loop")
     loop_timer_time = tmeas()
     last_yield = loop_timer_time
@@ -476,6 +521,7 @@ async def main():
     mqtt_client = mqtt_connect()
     # Start MQTT check loop (uses global mqtt_client)
     asyncio.create_task(mqtt_check_loop())
+    asyncio.create_task(scan_publish_loop())
 
     def get_status_msg():
         return json.dumps({
@@ -484,115 +530,245 @@ async def main():
             'threshold': threshold,
             'reset_threshold': reset_threshold,
             'baseline': baseline,
+            'rms': rms,
+            'auto_retune': AUTO_RETUNE,
             'runtime': time.time() - start_time_sec,
+            'time_sync': clock.quality(),
+            'sd_bytes_per_s': sd.bytes_per_s(),
+            'sd_write_p99_us': sd.writes.percentile_us(99),
+            'sd_worst_us': sd.worst()[1],
             'is_leader': is_leader,
             'avg_time_ms': avg_time,
+            'slow': slow.as_dict(),
+            'scan': scan.state if scan is not None else None,
+            'compaction': compactor.as_dict() if compactor is not None else None,
         })
 
     status_task_started = False
     first_event = True  # Track if this is the first event
 
+    def publish_event(muon_count, adc_value, temperature_adc_value, dt, end_time, wait_counts, coincidence, pulse=None):
+        nonlocal first_event
+        event_data = {
+            'device_number': int(device_id),
+            'muon_count': muon_count,
+            'adc_v': adc_value,
+            'temp_adc_v': temperature_adc_value,
+            'dt': dt,                 # milliseconds between this and previous hit
+            'ts': clock.iso8601(end_time),  # ISO-8601 UTC wall-clock time (Z), null until the clock is synced
+            't_ms': end_time,         # monotonic ticks_ms for debugging
+            'wait_cnt': wait_counts,
+            'coincidence': coincidence
+        }
+        if pulse is not None:
+            event_data.update(pulse)  # peak, tot_us, wave
+        if first_event:
+            print("sent first event string")
+            # Run start as ISO8601 UTC string (null until the clock is synced;
+            # events without ts are stamped with the receive time by the server)
+            event_data['run_start'] = clock.iso8601(run_start_ticks)
+            event_data['run_start_ticks_ms'] = run_start_ticks
+            event_data['time_sync'] = clock.quality()
+            # Include run metadata for server-side tracking
+            event_data['baseline'] = int(baseline)
+            event_data['reset_threshold'] = int(reset_threshold)
+            event_data['threshold'] = int(threshold)
+            event_data['is_leader'] = is_leader
+            first_event = False
+        try:
+            event_msg = json.dumps(event_data)
+            safe_publish(MQTT_TOPIC, event_msg)
+            gc.collect()  # Collect after event processing
+        except Exception as e:
+            print("MQTT publish error (event):", e)
+
     # DAQ main loop
-    while True:
-        iteration_count += 1
-        if iteration_count % INNER_ITER_LIMIT == 0:
-            rate = 1000./dts.calculate_average()
-            tdiff = time.ticks_diff(tmeas(), loop_timer_time)
-            avg_time = tdiff/INNER_ITER_LIMIT
-            print(f"iter {iteration_count}, # {muon_count}, {rate:.1f} Hz, {gc.mem_free()} free, avg time {avg_time:.3f} ms")
-            l1t()
-            loop_timer_time = tmeas()
-            # update rates ring buffer every half minute
-            if time.ticks_diff(loop_timer_time, tlast) >= 30000:  # 30,000 ms = 30 seconds
-                rates.append(round(rate, 2))
-                tlast = loop_timer_time
-            if iteration_count % OUTER_ITER_LIMIT == 0:
-                print("flush file, iter ", iteration_count, gc.mem_free())
-                f.flush()
-                os.sync()
-                gc.collect()
-            # Start status publish loop after first INNER_ITER_LIMIT
-            if not status_task_started:
-                asyncio.create_task(status_publish_loop(get_status_msg))
-                status_task_started = True
-        adc_value = readout()  # Read the ADC value (0 - 65535)
-        if adc_value > threshold: # we have a signal
-            l2on()
-            # Get the current time in milliseconds again
-            end_time = tmeas()
-            muon_count += 1
-            wait_counts = 150
-            if not is_leader:
-                coincidence_pin.value(1)
-            else:
-                if coincidence_pin.value() == 1:
-                    coincidence = 1
+    if DUAL_CORE:
+        # core 1 polls the ADC and queues the events; here they are written out and published
+        import DaqCore
+        ring = DaqCore.EventRing(256, capture.fields if capture is not None else 0)
+        ctrl = DaqCore.control(threshold, reset_threshold)
+        DaqCore.start(ring, ctrl, readout, lambda: slow.latest[0], coincidence_pin, is_leader, led2, capture,
+                      slow.sample)
+        rec = [0] * ring.width
+        blocks = 0
+        idle_seq = 0
+        flushed = loop_timer_time
+        while not (shutdown_request or switch_pressed or restart_request):
+            while ring.pop_into(rec):
+                muon_count = rec[DaqCore.MUON_COUNT]
+                coincidences += rec[DaqCore.COINC]
+                dts.append(rec[DaqCore.DT])
+                sd.write(run.f, ", ".join([str(v) for v in rec]) + "\n")
+                pulse = None
+                if capture is not None:
+                    pulse = {'peak': rec[DaqCore.FIELDS], 'tot_us': rec[DaqCore.FIELDS + 1],
+                             'wave': rec[DaqCore.FIELDS + 2:]}
+                publish_event(*rec[:DaqCore.FIELDS], pulse=pulse)
+            live_ms = ctrl[DaqCore.LIVE_MS]
+            if ctrl[DaqCore.IDLE_SEQ] != idle_seq:
+                idle_seq = ctrl[DaqCore.IDLE_SEQ]
+                track(ctrl[DaqCore.IDLE])
+            # thresholds may have been changed over MQTT or by retuning
+            ctrl[DaqCore.THRESHOLD] = threshold
+            ctrl[DaqCore.RESET_THRESHOLD] = reset_threshold
+            now = tmeas()
+            if time.ticks_diff(now, loop_timer_time) >= 5000:
+                n = ((ctrl[DaqCore.BLOCKS] - blocks) & 0x3FFFFFFF) * DaqCore.BLOCK
+                blocks = ctrl[DaqCore.BLOCKS]
+                iteration_count += n
+                avg_time = time.ticks_diff(now, loop_timer_time) / n if n else 0.
+                loop_timer_time = now
+                waited = ctrl[DaqCore.WAITED]
+                avg_dt = dts.calculate_average()
+                rate = 1000./avg_dt if avg_dt else 0.
+                print(f"iter {iteration_count}, # {muon_count}, {rate:.1f} Hz, {gc.mem_free()} free, "
+                      f"avg time {avg_time:.4f} ms, queued {len(ring)}, ring overflows {ctrl[DaqCore.OVERFLOWS]}")
+                l1t()
+                if not time_corrected and clock.synced:
+                    time_corrected = True
+                    start_time_sec = clock.epoch_ms(run_start_ticks) // 1000
+                run.check()  # header back-fill, switch to the next segment
+                baseline = tracker.mean
+                rms = tracker.rms()
+                if AUTO_RETUNE:
+                    new_threshold, new_reset = tracker.retune(threshold, reset_threshold)
+                    if new_threshold != threshold:
+                        print(f"baseline {baseline:.1f} rms {rms:.1f}: threshold {threshold} -> {new_threshold}, "
+                              f"reset_threshold {reset_threshold} -> {new_reset}")
+                        threshold, reset_threshold = new_threshold, new_reset
+                if time.ticks_diff(now, tlast) >= 30000:  # rates ring buffer, every 30 seconds
+                    rates.append(round(rate, 2))
+                    tlast = now
+                if time.ticks_diff(now, flushed) >= 100000:
+                    print("flush file, iter ", iteration_count, gc.mem_free())
+                    sd.flush(run.f)
+                    sd.sync()
+                    gc.collect()
+                    flushed = now
+                if not status_task_started:
+                    asyncio.create_task(status_publish_loop(get_status_msg))
+                    status_task_started = True
+            await asyncio.sleep_ms(10)
+        if not DaqCore.stop(ctrl):
+            print("core 1 trigger loop did not stop")
+        while ring.pop_into(rec):
+            sd.write(run.f, ", ".join([str(v) for v in rec]) + "\n")
+        print("dual core loop shutdown, waited is ", ctrl[DaqCore.WAITED], ", ring overflows ", ctrl[DaqCore.OVERFLOWS])
+    else:
+        while True:
+            # poll until a sample crosses the threshold or SCAN_BATCH samples were read
+            t = tus()
+            n = kernel_scan(readout, threshold, SCAN_BATCH, scan_out)
+            live_us += time.ticks_diff(tus(), t)
+            if live_us >= 1000:
+                live_ms = (live_ms + live_us // 1000) & 0x3FFFFFFF
+                live_us %= 1000
+            iteration_count += n
+            if iteration_count >= next_report:
+                rate = 1000./dts.calculate_average()
+                tdiff = time.ticks_diff(tmeas(), loop_timer_time)
+                avg_time = tdiff/(iteration_count - next_report + INNER_ITER_LIMIT)
+                next_report = iteration_count + INNER_ITER_LIMIT
+                print(f"iter {iteration_count}, # {muon_count}, {rate:.1f} Hz, {gc.mem_free()} free, avg time {avg_time:.3f} ms")
+                l1t()
+                if not time_corrected and clock.synced:
+                    time_corrected = True
+                    start_time_sec = clock.epoch_ms(run_start_ticks) // 1000
+                run.check()  # header back-fill, switch to the next segment
+                baseline = tracker.mean
+                rms = tracker.rms()
+                if AUTO_RETUNE:
+                    new_threshold, new_reset = tracker.retune(threshold, reset_threshold)
+                    if new_threshold != threshold:
+                        print(f"baseline {baseline:.1f} rms {rms:.1f}: threshold {threshold} -> {new_threshold}, "
+                              f"reset_threshold {reset_threshold} -> {new_reset}")
+                        threshold, reset_threshold = new_threshold, new_reset
+                loop_timer_time = tmeas()
+                # update rates ring buffer every half minute
+                if time.ticks_diff(loop_timer_time, tlast) >= 30000:  # 30,000 ms = 30 seconds
+                    rates.append(round(rate, 2))
+                    tlast = loop_timer_time
+                if iteration_count >= next_flush:
+                    next_flush = iteration_count + OUTER_ITER_LIMIT
+                    print("flush file, iter ", iteration_count, gc.mem_free())
+                    sd.flush(run.f)
+                    sd.sync()
+                    gc.collect()
+                # Start status publish loop after first INNER_ITER_LIMIT
+                if not status_task_started:
+                    asyncio.create_task(status_publish_loop(get_status_msg))
+                    status_task_started = True
+            adc_value = scan_out[TriggerKernel.LAST]  # last ADC value read (0 - 65535)
+            if scan_out[TriggerKernel.HIT]: # we have a signal
+                l2on()
+                # Get the current time in milliseconds again
+                end_time = tmeas()
+                muon_count += 1
+                wait_counts = 150
+                if not is_leader:
+                    coincidence_pin.value(1)
                 else:
-                    coincidence = 0
-            # wait to drop beneath reset threshold
-            while readout() > reset_threshold:
-                wait_counts = wait_counts - 1
-                tusleep(1)
-                if is_leader and coincidence == 0: # latch value of coincidence
                     if coincidence_pin.value() == 1:
                         coincidence = 1
-                if wait_counts == 0:
-                    waited += 1
-                    break
-            # Calculate elapsed time in milliseconds
-            dt = time.ticks_diff(end_time,start_time)
-            dts.append(dt)
-            temperature_adc_value = temperature_adc.read_u16()
-            start_time = end_time
-            # write to the SD card
-            f.write(f"{muon_count}, {adc_value}, {temperature_adc_value}, {dt}, {end_time}, {wait_counts}, {coincidence}\n")
-            l2off()
-            if not is_leader:
-                coincidence_pin.value(0)
-            # Prepare event message
-            event_data = {
-                'device_number': int(device_id),
-                'muon_count': muon_count,
-                'adc_v': adc_value,
-                'temp_adc_v': temperature_adc_value,
-                'dt': dt,                 # milliseconds between this and previous hit
-                'ts': get_iso8601_timestamp(),  # ISO-8601 UTC wall-clock time (Z)
-                't_ms': end_time,         # monotonic ticks_ms for debugging
-                'wait_cnt': wait_counts,
-                'coincidence': coincidence
-            }
-            if first_event:
-                print("sent first event string")
-                # Add localtime as ISO8601 string
-                lt = time.localtime()
-                event_data['run_start'] = "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}".format(
-                    lt[0], lt[1], lt[2], lt[3], lt[4], lt[5]
-                )
-                # Include run metadata for server-side tracking
-                event_data['baseline'] = int(baseline)
-                event_data['reset_threshold'] = int(reset_threshold)
-                event_data['threshold'] = int(threshold)
-                event_data['is_leader'] = is_leader
-                first_event = False
-            try:
-                event_msg = json.dumps(event_data)
-                safe_publish(MQTT_TOPIC, event_msg)
-                gc.collect()  # Collect after event processing
-            except Exception as e:
-                print("MQTT publish error (event):", e)
-        # Cooperative yield with a budget: only when idle and at most every YIELD_PERIOD_MS
-        if adc_value <= threshold:
-            now_ticks = tmeas()
-            if time.ticks_diff(now_ticks, last_yield) >= YIELD_PERIOD_MS:
+                    else:
+                        coincidence = 0
+                if capture is not None:
+                    capture.start(adc_value)
+                # wait to drop beneath reset threshold
+                while True:
+                    v = readout()
+                    if v <= reset_threshold:
+                        break
+                    if capture is not None:
+                        capture.add(v)
+                    wait_counts = wait_counts - 1
+                    tusleep(1)
+                    if is_leader and coincidence == 0: # latch value of coincidence
+                        if coincidence_pin.value() == 1:
+                            coincidence = 1
+                    if wait_counts == 0:
+                        waited += 1
+                        break
+                if capture is not None:
+                    capture.finish(wait_counts == 0)
+                # Calculate elapsed time in milliseconds
+                dt = time.ticks_diff(end_time,start_time)
+                dts.append(dt)
+                temperature_adc_value = slow.latest[0]  # latest slow-control average
+                coincidences += coincidence
+                start_time = end_time
+                # write to the SD card
+                sd.write(run.f, f"{muon_count}, {adc_value}, {temperature_adc_value}, {dt}, {end_time}, {wait_counts}, {coincidence}"
+                         f"{capture.csv() if capture is not None else ''}\n")
+                l2off()
+                if not is_leader:
+                    coincidence_pin.value(0)
+                publish_event(muon_count, adc_value, temperature_adc_value, dt, end_time, wait_counts, coincidence,
+                              capture.as_dict() if capture is not None else None)
+            elif adc_value < reset_threshold:
+                # idle sample already in hand: one per batch goes to the baseline tracker
+                track(adc_value)
+            # Cooperative yield with a budget: only when idle and at most every YIELD_PERIOD_MS
+            if not scan_out[TriggerKernel.HIT]:
+                now_ticks = tmeas()
+                if time.ticks_diff(now_ticks, last_yield) >= YIELD_PERIOD_MS:
+                    await asyncio.sleep_ms(0)
+                    last_yield = now_ticks
+            if iteration_count >= next_collect:
+                next_collect = iteration_count + 1_000
                 await asyncio.sleep_ms(0)
-                last_yield = now_ticks
-        if iteration_count % 1_000 == 0:
-            await asyncio.sleep_ms(0)
-            gc.collect()  # Collect periodically
-        if shutdown_request or switch_pressed or restart_request:
-            print("tight loop shutdown, waited is ", waited)
-            break
-    f.close()
+                gc.collect()  # Collect periodically
+            if shutdown_request or switch_pressed or restart_request:
+                print("tight loop shutdown, waited is ", waited)
+                break
+    sync_task.cancel()
+    run_task.cancel()
+    slow_task.cancel()
+    if compact_task is not None:
+        compact_task.cancel()
+    slow.flush()
+    run.close()
     hv_power_enable.off()
     print("exiting main loop")
 
@@ -602,13 +778,13 @@ try:
 except KeyboardInterrupt:
     print("keyboard interrupt")
     try:
-        f.close()
+        run.close()
     except Exception:
         pass # ignore errors on file close
 except Exception as e:
     sys.print_exception(e)
     try:
-        f.close()
+        run.close()
     except Exception:
         pass # ignore errors on file close
 unmount_sdcard()
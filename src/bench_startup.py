@@ -0,0 +1,58 @@
+"""Startup and heap benchmark for the firmware modules.
+
+Run on the board with `mpremote run bench_startup.py`. For each module it
+reports the import time and the heap it keeps (gc.mem_free() before and after
+the import). Whether the .py or the precompiled .mpy file was imported is shown
+too; remove one of them from the board to compare the two.
+"""
+import gc
+import sys
+import time
+import uos as os
+
+MODULES = ("RingBuffer", "BaselineTracker", "TimeSync", "RunFile", "SdStats", "TriggerKernel", "SlowControl",
+           "Compactor", "microdot", "WebPages",
+           # imported only with DUAL_CORE, PULSE_CAPTURE or at the first threshold scan
+           "DaqCore", "PulseCapture", "ThresholdScan")
+
+
+def installed_as(name):
+    for suffix in (".py", ".mpy"):
+        try:
+            os.stat(name + suffix)
+            return name + suffix
+        except OSError:
+            pass
+    return "?"
+
+
+def measure(name):
+    gc.collect()
+    before = gc.mem_free()
+    start = time.ticks_us()
+    try:
+        __import__(name)
+    except ImportError as e:
+        print(f"{name:16s} not importable: {e}")
+        return 0
+    elapsed = time.ticks_diff(time.ticks_us(), start)
+    gc.collect()
+    kept = before - gc.mem_free()
+    print(f"{name:16s} {installed_as(name):20s} {elapsed / 1000:8.1f} ms {kept:8d} bytes")
+    return kept
+
+
+def main():
+    gc.collect()
+    start_free = gc.mem_free()
+    print(f"heap free at start: {start_free} bytes")
+    print(f"{'module':16s} {'file':20s} {'import':>11s} {'heap':>14s}")
+    for name in MODULES:
+        if name in sys.modules:
+            del sys.modules[name]
+        measure(name)
+    gc.collect()
+    print(f"heap free after all imports: {gc.mem_free()} bytes ({start_free - gc.mem_free()} bytes used)")
+
+
+main()
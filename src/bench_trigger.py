@@ -0,0 +1,94 @@
+"""Samples/s benchmark of the trigger loop, before and after TriggerKernel.
+
+Run on the board with `mpremote run bench_trigger.py` (TriggerKernel.py or
+.mpy must be on the board), or with python on a laptop, where a constant
+stands in for the ADC. "per sample" is the old loop of asynchio4.py, with the
+counter, modulo checks and flag test on every sample; the others are the
+TriggerKernel.scan versions called in batches of BATCH samples, with the
+bookkeeping once per batch as in the loop now. No pulses are generated, so
+this is the rate at which the baseline is sampled while waiting for one.
+"""
+import array
+import time
+
+import TriggerKernel
+
+try:
+    from machine import ADC, Pin
+    readout = ADC(Pin(26)).read_u16
+except ImportError:  # host
+    def readout():
+        return 800
+
+try:
+    ticks_us = time.ticks_us
+    ticks_diff = time.ticks_diff
+except AttributeError:  # host
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+SAMPLES = 200_000
+BATCH = 64
+THRESHOLD = 65535       # never crossed
+stop_flag = False
+
+
+def per_sample(readout, samples):
+    iteration_count = 0
+    while iteration_count < samples:
+        iteration_count += 1
+        if iteration_count % 400_000 == 0:
+            pass
+        adc_value = readout()
+        if adc_value > THRESHOLD:
+            pass
+        elif adc_value < 0 and not iteration_count & 63:
+            pass
+        if iteration_count % 3_000 == 0:
+            pass
+        if stop_flag:
+            break
+    return iteration_count
+
+
+def batched(scan):
+    def loop(readout, samples):
+        out = array.array('i', [0, 0])
+        iteration_count = 0
+        while iteration_count < samples:
+            iteration_count += scan(readout, THRESHOLD, BATCH, out)
+            if stop_flag:
+                break
+        return iteration_count
+    return loop
+
+
+def measure(name, loop):
+    try:
+        start = ticks_us()
+        n = loop(readout, SAMPLES)
+        elapsed = ticks_diff(ticks_us(), start)
+    except Exception as e:  # e.g. no native code emitter in this firmware
+        print(f"{name:12s} failed: {e}")
+        return 0
+    rate = n * 1000000 / elapsed
+    print(f"{name:12s} {rate:12.0f} samples/s {elapsed / n:8.2f} us/sample")
+    return rate
+
+
+def main():
+    print(f"{SAMPLES} samples, batches of {BATCH}")
+    before = measure("per sample", per_sample)
+    for name, scan in (("scan_py", TriggerKernel.scan_py), ("scan_native", TriggerKernel.scan_native),
+                       ("scan_viper", TriggerKernel.scan_viper)):
+        rate = measure(name, batched(scan))
+        if before and rate:
+            print(f"{'':12s} {rate / before:12.2f} x per sample")
+        if scan is TriggerKernel.scan:
+            print(f"{'':12s} (used by the firmware)")
+
+
+main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""Offline coincidence matching between two or more boards.
+
+In hardware, coincidences are latched by the leader on pin 14, which only works
+for boards that are wired together and only with the fixed window set by the
+follower's pulse length. This tool redoes the matching offline on the event
+timestamps, so any window can be tried and any set of boards can be combined.
+
+Sources are run files (``muon_data_*.csv``, see ``muon_data.py``) or devices in
+an ``ingest.py`` output directory, written as ``DIR:NNN``::
+
+    python coincidence.py run_leader.csv run_follower.csv --window-ms 2
+    python coincidence.py ingest/:001 ingest/:002 ingest/:007 --window-ms 5
+
+The first source is the reference. For every other source each reference event
+is paired with the nearest event within the window (one-to-one), using
+``searchsorted`` over sorted ``int64`` microsecond timestamps, so multi-day runs
+with millions of events match in well under a second. Accidental rates are
+estimated both analytically and by repeating the match with one source shifted
+far out of time.
+"""
+
+from __future__ import annotations
+
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+import muon_data
+
+
+@dataclass
+class Source:
+    """Event times of one board, in microseconds, sorted."""
+
+    name: str
+    t_us: np.ndarray
+    coincidence: Optional[np.ndarray] = None   # hardware coincidence flag, if known
+
+    @property
+    def duration_s(self) -> float:
+        return float(self.t_us[-1] - self.t_us[0]) / 1e6 if len(self.t_us) > 1 else 0.0
+
+    @property
+    def rate_hz(self) -> float:
+        return len(self.t_us) / self.duration_s if self.duration_s > 0 else 0.0
+
+
+def load_source(spec: str) -> Source:
+    """Load a run file, or ``DIR:NNN`` for device NNN of an ingest directory."""
+
+    base, _, device = spec.rpartition(":")
+    if base and device.isdigit() and Path(base).is_dir():
+        from ingest import load_device
+
+        rows, _ = load_device(Path(base), int(device))
+        return Source(spec, rows["ts_us"].astype(np.int64), rows["coincidence"])
+    _, events = muon_data.load_run(spec)
+    events = events[~np.isnat(events["ts"])]
+    t_us = events["ts"].astype(np.int64)
+    order = np.argsort(t_us, kind="stable")
+    return Source(spec, t_us[order], events["coincidence"][order])
+
+
+def nearest_matches(ref: np.ndarray, other: np.ndarray, window_us: int,
+                    shift_us: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Pair events of two sorted time arrays that lie within ``window_us``.
+
+    Each reference event is paired with its nearest neighbour in ``other``
+    (shifted by ``shift_us``); if several reference events claim the same
+    partner, only the closest pair is kept. Returns index arrays into ``ref``
+    and ``other``.
+    """
+
+    if len(ref) == 0 or len(other) == 0:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+    shifted = other + shift_us if shift_us else other
+    pos = np.searchsorted(shifted, ref)
+    left = np.clip(pos - 1, 0, len(other) - 1)
+    right = np.clip(pos, 0, len(other) - 1)
+    d_left = np.abs(ref - shifted[left])
+    d_right = np.abs(ref - shifted[right])
+    partner = np.where(d_right < d_left, right, left)
+    distance = np.minimum(d_left, d_right)
+    ref_idx = np.flatnonzero(distance <= window_us)
+    if len(ref_idx) == 0:
+        return ref_idx, ref_idx
+    partner = partner[ref_idx]
+    # one-to-one: closest reference event wins each partner
+    order = np.lexsort((distance[ref_idx], partner))
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = partner[order][1:] != partner[order][:-1]
+    chosen = np.sort(order[keep])
+    return ref_idx[chosen], partner[chosen]
+
+
+def estimate_offset(ref: np.ndarray, other: np.ndarray, search_us: int, bin_us: int) -> int:
+    """Estimate the clock offset of ``other`` relative to ``ref``.
+
+    Histograms the time differences of all pairs within ``search_us`` and
+    returns the centre of the most populated bin. Useful for boards whose
+    clocks were never synchronized with each other (e.g. legacy files, whose
+    timestamps are anchored on the run start only).
+    """
+
+    lo = np.searchsorted(other, ref - search_us)
+    hi = np.searchsorted(other, ref + search_us, side="right")
+    counts = hi - lo
+    if counts.sum() == 0:
+        return 0
+    # expand (ref, other) pairs without a Python loop
+    ref_rep = np.repeat(ref, counts)
+    starts = np.repeat(lo - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    other_idx = starts + np.arange(counts.sum())
+    diffs = other[other_idx] - ref_rep
+    edges = np.arange(-search_us, search_us + bin_us, bin_us)
+    hist, edges = np.histogram(diffs, bins=edges)
+    peak = int(np.argmax(hist))
+    return -int((edges[peak] + edges[peak + 1]) // 2)
+
+
+def accidental_rate(rates_hz: list[float], window_us: int) -> float:
+    """Analytic accidental rate for the reference plus ``len(rates_hz) - 1`` other boards.
+
+    A reference event makes an accidental k-fold coincidence when every other
+    board happens to fire within +-window, i.e. ``R_ref * prod(2 w R_i)``.
+    """
+
+    window_s = window_us / 1e6
+    rate = rates_hz[0]
+    for other in rates_hz[1:]:
+        rate *= 2 * window_s * other
+    return rate
+
+
+def match(sources: list[Source], window_us: int, offsets_us: list[int], shift_us: int = 0) -> np.ndarray:
+    """Return a ``(n_ref, n_sources)`` array of matched event indices, -1 where unmatched."""
+
+    ref = sources[0].t_us
+    table = np.full((len(ref), len(sources)), -1, dtype=np.int64)
+    table[:, 0] = np.arange(len(ref))
+    for column, (source, offset) in enumerate(zip(sources[1:], offsets_us[1:]), start=1):
+        ref_idx, other_idx = nearest_matches(ref, source.t_us, window_us, offset + shift_us)
+        table[ref_idx, column] = other_idx
+    return table
+
+
+def overlap(sources: list[Source], offsets_us: list[int]) -> tuple[int, int]:
+    start = max(int(s.t_us[0]) + o for s, o in zip(sources, offsets_us))
+    stop = min(int(s.t_us[-1]) + o for s, o in zip(sources, offsets_us))
+    return start, stop
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Match events of several boards within a time window.")
+    parser.add_argument("sources", nargs="+", help="Run files or DIR:NNN ingest devices; the first is the reference")
+    parser.add_argument("--window-ms", type=float, default=1.0, help="Coincidence half-window in ms (default: 1)")
+    parser.add_argument("--offset-ms", type=float, nargs="*", default=None,
+                        help="Clock offset of each non-reference source in ms, added to its times")
+    parser.add_argument("--auto-offset", type=float, default=0.0, metavar="SEARCH_MS",
+                        help="Estimate clock offsets by searching +-SEARCH_MS for the peak of the dt histogram")
+    parser.add_argument("--min-fold", type=int, default=0,
+                        help="Count reference events matched on at least this many boards (default: all)")
+    parser.add_argument("--shifts", type=int, default=10,
+                        help="Number of out-of-time shifts for the measured accidental rate (default: 10)")
+    parser.add_argument("--out", type=Path, default=None, help="Write matched event times to this CSV file")
+    args = parser.parse_args()
+    if len(args.sources) < 2:
+        parser.error("need at least two sources")
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    sources = [load_source(spec) for spec in args.sources]
+    for source in sources:
+        print(f"{source.name}: {len(source.t_us)} events, {source.duration_s:.0f} s, {source.rate_hz:.3f} Hz")
+    if any(len(s.t_us) == 0 for s in sources):
+        raise SystemExit("a source has no events with timestamps")
+
+    window_us = int(args.window_ms * 1000)
+    offsets = [0] * len(sources)
+    if args.offset_ms:
+        for index, value in enumerate(args.offset_ms[: len(sources) - 1], start=1):
+            offsets[index] = int(value * 1000)
+    if args.auto_offset > 0:
+        for index, source in enumerate(sources[1:], start=1):
+            offsets[index] = estimate_offset(sources[0].t_us, source.t_us, int(args.auto_offset * 1000), window_us)
+            print(f"estimated offset of {source.name}: {offsets[index] / 1000:+.3f} ms")
+
+    start, stop = overlap(sources, offsets)
+    live_s = (stop - start) / 1e6
+    if live_s <= 0:
+        raise SystemExit("the sources do not overlap in time")
+    min_fold = args.min_fold or len(sources)
+
+    table = match(sources, window_us, offsets)
+    in_overlap = (sources[0].t_us >= start) & (sources[0].t_us <= stop)
+    fold = (table >= 0).sum(axis=1)
+    selected = in_overlap & (fold >= min_fold)
+    n_coinc = int(selected.sum())
+    print(f"overlap {live_s:.0f} s, window +-{args.window_ms} ms: "
+          f"{n_coinc} events with >= {min_fold}-fold coincidence, {n_coinc / live_s:.4f} Hz")
+    for column, source in enumerate(sources[1:], start=1):
+        pairs = int((in_overlap & (table[:, column] >= 0)).sum())
+        print(f"  {sources[0].name} x {source.name}: {pairs} pairs, {pairs / live_s:.4f} Hz")
+
+    rates = [float(((s.t_us + o >= start) & (s.t_us + o <= stop)).sum()) / live_s for s, o in zip(sources, offsets)]
+    if min_fold == len(sources):
+        print(f"accidental rate (analytic): {accidental_rate(rates, window_us):.6f} Hz")
+    if args.shifts > 0:
+        # shift far beyond any real correlation, but small compared to the overlap
+        step = max(100 * window_us, 1_000_000)
+        shifted_counts = []
+        for k in range(1, args.shifts + 1):
+            shifted = match(sources, window_us, offsets, shift_us=k * step)
+            shifted_counts.append(int((in_overlap & ((shifted >= 0).sum(axis=1) >= min_fold)).sum()))
+        mean = float(np.mean(shifted_counts))
+        print(f"accidental rate (measured over {args.shifts} shifts): {mean / live_s:.6f} Hz "
+              f"+- {np.sqrt(mean / args.shifts) / live_s:.6f} Hz")
+
+    hardware = sources[0].coincidence
+    if hardware is not None and n_coinc:
+        print(f"hardware coincidence flag set on {int(hardware[selected].sum())} of {n_coinc} "
+              f"offline coincidences ({int(hardware[in_overlap].sum())} flagged in total)")
+
+    if args.out is not None:
+        columns = [np.where(table[selected, c] >= 0, sources[c].t_us[table[selected, c]], -1)
+                   for c in range(len(sources))]
+        header = ",".join(f"t_us_{c}" for c in range(len(sources)))
+        np.savetxt(args.out, np.column_stack(columns), fmt="%d", delimiter=",", header=header, comments="")
+        print(f"wrote {n_coinc} matches to {args.out}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Convert ``muon_data_*.csv`` runs to Parquet or Arrow files, incrementally.
+
+Every analysis session used to parse the raw CSVs again. This converter writes
+each run once to a typed columnar file (``muon_data.EVENT_DTYPE`` columns, the
+``ts`` column as a UTC timestamp) with the run metadata embedded in the schema
+metadata under the key ``cuwatch``::
+
+    python convert_runs.py /path/to/archive --out converted/
+
+A manifest (``<out>/manifest.json``) records the SHA-256 of the content of each
+converted CSV. On the next run, files whose content hash is already in the
+manifest are skipped, so only new or changed runs (for example a run that was
+still being written) are converted. Files are hashed only when their size or
+modification time changed since the last pass.
+
+Runs compacted on the board (``.csv.gz``) are converted too, to the same output
+name as their ``.csv``; they are hashed by their uncompressed content, so a run
+converted before it was compacted is not converted again.
+
+Needs ``pyarrow``. Converted runs are read back with ``read_converted``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+import muon_data
+
+try:
+    import pyarrow as pa  # type: ignore[import-not-found]
+    import pyarrow.feather as feather  # type: ignore[import-not-found]
+    import pyarrow.parquet as pq  # type: ignore[import-not-found]
+except ImportError:
+    pa = None
+
+MANIFEST_NAME = "manifest.json"
+HASH_BLOCK = 1 << 20
+
+
+def content_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with muon_data.open_run(path) as fp:   # a .csv.gz hashes like the .csv it was compressed from
+        for block in iter(lambda: fp.read(HASH_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def header_metadata(header: muon_data.RunHeader, source: Path, digest: str) -> dict[str, Any]:
+    """Run metadata as a JSON-serializable dict."""
+
+    meta: dict[str, Any] = {}
+    for item in dataclasses.fields(header):
+        value = getattr(header, item.name)
+        if isinstance(value, Path):
+            value = value.name
+        elif hasattr(value, "isoformat"):
+            value = value.isoformat()
+        elif isinstance(value, tuple):
+            value = list(value)
+        meta[item.name] = value
+    meta["source"] = source.name
+    meta["sha256"] = digest
+    return meta
+
+
+def arrow_schema(meta: dict[str, Any]):
+    fields = []
+    for name in muon_data.EVENT_DTYPE.names:
+        if name == "ts":
+            fields.append(pa.field(name, pa.timestamp("us", tz="UTC")))
+        else:
+            fields.append(pa.field(name, pa.from_numpy_dtype(muon_data.EVENT_DTYPE[name])))
+    return pa.schema(fields, metadata={"cuwatch": json.dumps(meta)})
+
+
+def events_to_batch(events: np.ndarray, schema):
+    arrays = []
+    for field in schema:
+        column = events[field.name]
+        if field.name == "ts":
+            column = column.astype(np.int64)
+            arrays.append(pa.array(column, type=field.type, mask=column == np.iinfo(np.int64).min))
+        else:
+            arrays.append(pa.array(column, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def convert_run(source: Path, target: Path, digest: str, fmt: str, chunk_bytes: int = 16 << 20) -> int:
+    """Convert one run chunk by chunk; returns the number of events written."""
+
+    header = muon_data.read_header(source)
+    schema = arrow_schema(header_metadata(header, source, digest))
+    tmp = target.with_name(target.name + ".tmp")
+    count = 0
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(tmp, schema, compression="zstd")
+    else:
+        sink = pa.OSFile(str(tmp), "wb")
+        writer = pa.ipc.new_file(sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+    try:
+        for _, events in muon_data.iter_chunks(source, chunk_bytes):
+            if len(events):
+                writer.write_batch(events_to_batch(events, schema))
+                count += len(events)
+    except BaseException:
+        writer.close()
+        if fmt != "parquet":
+            sink.close()
+        tmp.unlink()
+        raise
+    writer.close()
+    if fmt != "parquet":
+        sink.close()
+    os.replace(tmp, target)
+    return count
+
+
+def read_converted(path: Path) -> tuple[dict[str, Any], np.ndarray]:
+    """Read a converted run back into ``(metadata, muon_data.EVENT_DTYPE array)``."""
+
+    path = Path(path)
+    table = pq.read_table(path) if path.suffix == ".parquet" else feather.read_table(path)
+    meta = json.loads((table.schema.metadata or {}).get(b"cuwatch", b"{}"))
+    events = np.zeros(table.num_rows, dtype=muon_data.EVENT_DTYPE)
+    for name in muon_data.EVENT_DTYPE.names:
+        if name not in table.column_names:  # converted before the column existed
+            continue
+        column = table.column(name)
+        if name == "ts":
+            column = column.cast(pa.int64()).fill_null(np.iinfo(np.int64).min)
+            events[name] = column.to_numpy().astype("datetime64[us]")
+        else:
+            events[name] = column.to_numpy()
+    return meta, events
+
+
+def load_manifest(out_dir: Path) -> dict[str, Any]:
+    path = out_dir / MANIFEST_NAME
+    if not path.exists():
+        return {"version": 1, "files": {}, "hashes": {}}
+    with open(path, encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def save_manifest(out_dir: Path, manifest: dict[str, Any]) -> None:
+    path = out_dir / MANIFEST_NAME
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def sync_archive(archive: Path, out_dir: Path, fmt: str = "parquet",
+                 patterns: tuple[str, ...] = muon_data.RUN_PATTERNS) -> dict[str, int]:
+    """Convert every new or changed run under ``archive``; returns counters."""
+
+    if pa is None:
+        raise SystemExit("Conversion needs pyarrow. Install it with `pip install pyarrow`.")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(out_dir)
+    files: dict[str, Any] = manifest["files"]      # relative source path -> stat and hash
+    hashes: dict[str, Any] = manifest["hashes"]    # content hash -> converted file
+    suffix = ".parquet" if fmt == "parquet" else ".arrow"
+    counters = {"converted": 0, "unchanged": 0, "failed": 0, "events": 0}
+    for source in muon_data.find_runs(archive, patterns, recursive=True):
+        rel = source.relative_to(archive).as_posix()
+        st = source.stat()
+        entry = files.get(rel)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            digest = entry["sha256"]
+        else:
+            digest = content_hash(source)
+        done = hashes.get(digest)
+        if done and done["format"] == fmt and (out_dir / done["output"]).exists():
+            counters["unchanged"] += 1
+        else:
+            target = out_dir / Path(rel).with_name(muon_data.run_stem(source) + suffix)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            start = time.perf_counter()
+            try:
+                count = convert_run(source, target, digest, fmt)
+            except ValueError as exc:
+                print(f"{rel}: not converted: {exc}")
+                counters["failed"] += 1
+                continue
+            print(f"{rel}: {count} events in {time.perf_counter() - start:.2f} s -> {target.relative_to(out_dir)}")
+            if entry and entry["sha256"] != digest:
+                # drop the stale conversion unless another file has the same old content
+                old = entry["sha256"]
+                if not any(other["sha256"] == old for name, other in files.items() if name != rel):
+                    hashes.pop(old, None)
+            hashes[digest] = {"output": target.relative_to(out_dir).as_posix(), "format": fmt, "events": count}
+            counters["converted"] += 1
+            counters["events"] += count
+        files[rel] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+        # save as we go so an interrupted pass keeps its progress
+        save_manifest(out_dir, manifest)
+    return counters
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Convert run CSVs to Parquet/Arrow, skipping runs already converted.")
+    parser.add_argument("archive", type=Path, help="Directory searched recursively for run files")
+    parser.add_argument("--out", type=Path, default=Path("converted"), help="Output directory (default: ./converted)")
+    parser.add_argument("--format", choices=("parquet", "arrow"), default="parquet", help="Output format")
+    parser.add_argument("--pattern", action="append", dest="patterns",
+                        help="Run file glob, can be repeated (default: muon_data_*.csv and muon_data_*.csv.gz)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    counters = sync_archive(args.archive, args.out, args.format, tuple(args.patterns or muon_data.RUN_PATTERNS))
+    print(f"{counters['converted']} converted ({counters['events']} events), "
+          f"{counters['unchanged']} unchanged, {counters['failed']} failed")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Copy the run files of a board to a local directory in one request.
+
+Downloads the ``/archive`` of a board running ``asynchio4.py`` and unpacks it
+while it arrives::
+
+    python harvest.py http://192.168.1.42 -o runs/board1
+    python harvest.py http://192.168.1.42 --from muon_data_20241101 --to muon_data_20241107
+
+The tar archive (gzipped with ``--compress``) is extracted as a stream, so
+nothing but the run files is written. ``--zip`` saves the zip archive next to
+the files and extracts it afterwards. Files that already exist with the same
+size are left alone unless ``--overwrite`` is given; the segment the board is
+still writing will differ and is replaced. Runs the board has compacted
+(``.csv.gz``) are unpacked to ``.csv`` unless ``--keep-gz`` is given.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import shutil
+import tarfile
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+from pathlib import Path
+from typing import Optional
+
+
+def archive_url(base: str, fmt: str = "tar", compress: bool = False, first: Optional[str] = None,
+                last: Optional[str] = None, files: Optional[list[str]] = None, sidecars: bool = True) -> str:
+    query = {"format": fmt}
+    if compress:
+        query["compress"] = "1"
+    if first:
+        query["from"] = first
+    if last:
+        query["to"] = last
+    if files:
+        query["files"] = ",".join(files)
+    if not sidecars:
+        query["sidecars"] = "0"
+    return base.rstrip("/") + "/archive?" + urllib.parse.urlencode(query)
+
+
+def _keep(target: Path, size: int, overwrite: bool) -> bool:
+    return not overwrite and target.exists() and target.stat().st_size == size
+
+
+def _save(src, out: Path, name: str, size: int, overwrite: bool, gunzip: bool) -> Optional[str]:
+    """Write one archive member to out; return the name written, None if an identical file exists"""
+    if gunzip and name.endswith(".csv.gz"):
+        # the size of the CSV is only known after unpacking it
+        name = name[:-3]
+        part = out / (name + ".part")
+        with gzip.GzipFile(fileobj=src) as unpacked, open(part, "wb") as dst:
+            shutil.copyfileobj(unpacked, dst)
+        if _keep(out / name, part.stat().st_size, overwrite):
+            part.unlink()
+            return None
+        part.replace(out / name)
+        return name
+    if _keep(out / name, size, overwrite):
+        return None
+    with open(out / name, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    return name
+
+
+def extract_tar(stream, out: Path, overwrite: bool = False, gunzip: bool = True) -> list[str]:
+    written = []
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = Path(member.name).name      # flat archive; never write outside `out`
+            with tar.extractfile(member) as src:
+                name = _save(src, out, name, member.size, overwrite, gunzip)
+            if name:
+                written.append(name)
+    return written
+
+
+def extract_zip(stream, out: Path, overwrite: bool = False, gunzip: bool = True) -> list[str]:
+    path = out / "cuwatch_runs.zip"
+    with open(path, "wb") as fp:
+        shutil.copyfileobj(stream, fp)
+    written = []
+    with zipfile.ZipFile(path) as z:
+        for info in z.infolist():
+            with z.open(info) as src:
+                name = _save(src, out, Path(info.filename).name, info.file_size, overwrite, gunzip)
+            if name:
+                written.append(name)
+    return written
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Download the run files of a board as one archive.")
+    parser.add_argument("board", help="Board URL, e.g. http://192.168.1.42")
+    parser.add_argument("-o", "--out", type=Path, default=Path("."), help="Output directory (default: .)")
+    parser.add_argument("--from", dest="first", help="First run name (prefix, inclusive)")
+    parser.add_argument("--to", dest="last", help="Last run name (prefix, inclusive)")
+    parser.add_argument("--files", nargs="+", help="Only these run files")
+    parser.add_argument("--no-sidecars", action="store_true", help="Skip .sd.json and .slow.csv files")
+    parser.add_argument("--zip", action="store_true", help="Ask for a zip instead of a tar archive")
+    parser.add_argument("--compress", action="store_true", help="Compress on the board (slower on the board, "
+                                                                "faster over a slow link)")
+    parser.add_argument("--overwrite", action="store_true", help="Replace files that exist with the same size")
+    parser.add_argument("--keep-gz", action="store_true", help="Save compacted runs as .csv.gz, do not unpack them")
+    parser.add_argument("--timeout", type=float, default=60, help="Socket timeout in seconds (default: 60)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    fmt = "zip" if args.zip else "tar"
+    url = archive_url(args.board, fmt, args.compress, args.first, args.last, args.files, not args.no_sidecars)
+    args.out.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=args.timeout) as resp:
+        extract = extract_zip if args.zip else extract_tar
+        written = extract(resp, args.out, args.overwrite, not args.keep_gz)
+    elapsed = time.perf_counter() - start
+    size = sum((args.out / name).stat().st_size for name in written)
+    print(f"{len(written)} files, {size / 1e6:.1f} MB in {elapsed:.1f} s -> {args.out}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
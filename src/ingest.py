@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+"""Host-side MQTT ingestion service for CuWatch boards.
+
+Subscribes to ``telemetry/+`` and ``status/+``, decodes the JSON messages that
+``asynchio5.py`` publishes and buffers them in memory per device. Buffers are
+flushed in batches to a columnar store on local disk::
+
+    <out>/telemetry/device=003/part-20250101T120000-000001.parquet
+    <out>/status/device=003/part-20250101T120000-000002.parquet
+
+Parquet is used when ``pyarrow`` is installed, NumPy ``.npz`` partitions
+otherwise. Run metadata sent with the first event of a run is embedded in each
+partition. The service prints its throughput and ingest lag (receive time minus
+the board's event timestamp) at a fixed interval.
+
+For testing, the service can be attached to ``local_broker.LocalBroker``
+instead of a real broker, see ``IngestService.attach``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+try:
+    import pyarrow as pa  # type: ignore[import-not-found]
+    import pyarrow.parquet as pq  # type: ignore[import-not-found]
+except ImportError:
+    pa = None
+    pq = None
+
+TELEMETRY_TOPIC = "telemetry/+"
+STATUS_TOPIC = "status/+"
+
+TELEMETRY_DTYPE = np.dtype([
+    ("muon_count", "<i8"),
+    ("adc_v", "<u2"),
+    ("temp_adc_v", "<u2"),
+    ("dt", "<i8"),
+    ("t_ms", "<i8"),
+    ("wait_cnt", "<i2"),
+    ("coincidence", "u1"),
+    ("ts_us", "<i8"),    # board wall-clock time, microseconds since the epoch (UTC)
+    ("recv_us", "<i8"),  # host receive time, microseconds since the epoch (UTC)
+])
+
+STATUS_DTYPE = np.dtype([
+    ("rate", "<f8"),
+    ("muon_count", "<i8"),
+    ("threshold", "<i4"),
+    ("reset_threshold", "<i4"),
+    ("baseline", "<f8"),
+    ("runtime", "<f8"),
+    ("is_leader", "u1"),
+    ("avg_time_ms", "<f8"),
+    ("recv_us", "<i8"),
+])
+
+# keys of the first event of a run that describe the run rather than the event
+RUN_METADATA_KEYS = ("run_start", "run_start_ticks_ms", "time_sync", "baseline", "threshold", "reset_threshold",
+                     "is_leader")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_timestamp_us(value: str) -> int:
+    """Convert an ISO-8601 timestamp to integer microseconds since the epoch.
+
+    Naive timestamps are taken to be UTC, which is what the boards send.
+    """
+
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    stamp = datetime.fromisoformat(value)
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=timezone.utc)
+    delta = stamp - _EPOCH
+    return (delta.days * 86_400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def device_from_topic(topic: str) -> int:
+    """Return the device number encoded in the last topic level, e.g. ``telemetry/003``."""
+
+    return int(topic.rsplit("/", 1)[-1])
+
+
+def decode_telemetry(data: dict[str, Any], recv_us: int) -> tuple:
+    """Turn one decoded telemetry message into a ``TELEMETRY_DTYPE`` row."""
+
+    ts = data.get("ts")
+    ts_us = parse_timestamp_us(ts) if ts else recv_us
+    # test_client.py sends ``end_time`` in place of the board's ``t_ms``
+    t_ms = data.get("t_ms", data.get("end_time", 0))
+    return (
+        int(data.get("muon_count", 0)),
+        int(data.get("adc_v", 0)),
+        int(data.get("temp_adc_v", 0)),
+        int(data.get("dt", 0)),
+        int(t_ms),
+        int(data.get("wait_cnt", 0)),
+        int(bool(data.get("coincidence", 0))),
+        ts_us,
+        recv_us,
+    )
+
+
+def decode_status(data: dict[str, Any], recv_us: int) -> tuple:
+    """Turn one decoded status message into a ``STATUS_DTYPE`` row."""
+
+    return (
+        float(data.get("rate", 0.0)),
+        int(data.get("muon_count", 0)),
+        int(data.get("threshold", 0)),
+        int(data.get("reset_threshold", 0)),
+        float(data.get("baseline", 0.0)),
+        float(data.get("runtime", 0.0)),
+        int(bool(data.get("is_leader", False))),
+        float(data.get("avg_time_ms", 0.0)),
+        recv_us,
+    )
+
+
+class DeviceBuffer:
+    """Rows waiting to be flushed for one device and message kind."""
+
+    __slots__ = ("rows", "first_recv", "meta")
+
+    def __init__(self) -> None:
+        self.rows: list[tuple] = []
+        self.first_recv = 0.0
+        self.meta: dict[str, Any] = {}
+
+
+class IngestStats:
+    """Counters for the periodic throughput and lag report."""
+
+    def __init__(self) -> None:
+        self.events = 0
+        self.status = 0
+        self.errors = 0
+        self.lag_sum_us = 0
+        self.lag_max_us = 0
+        self.partitions = 0
+        self.rows_written = 0
+
+    def reset_window(self) -> None:
+        self.events = 0
+        self.status = 0
+        self.errors = 0
+        self.lag_sum_us = 0
+        self.lag_max_us = 0
+
+
+def write_partition(path: Path, rows: np.ndarray, meta: dict[str, Any], fmt: str) -> Path:
+    """Write ``rows`` as one columnar partition and return the final path.
+
+    The file is written under a temporary name and renamed into place so that
+    readers never see a partially written partition.
+    """
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    meta_json = json.dumps(meta)
+    if fmt == "parquet":
+        final = path.with_suffix(".parquet")
+        tmp = final.with_name(final.name + ".tmp")
+        table = pa.table({name: rows[name] for name in rows.dtype.names})
+        table = table.replace_schema_metadata({"cuwatch": meta_json})
+        pq.write_table(table, tmp)
+    else:
+        final = path.with_suffix(".npz")
+        tmp = final.with_name(final.name + ".tmp")
+        columns = {name: rows[name] for name in rows.dtype.names}
+        with open(tmp, "wb") as fp:
+            np.savez(fp, meta=np.array(meta_json), **columns)
+    os.replace(tmp, final)
+    return final
+
+
+def read_partition(path: Path, dtype: np.dtype) -> tuple[np.ndarray, dict[str, Any]]:
+    """Read one partition written by ``write_partition``."""
+
+    if path.suffix == ".parquet":
+        table = pq.read_table(path)
+        raw_meta = (table.schema.metadata or {}).get(b"cuwatch", b"{}")
+        rows = np.empty(table.num_rows, dtype=dtype)
+        for name in dtype.names:
+            rows[name] = table.column(name).to_numpy()
+        return rows, json.loads(raw_meta)
+    with np.load(path) as npz:
+        rows = np.empty(len(npz[dtype.names[0]]), dtype=dtype)
+        for name in dtype.names:
+            rows[name] = npz[name]
+        return rows, json.loads(str(npz["meta"]))
+
+
+def load_device(root: Path, device: int, kind: str = "telemetry") -> tuple[np.ndarray, list[dict[str, Any]]]:
+    """Load every partition of one device, ordered by board timestamp.
+
+    Returns the concatenated rows and the list of distinct run metadata blocks.
+    """
+
+    dtype = TELEMETRY_DTYPE if kind == "telemetry" else STATUS_DTYPE
+    directory = Path(root) / kind / f"device={device:03d}"
+    parts = []
+    metas: list[dict[str, Any]] = []
+    for path in sorted(directory.glob("part-*")):
+        if path.suffix not in (".npz", ".parquet"):
+            continue
+        rows, meta = read_partition(path, dtype)
+        parts.append(rows)
+        if meta and meta not in metas:
+            metas.append(meta)
+    if not parts:
+        return np.empty(0, dtype=dtype), metas
+    rows = np.concatenate(parts)
+    key = "ts_us" if kind == "telemetry" else "recv_us"
+    return rows[np.argsort(rows[key], kind="stable")], metas
+
+
+class IngestService:
+    """Buffer decoded MQTT messages per device and flush them in batches."""
+
+    def __init__(
+        self,
+        out_dir: Path,
+        fmt: str = "auto",
+        flush_events: int = 5000,
+        flush_interval: float = 10.0,
+    ) -> None:
+        if fmt == "auto":
+            fmt = "parquet" if pa is not None else "npz"
+        if fmt == "parquet" and pa is None:
+            raise SystemExit("Parquet output needs pyarrow. Install it with `pip install pyarrow` or use --format npz.")
+        self.out_dir = Path(out_dir)
+        self.fmt = fmt
+        self.flush_events = flush_events
+        self.flush_interval = flush_interval
+        self.stats = IngestStats()
+        self._lock = threading.Lock()
+        self._buffers: dict[tuple[str, int], DeviceBuffer] = {}
+        # buffers closed early (run boundary) and waiting for the next flush
+        self._detached: list[tuple[tuple[str, int], DeviceBuffer]] = []
+        self._run_meta: dict[int, dict[str, Any]] = {}
+        self._sequence = 0
+
+    # -- message intake ---------------------------------------------------
+    def on_message(self, topic: str, payload: bytes, recv_us: Optional[int] = None) -> None:
+        """Decode one message and append it to its device buffer."""
+
+        if recv_us is None:
+            recv_us = now_us()
+        try:
+            kind = topic.split("/", 1)[0]
+            device = device_from_topic(topic)
+            data = json.loads(payload)
+            if kind == "telemetry":
+                row = decode_telemetry(data, recv_us)
+            elif kind == "status":
+                row = decode_status(data, recv_us)
+            else:
+                return
+        except (ValueError, TypeError, KeyError) as exc:
+            with self._lock:
+                self.stats.errors += 1
+            print(f"Dropping undecodable message on {topic}: {exc}")
+            return
+
+        with self._lock:
+            if kind == "telemetry":
+                self.stats.events += 1
+                lag = recv_us - row[7]
+                self.stats.lag_sum_us += lag
+                if lag > self.stats.lag_max_us:
+                    self.stats.lag_max_us = lag
+                if "run_start" in data:
+                    self._start_run(device, data)
+            else:
+                self.stats.status += 1
+            buffer = self._buffers.get((kind, device))
+            if buffer is None:
+                buffer = self._buffers[(kind, device)] = DeviceBuffer()
+            if not buffer.rows:
+                buffer.first_recv = time.monotonic()
+                buffer.meta = self._run_meta.get(device, {})
+            buffer.rows.append(row)
+
+    def _start_run(self, device: int, data: dict[str, Any]) -> None:
+        """Record run metadata; events of a previous run are flushed separately."""
+
+        meta = {key: data[key] for key in RUN_METADATA_KEYS if key in data}
+        meta["device_number"] = device
+        self._run_meta[device] = meta
+        buffer = self._buffers.get(("telemetry", device))
+        if buffer is not None and buffer.rows and buffer.meta != meta:
+            self._detached.append((("telemetry", device), buffer))
+            self._buffers[("telemetry", device)] = DeviceBuffer()
+
+    # -- flushing -----------------------------------------------------------
+    def flush_due(self, force: bool = False) -> int:
+        """Write out buffers that are full, older than the flush interval, or all if ``force``.
+
+        Returns the number of rows written.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            ready = self._detached
+            self._detached = []
+            for key, buffer in list(self._buffers.items()):
+                if not buffer.rows:
+                    continue
+                if force or len(buffer.rows) >= self.flush_events or now - buffer.first_recv >= self.flush_interval:
+                    ready.append((key, buffer))
+                    self._buffers[key] = DeviceBuffer()
+        written = 0
+        for (kind, device), buffer in ready:
+            dtype = TELEMETRY_DTYPE if kind == "telemetry" else STATUS_DTYPE
+            rows = np.array(buffer.rows, dtype=dtype)
+            self._sequence += 1
+            stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+            path = self.out_dir / kind / f"device={device:03d}" / f"part-{stamp}-{self._sequence:06d}"
+            meta = dict(buffer.meta, kind=kind, device_number=device)
+            write_partition(path, rows, meta, self.fmt)
+            written += len(rows)
+        with self._lock:
+            self.stats.partitions += len(ready)
+            self.stats.rows_written += written
+        return written
+
+    def buffered(self) -> tuple[int, float]:
+        """Return the number of buffered rows and the age of the oldest one in seconds."""
+
+        now = time.monotonic()
+        with self._lock:
+            count = 0
+            oldest = 0.0
+            for buffer in self._buffers.values():
+                if buffer.rows:
+                    count += len(buffer.rows)
+                    oldest = max(oldest, now - buffer.first_recv)
+            return count, oldest
+
+    def report(self, elapsed: float) -> str:
+        """Return a one-line throughput/lag summary and start a new reporting window."""
+
+        count, oldest = self.buffered()
+        with self._lock:
+            s = self.stats
+            mean_lag = s.lag_sum_us / s.events / 1000 if s.events else 0.0
+            line = (
+                f"{s.events / elapsed:.0f} events/s, {s.status / elapsed:.1f} status/s, "
+                f"lag mean {mean_lag:.1f} ms max {s.lag_max_us / 1000:.1f} ms, "
+                f"buffered {count} (oldest {oldest:.1f} s), "
+                f"{s.partitions} partitions / {s.rows_written} rows written, {s.errors} errors"
+            )
+            s.reset_window()
+        return line
+
+    # -- transports ---------------------------------------------------------
+    def attach(self, broker) -> None:
+        """Subscribe to a ``local_broker.LocalBroker`` (or anything with the same API)."""
+
+        broker.subscribe(TELEMETRY_TOPIC, self.on_message)
+        broker.subscribe(STATUS_TOPIC, self.on_message)
+
+    def run_mqtt(self, host: str, port: int, report_interval: float = 10.0) -> None:
+        """Connect to a real broker with paho-mqtt and ingest until interrupted."""
+
+        client = make_mqtt_client("cuwatch-ingest")
+
+        def _on_connect(client, userdata, flags, rc, properties=None):
+            print(f"Connected to {host}:{port} ({rc}), subscribing to {TELEMETRY_TOPIC} and {STATUS_TOPIC}")
+            client.subscribe([(TELEMETRY_TOPIC, 0), (STATUS_TOPIC, 0)])
+
+        def _on_message(client, userdata, msg):
+            self.on_message(msg.topic, msg.payload)
+
+        client.on_connect = _on_connect
+        client.on_message = _on_message
+        client.connect(host, port, 30)
+        client.loop_start()
+        last_report = time.monotonic()
+        try:
+            while True:
+                time.sleep(0.1)
+                self.flush_due()
+                now = time.monotonic()
+                if now - last_report >= report_interval:
+                    print(self.report(now - last_report))
+                    last_report = now
+        except KeyboardInterrupt:
+            print("Exiting...")
+        finally:
+            client.loop_stop()
+            client.disconnect()
+            self.flush_due(force=True)
+
+
+def make_mqtt_client(client_id: str = ""):
+    """Create a paho-mqtt client on either the 1.x or the 2.x API."""
+
+    import paho.mqtt.client as mqtt  # type: ignore[import-not-found]
+
+    try:
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+    except AttributeError:  # paho-mqtt < 2.0
+        return mqtt.Client(client_id=client_id)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Ingest CuWatch MQTT telemetry into columnar files.")
+    parser.add_argument("--host", default="localhost", help="MQTT broker host (default: localhost)")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port (default: 1883)")
+    parser.add_argument("--out", type=Path, default=Path("ingest"), help="Output directory (default: ./ingest)")
+    parser.add_argument("--format", choices=("auto", "parquet", "npz"), default="auto",
+                        help="Partition format; auto picks parquet when pyarrow is installed")
+    parser.add_argument("--flush-events", type=int, default=5000,
+                        help="Flush a device buffer once it holds this many rows (default: 5000)")
+    parser.add_argument("--flush-interval", type=float, default=10.0,
+                        help="Flush a device buffer once its oldest row is this many seconds old (default: 10)")
+    parser.add_argument("--report-interval", type=float, default=10.0,
+                        help="Seconds between throughput/lag reports (default: 10)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    service = IngestService(args.out, args.format, args.flush_events, args.flush_interval)
+    print(f"Writing {service.fmt} partitions to {service.out_dir}")
+    service.run_mqtt(args.host, args.port, args.report_interval)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -15,6 +15,19 @@ trap {
 $Files = @(
     "styles.css",
     "RingBuffer.mpy",
+    "BaselineTracker.mpy",
+    "TimeSync.mpy",
+    "RunFile.mpy",
+    "SlowControl.mpy",
+    "ThresholdScan.mpy",
+    "Compactor.mpy",
+    "SdStats.mpy",
+    "DaqCore.mpy",
+    "TriggerKernel.mpy",
+    "PulseCapture.mpy",
+    "WebPages.mpy",
+    "RunArchive.mpy",
+    "RunExport.mpy",
     "boot.py",
     "my_secrets.py"
 )
@@ -22,16 +35,42 @@ $Files = @(
 $MainFile = "asynchio4.py"
 
 # ---------------------------------------------------------------------------
-# Compile the RingBuffer module - creates RingBuffer.mpy
+# Compile the modules - creates RingBuffer.mpy etc.
 # ---------------------------------------------------------------------------
-if (Test-Path "RingBuffer.py") {
-    Write-Host "Compiling RingBuffer.py -> RingBuffer.mpy"
-    & mpy-cross "RingBuffer.py"
+$Modules = @(
+    "RingBuffer",
+    "BaselineTracker",
+    "TimeSync",
+    "RunFile",
+    "SlowControl",
+    "ThresholdScan",
+    "Compactor",
+    "SdStats",
+    "DaqCore",
+    "PulseCapture",
+    "WebPages",
+    "RunArchive"
+)
+
+foreach ($m in $Modules) {
+    if (Test-Path "$m.py") {
+        Write-Host "Compiling $m.py -> $m.mpy"
+        & mpy-cross "$m.py"
+        if ($LASTEXITCODE -ne 0) {
+            throw "mpy-cross failed for $m.py (exit code $LASTEXITCODE)"
+        }
+    } else {
+        throw "$m.py not found in the current directory."
+    }
+}
+
+# native (viper) code, compiled for the Cortex-M0+ of the RP2040
+foreach ($m in @("TriggerKernel", "RunExport")) {
+    Write-Host "Compiling $m.py -> $m.mpy"
+    & mpy-cross -march=armv6m "$m.py"
     if ($LASTEXITCODE -ne 0) {
-        throw "mpy-cross failed for RingBuffer.py (exit code $LASTEXITCODE)"
+        throw "mpy-cross failed for $m.py (exit code $LASTEXITCODE)"
     }
-} else {
-    throw "RingBuffer.py not found in the current directory."
 }
 
 # ---------------------------------------------------------------------------
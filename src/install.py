@@ -10,7 +10,11 @@ from __future__ import annotations
 
 import argparse
 import base64
+import binascii
+import hashlib
 import os
+import shutil
+import subprocess
 import sys
 import tarfile
 import textwrap
@@ -117,20 +121,58 @@ except ImportError:
                     err_text = err[:-1].decode("utf-8", errors="replace") if err else ""
                     raise RuntimeError(f"Execution failed: status {status!r} {err_text} {prompt}")
 
+                def _raw_paste_write(self, payload: bytes) -> None:
+                    # the board grants a window of bytes and sends 0x01 for each further window
+                    window = int.from_bytes(self.serial.read(2), "little")
+                    remain = window
+                    offset = 0
+                    while offset < len(payload):
+                        while remain == 0 or self.serial.in_waiting:
+                            flag = self.serial.read(1)
+                            if flag == b"\x01":
+                                remain += window
+                            elif flag == b"\x04":  # board aborted the paste
+                                self.write(b"\x04")
+                                return
+                            else:
+                                raise RuntimeError(f"Unexpected byte during raw paste: {flag!r}")
+                        piece = payload[offset : offset + remain]
+                        self.write(piece)
+                        remain -= len(piece)
+                        offset += len(piece)
+                    self.write(b"\x04")
+                    if not self._read_until(1, b"\x04", timeout=5.0).endswith(b"\x04"):
+                        raise RuntimeError("Board did not acknowledge the end of the raw paste")
+
+                def exec_raw_no_follow(self, command: str | bytes) -> None:
+                    """Start ``command`` without waiting for its output (raw-paste mode if supported)."""
+
+                    payload = command.encode("utf-8") if isinstance(command, str) else command
+                    self.write(b"\x05A\x01")
+                    reply = self.serial.read(2)
+                    if reply == b"R\x01":
+                        self._raw_paste_write(payload)
+                        return
+                    if reply != b"R\x00":
+                        # raw-paste unknown: the board prints the raw REPL banner again
+                        self._read_until(1, b">", timeout=2.0)
+                    for offset in range(0, len(payload), 256):
+                        self.write(payload[offset : offset + 256])
+                        time.sleep(0.01)
+                    self.write(b"\x04")
+                    if not self._read_until(2, b"OK", timeout=5.0).endswith(b"OK"):
+                        raise RuntimeError("Board did not accept the command")
+
+                def follow(self, timeout: float = 10.0) -> tuple[bytes, bytes]:
+                    """Collect stdout and stderr of a command started with exec_raw_no_follow."""
+
+                    data = self._read_until(1, b"\x04", timeout=timeout)
+                    err = self._read_until(1, b"\x04", timeout=timeout)
+                    self._read_until(1, b">", timeout=1.0)
+                    return data[:-1], err[:-1]
+
                 def fs_put(self, src: str, dest: str) -> None:
-                    data = Path(src).read_bytes()
-                    first = True
-                    for offset in range(0, len(data), 512):
-                        chunk = data[offset : offset + 512]
-                        payload = base64.b64encode(chunk).decode("ascii")
-                        mode = "wb" if first else "ab"
-                        first = False
-                        self.exec_(
-                            f"import ubinascii\nopen({dest!r}, '{mode}').write(ubinascii.a2b_base64('{payload}'))"
-                        )
-
-                    if first:
-                        self.exec_(f"open({dest!r}, 'wb').close()")
+                    stream_file(self, Path(src), dest)
     else:
         Pyboard = _pyboard.Pyboard  # type: ignore[attr-defined]
 
@@ -141,14 +183,48 @@ PROJECT_ROOT = Path(__file__).resolve().parent
 FILES_TO_COPY: tuple[Path, ...] = (
     PROJECT_ROOT / "styles.css",
     PROJECT_ROOT / "RingBuffer.mpy",
+    PROJECT_ROOT / "BaselineTracker.mpy",
+    PROJECT_ROOT / "TimeSync.mpy",
+    PROJECT_ROOT / "RunFile.mpy",
+    PROJECT_ROOT / "SlowControl.mpy",
+    PROJECT_ROOT / "ThresholdScan.mpy",
+    PROJECT_ROOT / "Compactor.mpy",
+    PROJECT_ROOT / "SdStats.mpy",
+    PROJECT_ROOT / "DaqCore.mpy",
+    PROJECT_ROOT / "TriggerKernel.mpy",
+    PROJECT_ROOT / "PulseCapture.mpy",
+    PROJECT_ROOT / "WebPages.mpy",
+    PROJECT_ROOT / "RunArchive.mpy",
+    PROJECT_ROOT / "RunExport.mpy",
     PROJECT_ROOT / "boot.py",
     PROJECT_ROOT / "my_secrets.py",
 )
 MAIN_FILE = PROJECT_ROOT / "asynchio4.py"
+# MQTT flavour, as in install_mqtt.sh (the board number goes to id.txt)
+MQTT_FILES_TO_COPY: tuple[Path, ...] = (
+    PROJECT_ROOT / "RingBuffer.mpy",
+    PROJECT_ROOT / "BaselineTracker.mpy",
+    PROJECT_ROOT / "TimeSync.mpy",
+    PROJECT_ROOT / "RunFile.mpy",
+    PROJECT_ROOT / "SlowControl.mpy",
+    PROJECT_ROOT / "ThresholdScan.mpy",
+    PROJECT_ROOT / "Compactor.mpy",
+    PROJECT_ROOT / "SdStats.mpy",
+    PROJECT_ROOT / "DaqCore.mpy",
+    PROJECT_ROOT / "TriggerKernel.mpy",
+    PROJECT_ROOT / "PulseCapture.mpy",
+    PROJECT_ROOT / "my_secrets.py",
+    PROJECT_ROOT / "boot.py",
+)
+MQTT_MAIN_FILE = PROJECT_ROOT / "asynchio5.py"
+# modules with viper code, compiled for the RP2040 like in install.sh
+ARMV6M_MODULES: tuple[str, ...] = ("TriggerKernel", "RunExport")
 MICRODOT_VERSION = "2.3.3"
 MICRODOT_CACHE_DIR = PROJECT_ROOT / f"microdot-{MICRODOT_VERSION}"
 MICRODOT_TARBALL = PROJECT_ROOT / f"v{MICRODOT_VERSION}.tar.gz"
 MICRODOT_FILES: tuple[str, ...] = ("microdot.py", "__init__.py")
+MIP_PACKAGES: tuple[str, ...] = ("sdcard", "ntptime")
+MQTT_MIP_PACKAGES: tuple[str, ...] = ("sdcard", "umqtt.simple", "ntptime")
 
 
 @contextmanager
@@ -243,6 +319,40 @@ def maybe_compile_with_mpy_cross(source: Path) -> Path:
     return target if target.exists() else source
 
 
+def compile_modules(files: Iterable[Path]) -> None:
+    """Build every staged ``.mpy`` from its ``.py`` source with mpy-cross, like install.sh.
+
+    A module is rebuilt when its ``.mpy`` is missing or older than the source.
+    """
+
+    mpy_cross = shutil.which("mpy-cross")
+    for target in files:
+        source = target.with_suffix(".py")
+        if target.suffix != ".mpy" or not source.exists():
+            continue
+        if target.exists() and target.stat().st_mtime >= source.stat().st_mtime:
+            continue
+        if mpy_cross is None:
+            continue        # check_staged() reports what is missing
+        command = [mpy_cross]
+        if source.stem in ARMV6M_MODULES:
+            command.append("-march=armv6m")
+        command += ["-o", str(target), str(source)]
+        print(f"Compiling {source.name} -> {target.name} with mpy-cross")
+        subprocess.run(command, check=True)
+
+
+def check_staged(files: Iterable[tuple[Path, str]]) -> None:
+    """Abort before any board is touched if a file to copy is missing."""
+
+    missing = [source.name for source, _ in files if not source.exists()]
+    if missing:
+        raise SystemExit(
+            f"Missing files: {' '.join(missing)}. Install mpy-cross (`pip install mpy-cross`) to build the"
+            " .mpy modules, and create my_secrets.py if it is listed."
+        )
+
+
 def wipe_board(connection: Pyboard) -> None:
     """Recursively delete every file from the board."""
 
@@ -277,6 +387,31 @@ def wipe_board(connection: Pyboard) -> None:
     connection.exec_(script)
 
 
+def missing_mip_packages(connection: Pyboard, packages: Iterable[str]) -> list[str]:
+    """Return the packages that are not installed in /lib on the board."""
+
+    packages = list(packages)
+    script = textwrap.dedent(
+        f"""
+        import os
+        for name in {packages!r}:
+            found = False
+            for suffix in ('.mpy', '.py', '/__init__.mpy', '/__init__.py'):
+                try:
+                    os.stat('/lib/' + name.replace('.', '/') + suffix)
+                    found = True
+                    break
+                except OSError:
+                    pass
+            if not found:
+                print(name)
+        """
+    ).strip()
+
+    output = connection.exec_(script).decode("utf-8", errors="replace")
+    return [line.strip() for line in output.splitlines() if line.strip()]
+
+
 def install_mip_packages(connection: Pyboard, packages: Iterable[str]) -> None:
     """Run micropython mip.install for each package name."""
 
@@ -305,14 +440,92 @@ def _ensure_chunk_writer(connection: Pyboard) -> None:
         connection.exec_(script)
 
 
-def put_file(connection: Pyboard, source: Path, destination: str) -> None:
-    """Copy a file from the host to the MicroPython filesystem."""
+STREAM_CHUNK = 4096
+
+# Runs on the board: receives `size` raw bytes on stdin in chunks, acknowledging
+# each chunk with 0x01, and prints the CRC-32 of what it wrote.
+STREAM_RECEIVER = """
+import sys, micropython, ubinascii
+micropython.kbd_intr(-1)
+try:
+    buf = bytearray({chunk})
+    mv = memoryview(buf)
+    left = {size}
+    crc = 0
+    with open({path!r}, 'wb') as fp:
+        sys.stdout.write('\\x01')
+        while left:
+            n = min(left, {chunk})
+            got = 0
+            while got < n:
+                got += sys.stdin.buffer.readinto(mv[got:n])
+            fp.write(mv[:n])
+            crc = ubinascii.crc32(mv[:n], crc)
+            left -= n
+            sys.stdout.write('\\x01')
+finally:
+    micropython.kbd_intr(3)
+print('%08x' % crc)
+"""
+
+
+def _wait_ack(connection: Pyboard, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if connection.serial.in_waiting:
+            flag = connection.serial.read(1)
+            if flag == b"\x01":
+                return
+            # anything else is the end of the output, i.e. the receiver failed
+            rest = flag + connection.serial.read(connection.serial.in_waiting or 1)
+            time.sleep(0.1)
+            rest += connection.serial.read(connection.serial.in_waiting)
+            raise RuntimeError(f"Transfer failed: {rest.decode('utf-8', errors='replace')}")
+        time.sleep(0.0005)
+    raise RuntimeError("Transfer timed out waiting for the board")
+
+
+def stream_file(connection: Pyboard, source: Path, destination: str, chunk: int = STREAM_CHUNK) -> int:
+    """Copy a file by streaming raw bytes to a receiver running on the board.
+
+    The receiver is sent in raw-paste mode (with the board's flow control) when
+    the board supports it. The file data then follows as binary chunks of
+    ``chunk`` bytes, each acknowledged by the board, into one open file, and the
+    CRC-32 of the written data is checked at the end. Returns the size.
+    """
+
+    data = source.read_bytes()
+    connection.exec_raw_no_follow(STREAM_RECEIVER.format(chunk=chunk, size=len(data), path=destination))
+    _wait_ack(connection)
+    for offset in range(0, len(data), chunk):
+        connection.serial.write(data[offset : offset + chunk])
+        _wait_ack(connection)
+    out, err = connection.follow(10)
+    if err:
+        raise RuntimeError(f"Transfer of {source.name} failed: {err.decode('utf-8', errors='replace')}")
+    crc = int(out.split()[-1], 16)
+    if crc != binascii.crc32(data):
+        raise RuntimeError(f"CRC mismatch for {destination}: board {crc:08x}, host {binascii.crc32(data):08x}")
+    return len(data)
+
+
+def put_file(connection: Pyboard, source: Path, destination: str) -> int:
+    """Copy a file from the host to the MicroPython filesystem; return its size."""
 
     print(f"Copying {source.name} -> {destination}")
 
     if HAS_FS_PUT:
         connection.fs_put(str(source), destination)
-        return
+        return source.stat().st_size
+
+    if hasattr(connection, "exec_raw_no_follow"):
+        return stream_file(connection, source, destination)
+
+    return put_file_chunked(connection, source, destination)
+
+
+def put_file_chunked(connection: Pyboard, source: Path, destination: str) -> int:
+    """Copy a file as 512-byte base64 chunks, one raw REPL command each."""
 
     _ensure_chunk_writer(connection)
 
@@ -330,6 +543,71 @@ def put_file(connection: Pyboard, source: Path, destination: str) -> None:
     if first:  # empty file case
         connection.exec_(f"open({destination!r}, 'wb').close()")
 
+    return len(data)
+
+
+def benchmark_transfer(connection: Pyboard, size_kb: int) -> None:
+    """Time the 512-byte base64 chunk path against the streaming transfer."""
+
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "bench.bin"
+        source.write_bytes(os.urandom(size_kb * 1024))
+        methods = [("base64 chunks", put_file_chunked)]
+        if hasattr(connection, "exec_raw_no_follow"):
+            methods.append(("raw-paste stream", stream_file))
+        for name, method in methods:
+            started = time.monotonic()
+            method(connection, source, "/bench.bin")
+            elapsed = time.monotonic() - started
+            print(f"{name:18s} {size_kb} KB in {elapsed:6.2f} s: {size_kb / elapsed:7.1f} KB/s")
+    connection.exec_("import os\nos.remove('/bench.bin')")
+
+
+def local_hash(path: Path) -> str:
+    """SHA-256 of a host file as a hex string."""
+
+    digest = hashlib.sha256()
+    with path.open("rb") as fp:
+        for block in iter(lambda: fp.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remote_hashes(connection: Pyboard, destinations: Iterable[str]) -> dict[str, str]:
+    """SHA-256 of each file on the board; files that do not exist are left out."""
+
+    destinations = list(destinations)
+    script = textwrap.dedent(
+        f"""
+        import hashlib, ubinascii
+        buf = bytearray(1024)
+        for path in {destinations!r}:
+            try:
+                fp = open(path, 'rb')
+            except OSError:
+                continue
+            h = hashlib.sha256()
+            mv = memoryview(buf)
+            while True:
+                n = fp.readinto(buf)
+                if not n:
+                    break
+                h.update(mv[:n])
+            fp.close()
+            print(path, ubinascii.hexlify(h.digest()).decode())
+        """
+    ).strip()
+
+    output = connection.exec_(script).decode("utf-8", errors="replace")
+    hashes = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            hashes[parts[0]] = parts[1]
+    return hashes
+
 
 
 def list_remote_tree(connection: Pyboard) -> str:
@@ -366,16 +644,22 @@ def list_remote_tree(connection: Pyboard) -> str:
     return connection.exec_(script).decode("utf-8", errors="replace").strip()
 
 
-def upload_project(connection: Pyboard) -> None:
-    """Send project files to the board."""
+def project_files(mqtt: bool = False) -> list[tuple[Path, str]]:
+    """Return (host path, board path) for every file that goes onto the board.
 
-    wipe_board(connection)
-    install_mip_packages(connection, ("sdcard", "ntptime"))
+    The ``.mpy`` modules are built first; exits if any file is still missing.
+    """
 
-    for path in FILES_TO_COPY:
-        put_file(connection, path, f"/{path.name}")
+    if mqtt:
+        compile_modules(MQTT_FILES_TO_COPY)
+        files = [(path, f"/{path.name}") for path in MQTT_FILES_TO_COPY]
+        files.append((MQTT_MAIN_FILE, "/main.py"))
+        check_staged(files)
+        return files
 
-    put_file(connection, MAIN_FILE, "/main.py")
+    compile_modules(FILES_TO_COPY)
+    files = [(path, f"/{path.name}") for path in FILES_TO_COPY]
+    files.append((MAIN_FILE, "/main.py"))
 
     microdot_source_dir = ensure_microdot_sources(MICRODOT_CACHE_DIR, MICRODOT_TARBALL)
     microdot_dir = microdot_source_dir / "src" / "microdot"
@@ -383,8 +667,53 @@ def upload_project(connection: Pyboard) -> None:
     for filename in MICRODOT_FILES:
         source = microdot_dir / filename
         staged = maybe_compile_with_mpy_cross(source)
-        destination = f"/{staged.name}"
-        put_file(connection, staged, destination)
+        files.append((staged, f"/{staged.name}"))
+
+    check_staged(files)
+    return files
+
+
+def upload_project(
+    connection: Pyboard,
+    sync: bool = False,
+    files: Optional[list[tuple[Path, str]]] = None,
+    packages: Iterable[str] = MIP_PACKAGES,
+) -> tuple[int, int]:
+    """Send project files to the board; return (files copied, bytes transferred).
+
+    By default the board is wiped and everything is reinstalled. With ``sync``
+    nothing is deleted: mip packages are only installed if missing, and only
+    files whose SHA-256 differs from the copy on the board are transferred.
+    ``files`` defaults to ``project_files()``.
+    """
+
+    started = time.monotonic()
+    if files is None:
+        files = project_files()
+
+    if sync:
+        install_mip_packages(connection, missing_mip_packages(connection, packages))
+        on_board = remote_hashes(connection, [destination for _, destination in files])
+    else:
+        wipe_board(connection)
+        install_mip_packages(connection, packages)
+        on_board = {}
+
+    copied = 0
+    transferred = 0
+    unchanged = 0
+    for source, destination in files:
+        if on_board.get(destination) == local_hash(source):
+            unchanged += source.stat().st_size
+            continue
+        transferred += put_file(connection, source, destination)
+        copied += 1
+
+    print(
+        f"{copied} of {len(files)} files copied, {transferred} bytes transferred"
+        f" ({unchanged} bytes unchanged) in {time.monotonic() - started:.1f} s"
+    )
+    return copied, transferred
 
 
 def parse_args() -> argparse.Namespace:
@@ -393,6 +722,22 @@ def parse_args() -> argparse.Namespace:
     )
     parser.add_argument("--port", required=True, help="Serial port of the MicroPython board (e.g. COM3)")
     parser.add_argument("--baud", type=int, default=115200, help="Serial baudrate (default: 115200)")
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Do not wipe the board; copy only files that changed and install missing mip packages.",
+    )
+    parser.add_argument(
+        "--mqtt",
+        action="store_true",
+        help="Install the MQTT version (asynchio5.py) like install_mqtt.sh instead of the web version.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="KB",
+        help="Only measure file transfer throughput with a KB-sized file and exit.",
+    )
     parser.add_argument(
         "--skip-env-check",
         action="store_true",
@@ -413,7 +758,11 @@ def main() -> None:
     ensure_environment(expected_env)
 
     with board_connection(args.port, args.baud) as connection:
-        upload_project(connection)
+        if args.benchmark:
+            benchmark_transfer(connection, args.benchmark)
+            return
+        packages = MQTT_MIP_PACKAGES if args.mqtt else MIP_PACKAGES
+        upload_project(connection, sync=args.sync, files=project_files(args.mqtt), packages=packages)
         tree_output = list_remote_tree(connection)
 
     if tree_output:
@@ -11,13 +11,40 @@ trap 'echo "Error occurred at line $LINENO: $BASH_COMMAND"; exit 1' ERR
 # list of files to install
 FILES="styles.css \
     RingBuffer.mpy \
+    BaselineTracker.mpy \
+    TimeSync.mpy \
+    RunFile.mpy \
+    SlowControl.mpy \
+    ThresholdScan.mpy \
+    Compactor.mpy \
+    SdStats.mpy \
+    DaqCore.mpy \
+    TriggerKernel.mpy \
+    PulseCapture.mpy \
+    WebPages.mpy \
+    RunArchive.mpy \
+    RunExport.mpy \
     boot.py \
     my_secrets.py "
 
 MAIN_FILE="asynchio4.py"
 
-# compile the RingBuffer module - creates mpy file
+# compile the modules - creates mpy files
 mpy-cross RingBuffer.py
+mpy-cross BaselineTracker.py
+mpy-cross TimeSync.py
+mpy-cross RunFile.py
+mpy-cross SlowControl.py
+mpy-cross ThresholdScan.py
+mpy-cross Compactor.py
+mpy-cross SdStats.py
+mpy-cross DaqCore.py
+mpy-cross PulseCapture.py
+# native (viper) code, compiled for the Cortex-M0+ of the RP2040
+mpy-cross -march=armv6m TriggerKernel.py
+mpy-cross -march=armv6m RunExport.py
+mpy-cross WebPages.py
+mpy-cross RunArchive.py
 
 # create my_secrets.py if it does not exist. Since RedRover does not 
 # require WiFi credentials, we can provide default values.
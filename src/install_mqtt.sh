@@ -23,6 +23,16 @@ conda activate rpico
 
 # list of files to install
 FILES="RingBuffer.mpy \
+    BaselineTracker.mpy \
+    TimeSync.mpy \
+    RunFile.mpy \
+    SlowControl.mpy \
+    ThresholdScan.mpy \
+    Compactor.mpy \
+    SdStats.mpy \
+    DaqCore.mpy \
+    TriggerKernel.mpy \
+    PulseCapture.mpy \
     my_secrets.py \
     id.txt \
     boot.py"
@@ -41,8 +51,19 @@ MQTT_SERVER="pepper.physics.cornell.edu"
 EOL
 fi
 
-# compile the RingBuffer module - creates mpy file
+# compile the modules - creates mpy files
 mpy-cross RingBuffer.py
+mpy-cross BaselineTracker.py
+mpy-cross TimeSync.py
+mpy-cross RunFile.py
+mpy-cross SlowControl.py
+mpy-cross ThresholdScan.py
+mpy-cross Compactor.py
+mpy-cross SdStats.py
+mpy-cross DaqCore.py
+mpy-cross PulseCapture.py
+# native (viper) code, compiled for the Cortex-M0+ of the RP2040
+mpy-cross -march=armv6m TriggerKernel.py
 
 # check for missing files in MAIN_FILE and FILES
 MISSING_FILES=0
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""Fleet-scale MQTT load generator for sizing the broker and the ingest path.
+
+Where ``test_client.py`` simulates a single board, this script simulates
+hundreds of boards at once. Each simulated board has its own MQTT connection
+and publishes the same JSON messages as ``asynchio5.py``:
+
+- singles events on ``telemetry/NNN`` as a Poisson process,
+- coincident events shared by leader/follower pairs (boards 2k and 2k+1), with
+  ``coincidence = 1`` on the leader,
+- the run metadata block on the first event of every run,
+- ``status/NNN`` messages every ``--status-interval`` seconds.
+
+Optionally all boards drop their connection at the same moment and reconnect
+(a reconnect storm, as after a campus Wi-Fi outage). Boards are spread over
+``--processes`` worker processes, each running an asyncio loop.
+
+At the end the achieved publish throughput, reconnect times and end-to-end
+latency (board timestamp to delivery at a subscriber) are reported. With
+``--local`` everything runs in one process against ``local_broker.LocalBroker``
+and, with ``--ingest-out``, straight into ``ingest.IngestService``.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Optional
+
+from ingest import make_mqtt_client, now_us, parse_timestamp_us
+
+BASELINE = 780
+THRESHOLD = BASELINE + 1000
+RESET_THRESHOLD = BASELINE + 50
+
+
+def iso_now() -> str:
+    """Return the current UTC time as an ISO-8601 string with microseconds."""
+
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class PahoTransport:
+    """One paho-mqtt connection with a background network thread."""
+
+    def __init__(self, host: str, port: int, client_id: str) -> None:
+        self.host = host
+        self.port = port
+        self.client = make_mqtt_client(client_id)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.connected = threading.Event()
+        self.acked = 0
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        self.connected.set()
+
+    def _on_disconnect(self, client, userdata, *args):
+        self.connected.clear()
+
+    def _on_publish(self, client, userdata, mid, *args):
+        self.acked += 1
+
+    def start(self) -> None:
+        self.client.connect_async(self.host, self.port, 60)
+        self.client.loop_start()
+
+    def stop(self) -> None:
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.connected.clear()
+
+    def publish(self, topic: str, payload: str) -> bool:
+        if not self.connected.is_set():
+            return False
+        return self.client.publish(topic, payload).rc == 0
+
+
+class LocalTransport:
+    """Connection to an in-process ``LocalBroker``."""
+
+    def __init__(self, broker, client_id: str) -> None:
+        self.broker = broker
+        self.client_id = client_id
+        self.connected = threading.Event()
+        self.acked = 0
+
+    def start(self) -> None:
+        self.broker.connect(self.client_id)
+        self.connected.set()
+
+    def stop(self) -> None:
+        self.broker.disconnect(self.client_id)
+        self.connected.clear()
+
+    def publish(self, topic: str, payload: str) -> bool:
+        if not self.connected.is_set():
+            return False
+        self.broker.publish(topic, payload)
+        self.acked += 1
+        return True
+
+
+class SimulatedBoard:
+    """Message generator for one board, mirroring the fields sent by asynchio5.py."""
+
+    def __init__(self, device: int, transport, is_leader: bool, rng: random.Random) -> None:
+        self.device = device
+        self.transport = transport
+        self.is_leader = is_leader
+        self.rng = rng
+        self.telemetry_topic = f"telemetry/{device:03d}"
+        self.status_topic = f"status/{device:03d}"
+        self.boot_ms = time.monotonic() * 1000 - rng.uniform(5_000, 60_000)
+        self.muon_count = 0
+        self.last_ms = 0
+        self.first_event = True
+        self.published = 0
+        self.failed = 0
+        self.run_start = time.time()
+
+    def ticks_ms(self) -> int:
+        return int(time.monotonic() * 1000 - self.boot_ms)
+
+    def event(self, coincidence: int) -> dict[str, Any]:
+        t_ms = self.ticks_ms()
+        self.muon_count += 1
+        data: dict[str, Any] = {
+            "device_number": self.device,
+            "muon_count": self.muon_count,
+            "adc_v": min(65535, THRESHOLD + int(self.rng.expovariate(1 / 8000))),
+            "temp_adc_v": 15000 + self.rng.randint(-40, 40),
+            "dt": t_ms - self.last_ms if self.last_ms else 0,
+            "ts": iso_now(),
+            "t_ms": t_ms,
+            "wait_cnt": self.rng.randint(40, 100),
+            "coincidence": coincidence if self.is_leader else 0,
+        }
+        self.last_ms = t_ms
+        if self.first_event:
+            data["run_start"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.run_start))
+            data["baseline"] = BASELINE
+            data["reset_threshold"] = RESET_THRESHOLD
+            data["threshold"] = THRESHOLD
+            data["is_leader"] = self.is_leader
+            self.first_event = False
+        return data
+
+    def status(self) -> dict[str, Any]:
+        runtime = time.time() - self.run_start
+        return {
+            "rate": round(self.muon_count / runtime, 2) if runtime > 0 else 0.0,
+            "muon_count": self.muon_count,
+            "threshold": THRESHOLD,
+            "reset_threshold": RESET_THRESHOLD,
+            "baseline": BASELINE,
+            "runtime": runtime,
+            "is_leader": self.is_leader,
+            "avg_time_ms": 0.011,
+        }
+
+    def send(self, topic: str, data: dict[str, Any]) -> None:
+        if self.transport.publish(topic, json.dumps(data)):
+            self.published += 1
+        else:
+            self.failed += 1
+
+
+async def sleep_before(delay: float, stop: float) -> bool:
+    """Sleep for ``delay`` seconds; return False instead if ``stop`` comes first."""
+
+    remaining = stop - time.monotonic()
+    if delay >= remaining:
+        await asyncio.sleep(max(0.0, remaining))
+        return False
+    await asyncio.sleep(delay)
+    return True
+
+
+async def singles_process(board: SimulatedBoard, rate: float, stop: float) -> None:
+    while await sleep_before(board.rng.expovariate(rate), stop):
+        board.send(board.telemetry_topic, board.event(0))
+
+
+async def coincidence_process(leader: SimulatedBoard, follower: SimulatedBoard, rate: float, stop: float) -> None:
+    while await sleep_before(leader.rng.expovariate(rate), stop):
+        leader.send(leader.telemetry_topic, leader.event(1))
+        follower.send(follower.telemetry_topic, follower.event(1))
+
+
+async def status_process(board: SimulatedBoard, interval: float, stop: float) -> None:
+    # stagger the first status message like boards booted at different times
+    delay = board.rng.uniform(0, interval)
+    while await sleep_before(delay, stop):
+        board.send(board.status_topic, board.status())
+        delay = interval
+
+
+async def wait_connected(boards: list[SimulatedBoard], timeout: float = 30.0) -> list[float]:
+    """Wait until every board is connected; return the per-board connect times in seconds."""
+
+    start = time.monotonic()
+    pending = {board.device: board for board in boards}
+    times: list[float] = []
+    while pending and time.monotonic() - start < timeout:
+        for device in [d for d, b in pending.items() if b.transport.connected.is_set()]:
+            del pending[device]
+            times.append(time.monotonic() - start)
+        await asyncio.sleep(0.01)
+    if pending:
+        print(f"{len(pending)} boards failed to connect within {timeout:.0f} s")
+    return times
+
+
+async def reconnect_storms(boards: list[SimulatedBoard], every: float, stop: float, times: list[float]) -> None:
+    while await sleep_before(every, stop):
+        for board in boards:
+            board.transport.stop()
+        for board in boards:
+            board.transport.start()
+        times.extend(await wait_connected(boards))
+
+
+async def run_boards(boards: list[SimulatedBoard], args: argparse.Namespace) -> dict[str, Any]:
+    """Drive a set of boards for ``args.duration`` seconds and return their counters."""
+
+    for board in boards:
+        board.transport.start()
+    connect_times = await wait_connected(boards)
+    start = time.monotonic()
+    stop = start + args.duration
+    tasks = []
+    by_device = {board.device: board for board in boards}
+    for board in boards:
+        tasks.append(singles_process(board, args.rate, stop))
+        tasks.append(status_process(board, args.status_interval, stop))
+        follower = by_device.get(board.device + 1)
+        if board.is_leader and follower is not None and args.coinc_rate > 0:
+            tasks.append(coincidence_process(board, follower, args.coinc_rate, stop))
+    reconnect_times: list[float] = []
+    if args.storm_every > 0:
+        tasks.append(reconnect_storms(boards, args.storm_every, stop, reconnect_times))
+    await asyncio.gather(*tasks)
+    duration = time.monotonic() - start
+    # give the network threads a moment to drain their queues
+    await asyncio.sleep(0.5)
+    acked = sum(board.transport.acked for board in boards)
+    for board in boards:
+        board.transport.stop()
+    return {
+        "published": sum(board.published for board in boards),
+        "failed": sum(board.failed for board in boards),
+        "acked": acked,
+        "duration": duration,
+        "connect_times": connect_times,
+        "reconnect_times": reconnect_times,
+    }
+
+
+def pair_of(device: int) -> int:
+    """Boards 2k and 2k+1 are wired together as a pair; the even board is the leader."""
+
+    return device // 2
+
+
+def make_boards(devices: list[int], transport_factory, seed: int) -> list[SimulatedBoard]:
+    boards = []
+    for device in devices:
+        rng = random.Random(seed * 100_003 + device)
+        transport = transport_factory(f"cuwatch_{device:03d}")
+        boards.append(SimulatedBoard(device, transport, device == 2 * pair_of(device), rng))
+    return boards
+
+
+def worker(devices: list[int], args: argparse.Namespace, results) -> None:
+    """Entry point of one worker process."""
+
+    boards = make_boards(devices, lambda cid: PahoTransport(args.host, args.port, cid), args.seed)
+    results.put(asyncio.run(run_boards(boards, args)))
+
+
+class LatencyMonitor:
+    """Measure delivery latency from the board timestamp of each telemetry message."""
+
+    def __init__(self, sample_every: int = 1) -> None:
+        self.latencies_ms: list[float] = []
+        self.received = 0
+        self.sample_every = sample_every
+        self._lock = threading.Lock()
+
+    def on_message(self, topic: str, payload: bytes) -> None:
+        recv = now_us()
+        with self._lock:
+            self.received += 1
+            if self.received % self.sample_every:
+                return
+        try:
+            ts = json.loads(payload)["ts"]
+        except (ValueError, KeyError):
+            return
+        with self._lock:
+            self.latencies_ms.append((recv - parse_timestamp_us(ts)) / 1000)
+
+
+def start_remote_monitor(args: argparse.Namespace, monitor: LatencyMonitor):
+    client = make_mqtt_client("cuwatch-loadgen-monitor")
+
+    def _on_connect(client, userdata, flags, rc, properties=None):
+        client.subscribe("telemetry/+")
+
+    def _on_message(client, userdata, msg):
+        monitor.on_message(msg.topic, msg.payload)
+
+    client.on_connect = _on_connect
+    client.on_message = _on_message
+    client.connect(args.host, args.port, 60)
+    client.loop_start()
+    return client
+
+
+def report(totals: dict[str, Any], monitor: LatencyMonitor, ingest=None) -> None:
+    elapsed = totals["duration"]
+    print(f"published {totals['published']} messages in {elapsed:.1f} s: "
+          f"{totals['published'] / elapsed:.0f} msg/s ({totals['acked']} acked, {totals['failed']} failed)")
+    connect = totals["connect_times"]
+    print(f"initial connect: {len(connect)} boards, p50 {percentile(connect, 0.5):.3f} s, "
+          f"max {max(connect, default=0.0):.3f} s")
+    reconnect = totals["reconnect_times"]
+    if reconnect:
+        print(f"reconnect storms: {len(reconnect)} reconnects, p50 {percentile(reconnect, 0.5):.3f} s, "
+              f"p99 {percentile(reconnect, 0.99):.3f} s, max {max(reconnect):.3f} s")
+    lat = monitor.latencies_ms
+    print(f"end-to-end latency over {len(lat)} samples ({monitor.received} received): "
+          f"p50 {percentile(lat, 0.5):.2f} ms, p99 {percentile(lat, 0.99):.2f} ms, max {max(lat, default=0.0):.2f} ms")
+    if ingest is not None:
+        ingest.flush_due(force=True)
+        print("ingest:", ingest.report(elapsed))
+
+
+def run_local(args: argparse.Namespace) -> None:
+    from local_broker import LocalBroker
+
+    broker = LocalBroker()
+    monitor = LatencyMonitor(args.sample_every)
+    broker.subscribe("telemetry/+", monitor.on_message)
+    service = None
+    if args.ingest_out is not None:
+        from ingest import IngestService
+
+        service = IngestService(args.ingest_out, fmt=args.ingest_format)
+        service.attach(broker)
+
+    async def _run():
+        boards = make_boards(list(range(args.first_device, args.first_device + args.devices)),
+                             lambda cid: LocalTransport(broker, cid), args.seed)
+        if service is None:
+            return await run_boards(boards, args)
+
+        async def _flusher():
+            while not done:
+                service.flush_due()
+                await asyncio.sleep(0.1)
+
+        done = False
+        flusher = asyncio.create_task(_flusher())
+        totals = await run_boards(boards, args)
+        done = True
+        await flusher
+        return totals
+
+    totals = asyncio.run(_run())
+    report(totals, monitor, service)
+
+
+def run_remote(args: argparse.Namespace) -> None:
+    monitor = LatencyMonitor(args.sample_every)
+    monitor_client = start_remote_monitor(args, monitor)
+    devices = list(range(args.first_device, args.first_device + args.devices))
+    # keep leader/follower pairs in the same process
+    pairs: list[list[int]] = []
+    for device in devices:
+        if pairs and pair_of(pairs[-1][0]) == pair_of(device):
+            pairs[-1].append(device)
+        else:
+            pairs.append([device])
+    groups = [sum(pairs[i::args.processes], []) for i in range(args.processes)]
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(group, args, results)) for group in groups if group]
+    for process in processes:
+        process.start()
+    totals: dict[str, Any] = {"published": 0, "failed": 0, "acked": 0, "duration": 0.0,
+                              "connect_times": [], "reconnect_times": []}
+    for _ in processes:
+        result = results.get()
+        for key in ("published", "failed", "acked"):
+            totals[key] += result[key]
+        # workers run in parallel, so the slowest one sets the wall-clock duration
+        totals["duration"] = max(totals["duration"], result["duration"])
+        totals["connect_times"].extend(result["connect_times"])
+        totals["reconnect_times"].extend(result["reconnect_times"])
+    for process in processes:
+        process.join()
+    time.sleep(0.5)
+    monitor_client.loop_stop()
+    monitor_client.disconnect()
+    report(totals, monitor)
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulate a fleet of CuWatch boards publishing over MQTT.")
+    parser.add_argument("--host", default="localhost", help="MQTT broker host (default: localhost)")
+    parser.add_argument("--port", type=int, default=1883, help="MQTT broker port (default: 1883)")
+    parser.add_argument("--devices", type=int, default=100, help="Number of simulated boards (default: 100)")
+    parser.add_argument("--first-device", type=int, default=1, help="Device number of the first board (default: 1)")
+    parser.add_argument("--processes", type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help="Worker processes for the remote broker mode")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds of data taking (default: 60)")
+    parser.add_argument("--rate", type=float, default=1.0, help="Singles rate per board in Hz (default: 1.0)")
+    parser.add_argument("--coinc-rate", type=float, default=0.1,
+                        help="Coincidence rate per leader/follower pair in Hz (default: 0.1)")
+    parser.add_argument("--status-interval", type=float, default=30.0,
+                        help="Seconds between status messages per board (default: 30, as on the boards)")
+    parser.add_argument("--storm-every", type=float, default=0.0,
+                        help="Disconnect and reconnect all boards at once every N seconds (default: off)")
+    parser.add_argument("--sample-every", type=int, default=1,
+                        help="Measure latency on every Nth telemetry message (default: 1)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    parser.add_argument("--local", action="store_true", help="Use the in-process LocalBroker instead of a real broker")
+    parser.add_argument("--ingest-out", type=Path, default=None,
+                        help="With --local, feed an IngestService writing to this directory")
+    parser.add_argument("--ingest-format", choices=("auto", "parquet", "npz"), default="auto",
+                        help="Partition format for --ingest-out (default: auto)")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    if args.local:
+        run_local(args)
+    else:
+        run_remote(args)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
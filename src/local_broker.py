@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""In-process stand-in for an MQTT broker.
+
+``LocalBroker`` implements just enough of the publish/subscribe behaviour of a
+real broker (topic filters with ``+`` and ``#`` wildcards, client connect and
+disconnect) to exercise the host-side tools without running mosquitto. Messages
+are delivered synchronously on the publisher's thread.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Callable
+
+MessageCallback = Callable[[str, bytes], None]
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """Return True if ``topic`` matches the MQTT topic filter ``pattern``."""
+
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class LocalBroker:
+    """Thread-safe in-memory broker with MQTT-style topic filters."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._subscriptions: list[tuple[str, MessageCallback]] = []
+        self.published = 0
+        self.delivered = 0
+        self.connects = 0
+        self.disconnects = 0
+
+    def subscribe(self, pattern: str, callback: MessageCallback) -> None:
+        with self._lock:
+            self._subscriptions.append((pattern, callback))
+
+    def unsubscribe(self, callback: MessageCallback) -> None:
+        with self._lock:
+            self._subscriptions = [(p, cb) for p, cb in self._subscriptions if cb is not callback]
+
+    def connect(self, client_id: str = "") -> None:
+        with self._lock:
+            self.connects += 1
+
+    def disconnect(self, client_id: str = "") -> None:
+        with self._lock:
+            self.disconnects += 1
+
+    def publish(self, topic: str, payload: bytes | str) -> None:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self._lock:
+            self.published += 1
+            targets = [cb for pattern, cb in self._subscriptions if topic_matches(pattern, topic)]
+            self.delivered += len(targets)
+        for callback in targets:
+            callback(topic, payload)
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+"""Fast loader for ``muon_data_*.csv`` run files.
+
+Two layouts are in use. Files written on the SD card by ``asynchio4.py`` and
+``asynchio5.py`` start with a two-line metadata block followed by the legacy
+event header::
+
+    baseline,stddev,threshold,reset_threshold,run_start_time,is_leader
+    775.0, 9.3, 975, 825, 2024-11-01T18:06:41.482495-04:00, 1
+    Muon Count,ADC,temperature_ADC,dt,t,t_wait,coinc
+    1, 7089, 15171, 2, 20751, 76, 0
+
+Newer firmware adds ``run_start_ticks_ms`` (the board's ``ticks_ms`` at
+``run_start_time``, used to time the events exactly) and ``time_sync`` (how the
+clock was synced; ``run_start_time`` is ``unsynced`` if it never was) and
+``segment``: long runs are split into segment files (``..._s001.csv``, ...),
+each with the full metadata block, and event counts and ``t`` continue across
+them. ``segment_start_ticks_ms`` and ``segment_start_time`` are a ticks_ms
+value shortly before the segment's first event and its wall-clock time; events
+are timed from them, so a segment that starts weeks into a run still loads on
+its own. A segment may end in a tail of NUL bytes (preallocated space), which is
+ignored. Runs taken with ``PULSE_CAPTURE`` have more event columns: the pulse
+``peak``, the time over threshold ``tot_us`` and a short waveform ``w0, w1,
+...``; ``load_waveforms`` reads the latter. Newer firmware reads the
+temperature every few seconds rather than per event (``temperature_ADC`` is
+the latest average) and writes the averages to ``<segment>.slow.csv``, which
+``load_slow_control`` reads. Boards with ``COMPACT_RUNS`` gzip closed segments
+to ``<segment>.csv.gz``; every loader here reads those as well.
+
+Files exported from the MQTT server use the message field names
+(``muon_count,adc_v,temp_adc_v,dt,ts,t_ms,wait_cnt,coincidence``, any subset
+and order) and may or may not carry the metadata block.
+
+``load_run`` parses the metadata into a ``RunHeader`` and reads the event
+table with NumPy's C parser into a structured array with one normalized schema,
+``EVENT_DTYPE``, whichever layout the file uses::
+
+    header, events = load_run("muon_data_20241101_1806.csv")
+    volts = adc_to_volts(events["adc_v"])
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import io
+import re
+import time
+import warnings
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+
+import numpy as np
+
+PathLike = Union[str, Path]
+
+EVENT_DTYPE = np.dtype([
+    ("muon_count", "<i8"),
+    ("adc_v", "<u2"),
+    ("temp_adc_v", "<u2"),
+    ("dt", "<i8"),               # ms since the previous event
+    ("t_ms", "<i8"),             # board ticks_ms at the trigger
+    ("wait_cnt", "<i2"),
+    ("coincidence", "u1"),
+    ("peak", "<u2"),             # pulse maximum (PULSE_CAPTURE runs, else 0)
+    ("tot_us", "<i4"),           # time over threshold in us (PULSE_CAPTURE runs, else 0; < 0: saturated)
+    ("ts", "datetime64[us]"),    # UTC wall-clock time of the event
+])
+
+# column name in either file layout -> field of EVENT_DTYPE
+COLUMN_ALIASES = {
+    "Muon Count": "muon_count",
+    "muon_count": "muon_count",
+    "ADC": "adc_v",
+    "adc_v": "adc_v",
+    "temperature_ADC": "temp_adc_v",
+    "temp_adc_v": "temp_adc_v",
+    "dt": "dt",
+    "t": "t_ms",
+    "t_ms": "t_ms",
+    "end_time": "t_ms",
+    "t_wait": "wait_cnt",
+    "wait_cnt": "wait_cnt",
+    "coinc": "coincidence",
+    "coincidence": "coincidence",
+    "ts": "ts",
+    "peak": "peak",
+    "tot_us": "tot_us",
+}
+WAVE_COLUMN = re.compile(r"w\d+")
+# files the boards write next to a segment; they match muon_data_*.csv but are not runs
+SIDECAR_SUFFIXES = (".slow.csv",)
+# run files as written by the boards and as compacted by COMPACT_RUNS
+RUN_PATTERNS = ("muon_data_*.csv", "muon_data_*.csv.gz")
+
+LEGACY_COLUMNS = ("Muon Count", "ADC", "temperature_ADC", "dt", "t", "t_wait", "coinc")
+METADATA_KEYS = ("baseline", "stddev", "threshold", "reset_threshold", "run_start_time", "is_leader",
+                 "run_start_ticks_ms", "time_sync", "segment", "segment_start_time", "segment_start_ticks_ms")
+
+# ``t`` is the board's ticks_ms, which wraps around to 0 after this many ms (about 12.4 days)
+TICKS_PERIOD_MS = 1 << 30
+
+ADC_FULL_SCALE = 2 ** 16 - 1
+ADC_VREF = 3.3
+# TMP235 on Rev 3 boards: T = (V_OUT - V_OFFSET) / T_C, see pepper_analyze.ipynb
+TMP235_V_OFFSET = 0.5
+TMP235_T_C = 0.01
+
+
+@dataclass
+class RunHeader:
+    """Run metadata and layout information of one run file."""
+
+    path: Path
+    schema: str                                # "legacy" or "mqtt"
+    columns: tuple[str, ...]                   # event columns as named in the file
+    data_line: int                             # 0-based line number of the first event
+    data_offset: int                           # byte offset of the first event
+    baseline: Optional[float] = None
+    stddev: Optional[float] = None
+    threshold: Optional[int] = None
+    reset_threshold: Optional[int] = None
+    run_start_time: Optional[datetime] = None
+    is_leader: Optional[bool] = None
+    run_start_ticks_ms: Optional[int] = None   # board ticks_ms at run_start_time
+    time_sync: Optional[str] = None            # how the board clock was synced, "none" if never
+    segment: Optional[int] = None              # number of the segment file within the run
+    segment_start_time: Optional[datetime] = None
+    segment_start_ticks_ms: Optional[int] = None   # board ticks_ms at segment_start_time
+    extra: dict[str, str] = field(default_factory=dict)   # metadata keys not listed above
+    ignored_columns: tuple[str, ...] = ()
+
+    @property
+    def has_metadata(self) -> bool:
+        return self.baseline is not None
+
+
+def adc_to_volts(adc: np.ndarray) -> np.ndarray:
+    return adc * (ADC_VREF / ADC_FULL_SCALE)
+
+
+def temp_adc_to_celsius(temp_adc: np.ndarray) -> np.ndarray:
+    """Convert the temperature ADC reading of a TMP235 sensor to degrees C."""
+
+    return (temp_adc * (ADC_VREF / 65536) - TMP235_V_OFFSET) / TMP235_T_C
+
+
+def parse_iso8601(value: str) -> datetime:
+    """Parse an ISO-8601 timestamp as written by the boards; naive values are UTC."""
+
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    stamp = datetime.fromisoformat(value)
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=timezone.utc)
+    return stamp
+
+
+def _split(line: str) -> list[str]:
+    return [item.strip() for item in line.rstrip("\r\n").split(",")]
+
+
+def _apply_metadata(header: RunHeader, keys: list[str], values: list[str]) -> None:
+    for key, value in zip(keys, values):
+        if key == "baseline":
+            header.baseline = float(value)
+        elif key == "stddev":
+            header.stddev = float(value)
+        elif key == "threshold":
+            header.threshold = int(float(value))
+        elif key == "reset_threshold":
+            header.reset_threshold = int(float(value))
+        elif key == "run_start_time":
+            try:
+                header.run_start_time = parse_iso8601(value)
+            except ValueError:
+                header.extra[key] = value
+        elif key == "is_leader":
+            header.is_leader = value not in ("0", "False", "false", "")
+        elif key == "run_start_ticks_ms":
+            header.run_start_ticks_ms = int(value)
+        elif key == "time_sync":
+            header.time_sync = value
+        elif key == "segment":
+            header.segment = int(value)
+        elif key == "segment_start_time":
+            try:
+                header.segment_start_time = parse_iso8601(value)
+            except ValueError:
+                header.extra[key] = value
+        elif key == "segment_start_ticks_ms":
+            header.segment_start_ticks_ms = int(value)
+        else:
+            header.extra[key] = value
+
+
+def run_stem(path: PathLike) -> str:
+    """File name of a run without ``.csv`` or ``.csv.gz``, the base of its sidecar names."""
+
+    path = Path(path)
+    if path.name.endswith(".csv.gz"):
+        return path.name[: -len(".csv.gz")]
+    return path.stem
+
+
+def find_runs(directory: PathLike, patterns: Sequence[str] = RUN_PATTERNS, recursive: bool = False) -> list[Path]:
+    """Run files in ``directory`` matching any of ``patterns``, sorted.
+
+    Sidecars are left out, and so is a ``.csv.gz`` whose unpacked ``.csv`` is
+    next to it (e.g. after ``gunzip -k``), so no run is counted twice.
+    """
+
+    directory = Path(directory)
+    found: set[Path] = set()
+    for pattern in patterns:
+        found.update(directory.rglob(pattern) if recursive else directory.glob(pattern))
+    return sorted(p for p in found
+                  if not p.name.endswith(SIDECAR_SUFFIXES)
+                  and not (p.name.endswith(".csv.gz") and p.with_name(p.name[: -len(".gz")]) in found))
+
+
+def open_run(path: PathLike):
+    """Open a run file for binary reading; ``.gz`` files (compacted on the board) are decompressed."""
+
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_header(path: PathLike) -> RunHeader:
+    """Read the metadata block (if any) and the event header line of a run file."""
+
+    path = Path(path)
+    with open_run(path) as fp:
+        offset = 0
+        line_no = 0
+        metadata: Optional[tuple[list[str], list[str]]] = None
+        while True:
+            raw = fp.readline()
+            if not raw:
+                raise ValueError(f"{path}: no event header found")
+            text = raw.decode("utf-8", errors="replace")
+            offset += len(raw)
+            line_no += 1
+            keys = _split(text)
+            if keys and keys[0] == "baseline":
+                values_raw = fp.readline()
+                offset += len(values_raw)
+                line_no += 1
+                metadata = (keys, _split(values_raw.decode("utf-8", errors="replace")))
+                continue
+            if any(key in COLUMN_ALIASES for key in keys):
+                break
+            raise ValueError(f"{path}: unrecognized line {line_no}: {text.strip()!r}")
+
+    schema = "legacy" if tuple(keys[:len(LEGACY_COLUMNS)]) == LEGACY_COLUMNS else "mqtt"
+    ignored = tuple(key for key in keys if key not in COLUMN_ALIASES)
+    header = RunHeader(path=path, schema=schema, columns=tuple(keys), data_line=line_no,
+                       data_offset=offset, ignored_columns=ignored)
+    if metadata is not None:
+        _apply_metadata(header, *metadata)
+    return header
+
+
+def _complete_lines(data: bytes) -> bytes:
+    """Drop a trailing partial line, e.g. after a reset interrupted a write."""
+
+    data = data.rstrip(b"\x00")
+    end = data.rfind(b"\n")
+    return data[: end + 1] if end >= 0 else b""
+
+
+def _parse_ts(values: np.ndarray) -> np.ndarray:
+    """Vectorized conversion of ISO-8601 strings to ``datetime64[us]`` in UTC.
+
+    All rows of a file share one format, so the timezone suffix is taken from
+    the first value and removed from every row.
+    """
+
+    if len(values) == 0:
+        return values.astype("datetime64[us]")
+    first = str(values[0])
+    offset = np.timedelta64(0, "us")
+    if first.endswith("Z"):
+        values = np.char.rstrip(values, "Z")
+    elif len(first) > 6 and first[-6] in "+-" and first[-3] == ":":
+        sign = 1 if first[-6] == "+" else -1
+        minutes = int(first[-5:-3]) * 60 + int(first[-2:])
+        offset = np.timedelta64(sign * minutes * 60_000_000, "us")
+        values = np.char.rpartition(values, first[-6])[:, 0]
+    return values.astype("datetime64[us]") - offset
+
+
+def _parse_int_table(text: str, ncols: int) -> Optional[np.ndarray]:
+    """Parse an all-integer table in one pass with ``np.fromstring``.
+
+    Returns None if the text does not split into rows of ``ncols`` integers, in
+    which case the caller falls back to ``np.loadtxt`` for a precise error.
+    """
+
+    flat_text = text.replace("\r", "").replace("\n", ",")
+    with warnings.catch_warnings():
+        # fromstring warns (rather than raising) when it stops at bad input
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            flat = np.fromstring(flat_text, dtype=np.int64, sep=",")
+        except (ValueError, DeprecationWarning):
+            return None
+    if len(flat) % ncols or len(flat) // ncols != text.count("\n"):
+        return None
+    return flat.reshape(-1, ncols)
+
+
+def parse_events(header: RunHeader, text: Union[str, bytes], previous: Optional[RunCursor] = None) -> np.ndarray:
+    """Parse complete event lines of a file with the given header into ``EVENT_DTYPE``.
+
+    ``previous`` carries state from the preceding chunk of the same run so that
+    derived fields continue across chunk boundaries; see ``iter_chunks``.
+    """
+
+    if isinstance(text, bytes):
+        text = text.decode("utf-8", errors="replace")
+    usecols = []
+    names = []
+    formats = []
+    for index, column in enumerate(header.columns):
+        name = COLUMN_ALIASES.get(column)
+        if name is None:
+            continue
+        usecols.append(index)
+        names.append(name)
+        formats.append("U40" if name == "ts" else "<i8")
+    dtype = np.dtype({"names": names, "formats": formats})
+    if not text:
+        return normalize(header, np.empty(0, dtype=dtype), previous)
+    if "ts" in names:
+        raw = np.loadtxt(io.StringIO(text), delimiter=",", usecols=usecols, dtype=dtype, ndmin=1)
+    else:
+        table = _parse_int_table(text, len(header.columns))
+        if table is None:
+            table = np.loadtxt(io.StringIO(text), delimiter=",", dtype=np.int64, ndmin=2)
+        table = table[:, usecols]
+        raw = np.empty(len(table), dtype=dtype)
+        for index, name in enumerate(names):
+            raw[name] = table[:, index]
+    return normalize(header, raw, previous)
+
+
+class RunCursor:
+    """What ``normalize`` needs to know about the events before the current chunk."""
+
+    __slots__ = ("count", "first_t_ms", "first_ts", "last_t_ms", "last_ts")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.first_t_ms = 0
+        self.first_ts = np.datetime64("NaT", "us")
+        self.last_t_ms = 0
+        self.last_ts = np.datetime64("NaT", "us")
+
+    def advance(self, events: np.ndarray) -> None:
+        if len(events) == 0:
+            return
+        if self.count == 0:
+            self.first_t_ms = int(events["t_ms"][0])
+            self.first_ts = events["ts"][0]
+        self.count += len(events)
+        self.last_t_ms = int(events["t_ms"][-1])
+        self.last_ts = events["ts"][-1]
+
+
+def normalize(header: RunHeader, raw: np.ndarray, previous: Optional[RunCursor] = None) -> np.ndarray:
+    """Fill an ``EVENT_DTYPE`` array from parsed columns, deriving missing fields."""
+
+    n = len(raw)
+    events = np.zeros(n, dtype=EVENT_DTYPE)
+    if n == 0:
+        return events
+    started = previous is not None and previous.count > 0
+    present = raw.dtype.names or ()
+    for name in present:
+        if name == "ts":
+            events["ts"] = _parse_ts(raw["ts"])
+        else:
+            events[name] = raw[name]
+    if "muon_count" not in present:
+        events["muon_count"] = np.arange(1, n + 1) + (previous.count if started else 0)
+    if "t_ms" not in present and "ts" in present:
+        origin = previous.first_ts if started else events["ts"][0]
+        events["t_ms"] = (events["ts"] - origin) // np.timedelta64(1, "ms")
+    if "dt" not in present:
+        events["dt"][1:] = np.diff(events["t_ms"])
+        if started:
+            events["dt"][0] = events["t_ms"][0] - previous.last_t_ms
+        if "t_ms" in present:
+            events["dt"] %= TICKS_PERIOD_MS
+    if "ts" not in present:
+        if header.run_start_time is not None:
+            # t wraps at TICKS_PERIOD_MS, so each event is timed from the one before it
+            # (differences modulo the period, as ticks_diff on the board), which keeps
+            # runs across the wrap, and longer than one period, in order
+            steps = np.empty(n, dtype=np.int64)
+            steps[1:] = np.diff(events["t_ms"]) % TICKS_PERIOD_MS
+            if started and not np.isnat(previous.last_ts):
+                base = previous.last_ts
+                origin = previous.last_t_ms
+            elif header.segment_start_time is not None and header.segment_start_ticks_ms is not None:
+                # a reference taken just before this segment, within one period of its events
+                base = np.datetime64(header.segment_start_time.astimezone(timezone.utc).replace(tzinfo=None), "us")
+                origin = header.segment_start_ticks_ms
+            else:
+                base = np.datetime64(header.run_start_time.astimezone(timezone.utc).replace(tzinfo=None), "us")
+                if header.run_start_ticks_ms is not None:
+                    # the header says which ticks_ms the start time belongs to
+                    origin = header.run_start_ticks_ms
+                else:
+                    # Older files only have ticks_ms; anchor the first event at the run
+                    # start time. Good to a second or so, which the matcher can absorb.
+                    origin = previous.first_t_ms if started else events["t_ms"][0]
+            steps[0] = (events["t_ms"][0] - origin) % TICKS_PERIOD_MS
+            events["ts"] = base + np.cumsum(steps) * np.timedelta64(1, "ms")
+        else:
+            events["ts"] = np.datetime64("NaT")
+    return events
+
+
+def load_run(path: PathLike) -> tuple[RunHeader, np.ndarray]:
+    """Load a whole run file into ``(RunHeader, EVENT_DTYPE array)``."""
+
+    header = read_header(path)
+    with open_run(header.path) as fp:
+        fp.seek(header.data_offset)
+        data = _complete_lines(fp.read())
+    return header, parse_events(header, data)
+
+
+def load_waveforms(path: PathLike) -> np.ndarray:
+    """The captured waveforms of a ``PULSE_CAPTURE`` run, one row of ``w0, w1, ...`` per event.
+
+    Slots after the end of a short pulse are 0. Runs without capture give an
+    array with no columns.
+    """
+
+    header = read_header(path)
+    wave = [index for index, column in enumerate(header.columns) if WAVE_COLUMN.fullmatch(column)]
+    with open_run(header.path) as fp:
+        fp.seek(header.data_offset)
+        text = _complete_lines(fp.read()).decode("utf-8", errors="replace")
+    if not text:
+        return np.zeros((0, len(wave)), dtype="<u2")
+    table = _parse_int_table(text, len(header.columns))
+    if table is None:
+        table = np.loadtxt(io.StringIO(text), delimiter=",", dtype=np.int64, ndmin=2)
+    return table[:, wave].astype("<u2")
+
+
+def load_slow_control(path: PathLike) -> np.ndarray:
+    """The slow-control stream of a run segment (``<segment>.slow.csv``, or give the segment itself).
+
+    A structured array with ``t_ms``, ``seq`` and one integer field per channel
+    (``temperature_adc``, ``die_temperature_adc``, ...).
+    """
+
+    path = Path(path)
+    if not path.name.endswith(".slow.csv"):
+        path = path.with_name(run_stem(path) + ".slow.csv")
+    with open(path, encoding="utf-8") as fp:
+        names = ["t_ms" if name == "t" else name for name in _split(fp.readline())]
+        table = np.loadtxt(fp, delimiter=",", dtype=np.int64, ndmin=2)
+    rows = np.empty(len(table), dtype=[(name, "<i8") for name in names])
+    for index, name in enumerate(names):
+        rows[name] = table[:, index]
+    return rows
+
+
+def iter_chunks(path: PathLike, chunk_bytes: int = 4 << 20) -> Iterator[tuple[RunHeader, np.ndarray]]:
+    """Yield a run file as consecutive ``EVENT_DTYPE`` arrays of about ``chunk_bytes`` of text each.
+
+    Memory use is bounded by the chunk size, independent of the file size.
+    Derived fields (``dt``, legacy ``ts``) continue correctly across chunks.
+    """
+
+    header = read_header(path)
+    cursor = RunCursor()
+    with open_run(header.path) as fp:
+        fp.seek(header.data_offset)
+        carry = b""
+        while True:
+            block = fp.read(chunk_bytes)
+            if not block:
+                break
+            block = carry + block
+            end = block.rfind(b"\n")
+            if end < 0:
+                carry = block.rstrip(b"\x00")
+                continue
+            carry = block[end + 1:].rstrip(b"\x00")
+            events = parse_events(header, block[: end + 1], cursor)
+            cursor.advance(events)
+            yield header, events
+        # like load_run, a trailing line without newline is treated as partial and dropped
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load muon_data run files and print a short summary.")
+    parser.add_argument("files", nargs="+", type=Path, help="Run files to load")
+    args = parser.parse_args()
+    for path in args.files:
+        start = time.perf_counter()
+        header, events = load_run(path)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{path}: {header.schema} layout, {len(events)} events in {elapsed:.1f} ms")
+        if header.has_metadata:
+            print(f"  baseline {header.baseline}, stddev {header.stddev}, threshold {header.threshold}, "
+                  f"reset {header.reset_threshold}, start {header.run_start_time}, leader {header.is_leader}")
+        if len(events):
+            print(f"  {events['ts'][0]} .. {events['ts'][-1]}, {int(events['coincidence'].sum())} coincidences")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
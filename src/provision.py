@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Provision every attached Pico W at once.
+
+Finds all boards on USB serial (or takes ``--port`` several times), reads the
+WLAN MAC address of each, looks up its number in ``macs.md`` and installs the
+firmware on all boards concurrently, one thread per board, with the same steps
+as ``install.py``. Each board also gets its number in ``id.txt``. Ends with a
+per-board report::
+
+    python provision.py --mqtt
+    python provision.py --sync --port /dev/ttyACM0 --port /dev/ttyACM1
+
+Boards whose MAC is not in the mapping file are reported and left alone.
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import install
+
+RASPBERRY_PI_VID = 0x2E8A
+MAC_ROW = re.compile(r"^\|\s*([0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5})\s*\|\s*([^|]*?)\s*\|")
+
+
+@dataclass
+class BoardResult:
+    port: str
+    mac: str = ""
+    board: Optional[int] = None
+    ok: bool = False
+    files: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    message: str = ""
+
+
+def read_mac_map(path: Path) -> dict[str, int]:
+    """Map lower-case MAC address -> board number from a ``macs.md`` table.
+
+    Rows whose number is not an integer (e.g. ``unassigned``) are skipped.
+    """
+
+    mapping = {}
+    for line in path.read_text(encoding="utf-8").splitlines():
+        match = MAC_ROW.match(line.strip())
+        if match and match.group(2).isdigit():
+            mapping[match.group(1).lower()] = int(match.group(2))
+    return mapping
+
+
+def detect_ports() -> list[str]:
+    """Serial ports of all attached boards with the Raspberry Pi USB vendor id."""
+
+    from serial.tools import list_ports  # installed with mpremote
+
+    return sorted(p.device for p in list_ports.comports() if p.vid == RASPBERRY_PI_VID)
+
+
+def read_board_mac(connection: install.Pyboard) -> str:
+    script = (
+        "import network\n"
+        "print(':'.join('%02x' % b for b in network.WLAN(network.STA_IF).config('mac')))"
+    )
+    return connection.exec_(script).decode("utf-8", errors="replace").strip().lower()
+
+
+def provision_board(
+    port: str,
+    baud: int,
+    mac_map: dict[str, int],
+    files: list[tuple[Path, str]],
+    packages: tuple[str, ...],
+    sync: bool,
+) -> BoardResult:
+    result = BoardResult(port)
+    started = time.monotonic()
+    try:
+        with install.board_connection(port, baud) as connection:
+            result.mac = read_board_mac(connection)
+            result.board = mac_map.get(result.mac)
+            if result.board is None:
+                result.message = "MAC not in mapping file"
+                return result
+            with tempfile.TemporaryDirectory() as tmp:
+                id_file = Path(tmp) / "id.txt"
+                id_file.write_text(f"{result.board}\n")
+                result.files, result.bytes = install.upload_project(
+                    connection, sync=sync, files=files + [(id_file, "/id.txt")], packages=packages
+                )
+        result.ok = True
+        result.message = "ok"
+    except Exception as exc:  # report and carry on with the other boards
+        result.message = f"{type(exc).__name__}: {exc}"
+    finally:
+        result.seconds = time.monotonic() - started
+    return result
+
+
+def print_report(results: list[BoardResult]) -> None:
+    print(f"{'port':16s} {'mac':17s} {'board':>5s} {'files':>5s} {'bytes':>8s} {'time':>7s}  status")
+    for r in sorted(results, key=lambda r: (r.board is None, r.board or 0, r.port)):
+        board = "-" if r.board is None else str(r.board)
+        print(f"{r.port:16s} {r.mac or '?':17s} {board:>5s} {r.files:5d} {r.bytes:8d} {r.seconds:6.1f}s  {r.message}")
+    failed = sum(not r.ok for r in results)
+    print(f"{len(results) - failed} of {len(results)} boards provisioned")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Install the firmware on all attached boards concurrently.")
+    parser.add_argument("--port", action="append", help="serial port of a board (repeatable); default: detect all")
+    parser.add_argument("--baud", type=int, default=115200, help="serial baudrate (default: 115200)")
+    parser.add_argument("--macs", type=Path, default=install.PROJECT_ROOT / "macs.md",
+                        help="MAC address to board number table (default: macs.md)")
+    parser.add_argument("--mqtt", action="store_true", help="install the MQTT version (asynchio5.py)")
+    parser.add_argument("--sync", action="store_true", help="copy only changed files, do not wipe the boards")
+    parser.add_argument("--jobs", type=int, default=0, help="boards flashed at the same time (default: all)")
+    parser.add_argument("--skip-env-check", action="store_true",
+                        help="skip checking that the rpico Conda environment is active")
+    parser.add_argument("--expected-env", default="rpico", help="Conda environment expected (default: rpico)")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    install.ensure_environment(None if args.skip_env_check else args.expected_env)
+
+    ports = args.port or detect_ports()
+    if not ports:
+        raise SystemExit("No boards found.")
+    mac_map = read_mac_map(args.macs)
+    # compile/download once here, not in every thread
+    files = install.project_files(args.mqtt)
+    packages = install.MQTT_MIP_PACKAGES if args.mqtt else install.MIP_PACKAGES
+
+    print(f"Provisioning {len(ports)} boards: {' '.join(ports)}")
+    started = time.monotonic()
+    results = []
+    with ThreadPoolExecutor(max_workers=args.jobs or len(ports)) as pool:
+        futures = [
+            pool.submit(provision_board, port, args.baud, mac_map, files, packages, args.sync)
+            for port in ports
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"[{result.port}] board {result.board}: {result.message} ({result.seconds:.1f} s)")
+            results.append(result)
+
+    print_report(results)
+    print(f"total {time.monotonic() - started:.1f} s")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""Sidecar byte-offset index for random access into run files.
+
+Looking at one hour of a multi-day run used to mean parsing the whole CSV. The
+index records, every ``stride`` events, the byte offset of the event line, the
+number of events before it and its timestamp, plus the state ``normalize``
+needs to continue derived fields (``muon_count``, ``t_ms``, ``dt``) from that
+point. It is stored next to the run as ``<run>.idx.npz``::
+
+    python run_index.py runs/*.csv --stride 4096
+
+``load_range`` then reads only the indexed blocks that cover the requested
+event or time range, so the cost grows with the requested data, not with the
+file::
+
+    header, events = load_range("muon_data_20241101_1806.csv",
+                                start_time="2024-11-02T13:00", stop_time="2024-11-02T14:00")
+
+The events returned are identical to the same slice of ``muon_data.load_run``.
+Time lookups assume that timestamps do not decrease within a run, which is how
+the firmware writes them. If the run file grew since the index was built (a run
+still being written), the index is extended from its last entry; if it shrank
+or was replaced, the index is rebuilt.
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+import muon_data
+
+INDEX_SUFFIX = ".idx.npz"
+INDEX_VERSION = 2
+DEFAULT_STRIDE = 4096
+
+INDEX_DTYPE = np.dtype([
+    ("offset", "<i8"),            # byte offset of the event line
+    ("event", "<i8"),             # 0-based number of the event in the run
+    ("ts", "datetime64[us]"),     # its timestamp
+    ("prev_t_ms", "<i8"),         # t_ms of the event before it, for dt
+    ("prev_ts", "datetime64[us]"),  # and its timestamp, to time the events after a ticks_ms wrap
+])
+
+TimeLike = Union[str, np.datetime64, None]
+
+
+class RunIndex:
+    """Index entries of one run file and the state needed to resume parsing."""
+
+    def __init__(self, path: Path, stride: int, entries: np.ndarray, indexed_bytes: int,
+                 events: int, first_t_ms: int, first_ts: np.datetime64, last_t_ms: int) -> None:
+        self.path = path
+        self.stride = stride
+        self.entries = entries
+        self.indexed_bytes = indexed_bytes   # file size covered by the index (complete lines only)
+        self.events = events                 # events in the indexed part of the file
+        self.first_t_ms = first_t_ms
+        self.first_ts = first_ts
+        self.last_t_ms = last_t_ms
+
+    def cursor(self, entry: int) -> muon_data.RunCursor:
+        """The ``RunCursor`` state before the event of the given entry."""
+
+        cursor = muon_data.RunCursor()
+        cursor.count = int(self.entries["event"][entry])
+        cursor.first_t_ms = self.first_t_ms
+        cursor.first_ts = self.first_ts
+        cursor.last_t_ms = int(self.entries["prev_t_ms"][entry])
+        cursor.last_ts = self.entries["prev_ts"][entry]
+        return cursor
+
+    def save(self, path: Optional[Path] = None) -> Path:
+        path = index_path(self.path) if path is None else path
+        tmp = path.with_name(path.name + ".tmp.npz")
+        np.savez(tmp, version=np.array(INDEX_VERSION), stride=np.array(self.stride), entries=self.entries,
+                 indexed_bytes=np.array(self.indexed_bytes), events=np.array(self.events),
+                 first_t_ms=np.array(self.first_t_ms), first_ts=np.array(self.first_ts),
+                 last_t_ms=np.array(self.last_t_ms))
+        tmp.replace(path)
+        return path
+
+
+def index_path(path: muon_data.PathLike) -> Path:
+    path = Path(path)
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+def _line_starts(block: bytes) -> np.ndarray:
+    """Offsets of the non-empty lines in a block of complete lines."""
+
+    raw = np.frombuffer(block, dtype=np.uint8)
+    newlines = np.flatnonzero(raw == ord("\n"))
+    starts = np.concatenate(([0], newlines[:-1] + 1))
+    length = newlines - starts
+    # loadtxt skips blank lines, so they carry no event
+    blank = (length == 0) | ((length == 1) & (raw[newlines - 1] == ord("\r")))
+    return starts[~blank]
+
+
+def _require_plain(path: muon_data.PathLike) -> None:
+    """Byte offsets into a compressed run mean nothing: only plain CSVs are indexed."""
+
+    if str(path).endswith(".gz"):
+        raise ValueError(f"{path}: compressed run, unpack it (gunzip or harvest.py) and index the unpacked .csv")
+
+
+def build_index(path: muon_data.PathLike, stride: int = DEFAULT_STRIDE, chunk_bytes: int = 4 << 20,
+                resume: Optional[RunIndex] = None) -> RunIndex:
+    """Scan a run file and index every ``stride``-th event.
+
+    With ``resume``, only the part of the file after the last entry of that
+    index is scanned.
+    """
+
+    _require_plain(path)
+    header = muon_data.read_header(path)
+    cursor = muon_data.RunCursor()
+    entries: list[np.ndarray] = []
+    start = header.data_offset
+    if resume is not None and len(resume.entries):
+        # restart at the last entry: the block after it may have been incomplete
+        last = len(resume.entries) - 1
+        cursor = resume.cursor(last)
+        start = int(resume.entries["offset"][last])
+        entries.append(resume.entries[:last])
+        stride = resume.stride
+
+    with open(header.path, "rb") as fp:
+        fp.seek(start)
+        base = start
+        carry = b""
+        while True:
+            block = fp.read(chunk_bytes)
+            if not block:
+                break
+            block = carry + block
+            end = block.rfind(b"\n")
+            if end < 0:
+                carry = block.rstrip(b"\x00")
+                continue
+            carry = block[end + 1:].rstrip(b"\x00")
+            lines = block[: end + 1]
+            events = muon_data.parse_events(header, lines, cursor)
+            starts = _line_starts(lines)
+            if len(starts) != len(events):
+                raise ValueError(f"{header.path}: cannot index, line and event counts differ near byte {base}")
+            if len(events):
+                number = cursor.count + np.arange(len(events))
+                keep = np.flatnonzero(number % stride == 0)
+                prev_t_ms = np.concatenate(([cursor.last_t_ms], events["t_ms"][:-1]))
+                prev_ts = np.concatenate(([cursor.last_ts], events["ts"][:-1]))
+                chunk_entries = np.empty(len(keep), dtype=INDEX_DTYPE)
+                chunk_entries["offset"] = base + starts[keep]
+                chunk_entries["event"] = number[keep]
+                chunk_entries["ts"] = events["ts"][keep]
+                chunk_entries["prev_t_ms"] = prev_t_ms[keep]
+                chunk_entries["prev_ts"] = prev_ts[keep]
+                entries.append(chunk_entries)
+            cursor.advance(events)
+            base += end + 1
+    return RunIndex(header.path, stride, np.concatenate(entries) if entries else np.empty(0, INDEX_DTYPE),
+                    base, cursor.count, cursor.first_t_ms, cursor.first_ts, cursor.last_t_ms)
+
+
+def load_index(path: muon_data.PathLike) -> Optional[RunIndex]:
+    """Load the sidecar index of a run file, or None if there is none."""
+
+    sidecar = index_path(path)
+    if not sidecar.exists():
+        return None
+    with np.load(sidecar) as data:
+        if int(data["version"]) != INDEX_VERSION:
+            return None
+        return RunIndex(Path(path), int(data["stride"]), data["entries"], int(data["indexed_bytes"]),
+                        int(data["events"]), int(data["first_t_ms"]), data["first_ts"][()], int(data["last_t_ms"]))
+
+
+def _is_current(index: RunIndex, size: int) -> bool:
+    """Whether the indexed bytes are still a prefix of the file."""
+
+    if size < index.indexed_bytes or not len(index.entries):
+        return False
+    # spot-check that the last entry still points at the start of a line
+    offset = int(index.entries["offset"][-1])
+    with open(index.path, "rb") as fp:
+        fp.seek(offset - 1)
+        return fp.read(1) == b"\n"
+
+
+def ensure_index(path: muon_data.PathLike, stride: int = DEFAULT_STRIDE, save: bool = True) -> RunIndex:
+    """Load the index of a run file, extending or rebuilding it as needed."""
+
+    _require_plain(path)
+    path = Path(path)
+    index = load_index(path)
+    size = path.stat().st_size
+    if index is not None and _is_current(index, size):
+        if size == index.indexed_bytes:
+            return index
+        index = build_index(path, resume=index)
+    else:
+        index = build_index(path, stride)
+    if save:
+        index.save()
+    return index
+
+
+def _as_datetime(value: TimeLike) -> Optional[np.datetime64]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return muon_data._parse_ts(np.array([value]))[0]
+    return np.datetime64(value, "us")
+
+
+def load_range(
+    path: muon_data.PathLike,
+    start_event: Optional[int] = None,
+    stop_event: Optional[int] = None,
+    start_time: TimeLike = None,
+    stop_time: TimeLike = None,
+    index: Optional[RunIndex] = None,
+) -> tuple[muon_data.RunHeader, np.ndarray]:
+    """Load the events ``start_event <= n < stop_event`` and/or ``start_time <= ts < stop_time``.
+
+    Event numbers are 0-based positions in the run; times are UTC
+    (``numpy.datetime64`` or ISO-8601 strings, with or without a suffix).
+    Only the blocks of the file covering the range are read.
+    """
+
+    _require_plain(path)
+    header = muon_data.read_header(path)
+    index = ensure_index(path) if index is None else index
+    entries = index.entries
+    t0 = _as_datetime(start_time)
+    t1 = _as_datetime(stop_time)
+    if (t0 is not None or t1 is not None) and len(entries) and np.isnat(entries["ts"][0]):
+        raise ValueError(f"{header.path}: events have no timestamps, select by event number")
+
+    # first entry: the last one at or before the start of the range
+    first = 0
+    if start_event is not None:
+        first = max(first, int(np.searchsorted(entries["event"], start_event, side="right")) - 1)
+    if t0 is not None:
+        first = max(first, int(np.searchsorted(entries["ts"], t0, side="left")) - 1)
+    first = max(first, 0)
+    # stop entry: the first one past the end of the range
+    stop = len(entries)
+    if stop_event is not None:
+        stop = min(stop, int(np.searchsorted(entries["event"], stop_event, side="left")))
+    if t1 is not None:
+        stop = min(stop, int(np.searchsorted(entries["ts"], t1, side="left")))
+    if stop <= first:
+        stop = first + 1
+
+    if len(entries) == 0:
+        return header, muon_data.normalize(header, np.empty(0, dtype=[]))
+    offset = int(entries["offset"][first])
+    with open(header.path, "rb") as fp:
+        fp.seek(offset)
+        if stop < len(entries):
+            data = fp.read(int(entries["offset"][stop]) - offset)
+        else:
+            data = muon_data._complete_lines(fp.read())
+    events = muon_data.parse_events(header, data, index.cursor(first))
+
+    number = int(entries["event"][first]) + np.arange(len(events))
+    keep = np.ones(len(events), dtype=bool)
+    if start_event is not None:
+        keep &= number >= start_event
+    if stop_event is not None:
+        keep &= number < stop_event
+    if t0 is not None:
+        keep &= events["ts"] >= t0
+    if t1 is not None:
+        keep &= events["ts"] < t1
+    return header, events[keep]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build or update sidecar indexes of run files.")
+    parser.add_argument("files", nargs="+", type=Path, help="Run files")
+    parser.add_argument("--stride", type=int, default=DEFAULT_STRIDE,
+                        help=f"Index every Nth event (default: {DEFAULT_STRIDE})")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild indexes instead of extending them")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    for path in args.files:
+        if args.rebuild:
+            index_path(path).unlink(missing_ok=True)
+        start = time.perf_counter()
+        try:
+            index = ensure_index(path, args.stride)
+        except ValueError as exc:
+            print(f"{path}: not indexed: {exc}")
+            continue
+        print(f"{path}: {index.events} events, {len(index.entries)} entries "
+              f"in {(time.perf_counter() - start) * 1000:.0f} ms -> {index_path(path).name}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
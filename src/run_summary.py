@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Summarize every run in a directory in parallel.
+
+Instead of editing ``filename`` in ``pepper_analyze.ipynb`` for each run, this
+tool processes a whole directory of ``muon_data_*.csv`` files with a process
+pool (one run per task, read in bounded-memory chunks) and writes:
+
+- ``<out>/summary.csv``: one row per run with the event count, duration,
+  singles and coincidence rates, ``t_wait`` cut efficiency and temperature
+  statistics, plus SD card write/flush/sync latencies where the board saved
+  them (``<run>.sd.json``),
+- ``<out>/spectra.npz``: the pulse-height spectrum of each run,
+- ``<out>/*.png``: report figures, if matplotlib is installed.
+
+::
+
+    python run_summary.py /path/to/runs --out report/ --wait-cut 60
+
+Runs are independent, so wall-clock time scales with the number of cores up to
+the number of runs.
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+import muon_data
+
+V_EDGES = np.linspace(0, 3.3, 101)
+
+SUMMARY_COLUMNS = (
+    "run", "start", "leader", "baseline", "threshold", "events", "duration_s",
+    "rate_hz", "coinc_events", "coinc_rate_hz", "twait_efficiency",
+    "temp_mean_c", "temp_min_c", "temp_max_c", "v_mean", "v_median",
+    "sd_bytes_per_s", "sd_write_p99_us", "sd_write_max_us", "sd_flush_max_us", "sd_sync_max_us",
+)
+
+
+def _percentile_us(latency: dict[str, Any], q: float) -> int:
+    """Same bound as SdStats.Latency.percentile_us, from a saved histogram."""
+
+    if not latency["count"]:
+        return 0
+    seen = np.cumsum(latency["hist"])
+    b = int(np.searchsorted(seen, latency["count"] * q / 100.0))
+    return min(1 << b, latency["max_us"])
+
+
+def read_sd_stats(path: Path) -> dict[str, Any]:
+    """SD latency columns from the ``.sd.json`` file saved next to a run segment, if any."""
+
+    sidecar = path.with_name(muon_data.run_stem(path) + ".sd.json")
+    if not sidecar.exists():
+        return {}
+    data = json.loads(sidecar.read_text(encoding="utf-8"))
+    return {
+        "sd_bytes_per_s": data["bytes_per_s"],
+        "sd_write_p99_us": _percentile_us(data["write"], 99),
+        "sd_write_max_us": data["write"]["max_us"],
+        "sd_flush_max_us": data["flush"]["max_us"],
+        "sd_sync_max_us": data["sync"]["max_us"],
+    }
+
+
+def summarize_run(path: Path, wait_cut: int, chunk_bytes: int) -> tuple[dict[str, Any], np.ndarray]:
+    """Summary row and pulse-height spectrum of one run; runs in a worker process."""
+
+    spectrum = np.zeros(len(V_EDGES) - 1, dtype=np.int64)
+    events = coinc = passed = 0
+    temp_sum = 0.0
+    temp_min = np.inf
+    temp_max = -np.inf
+    first_ts = last_ts = None
+    header = muon_data.read_header(path)
+    for _, chunk in muon_data.iter_chunks(path, chunk_bytes):
+        if len(chunk) == 0:
+            continue
+        events += len(chunk)
+        coinc += int(np.count_nonzero(chunk["coincidence"]))
+        passed += int(np.count_nonzero(chunk["wait_cnt"] < wait_cut))
+        temps = muon_data.temp_adc_to_celsius(chunk["temp_adc_v"])
+        temp_sum += float(temps.sum())
+        temp_min = min(temp_min, float(temps.min()))
+        temp_max = max(temp_max, float(temps.max()))
+        spectrum += np.histogram(muon_data.adc_to_volts(chunk["adc_v"]), bins=V_EDGES)[0]
+        ts = chunk["ts"][~np.isnat(chunk["ts"])]
+        if len(ts):
+            first_ts = ts[0] if first_ts is None else first_ts
+            last_ts = ts[-1]
+
+    duration = float((last_ts - first_ts) / np.timedelta64(1, "s")) if first_ts is not None else 0.0
+    centres = 0.5 * (V_EDGES[1:] + V_EDGES[:-1])
+    cumulative = np.cumsum(spectrum)
+    row = {
+        "run": path.name,
+        "start": str(first_ts) if first_ts is not None else "",
+        "leader": "" if header.is_leader is None else int(header.is_leader),
+        "baseline": header.baseline if header.baseline is not None else "",
+        "threshold": header.threshold if header.threshold is not None else "",
+        "events": events,
+        "duration_s": round(duration, 1),
+        "rate_hz": events / duration if duration > 0 else 0.0,
+        "coinc_events": coinc,
+        "coinc_rate_hz": coinc / duration if duration > 0 else 0.0,
+        "twait_efficiency": passed / events if events else 0.0,
+        "temp_mean_c": temp_sum / events if events else 0.0,
+        "temp_min_c": temp_min if events else 0.0,
+        "temp_max_c": temp_max if events else 0.0,
+        "v_mean": float((spectrum * centres).sum() / events) if events else 0.0,
+        "v_median": float(centres[np.searchsorted(cumulative, events / 2)]) if events else 0.0,
+    }
+    row.update(read_sd_stats(path))
+    return row, spectrum
+
+
+def _summarize_task(task: tuple[Path, int, int]):
+    path, wait_cut, chunk_bytes = task
+    try:
+        return summarize_run(path, wait_cut, chunk_bytes)
+    except (ValueError, OSError) as exc:
+        return {"run": path.name, "error": str(exc)}, None
+
+
+def write_table(out_dir: Path, rows: list[dict[str, Any]]) -> Path:
+    path = out_dir / "summary.csv"
+    with open(path, "w", newline="", encoding="utf-8") as fp:
+        writer = csv.DictWriter(fp, fieldnames=SUMMARY_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: (f"{value:.6g}" if isinstance(value, float) else value) for key, value in row.items()})
+    return path
+
+
+def write_figures(out_dir: Path, rows: list[dict[str, Any]], spectra: np.ndarray, wait_cut: int) -> list[Path]:
+    """Report figures; skipped if matplotlib is not installed."""
+
+    try:
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib not installed, skipping figures")
+        return []
+
+    written = []
+    index = np.arange(len(rows))
+    names = [row["run"] for row in rows]
+
+    fig, ax = plt.subplots(figsize=(10, 5))
+    ax.plot(index, [row["rate_hz"] for row in rows], "o-", label="singles")
+    ax.plot(index, [row["coinc_rate_hz"] for row in rows], "s-", label="coincidences")
+    ax.set_ylabel("Rate (Hz)")
+    ax.set_xticks(index, names, rotation=90, fontsize=6)
+    ax.grid()
+    ax.legend()
+    ax.set_title("Rate per run")
+    fig.tight_layout()
+    written.append(out_dir / "rates.png")
+    fig.savefig(written[-1], dpi=150)
+    plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(10, 5))
+    ax.plot(index, [row["twait_efficiency"] for row in rows], "o-")
+    ax.set_ylabel(f"fraction with wait_cnt < {wait_cut}")
+    ax.set_xticks(index, names, rotation=90, fontsize=6)
+    ax.grid()
+    ax.set_title("$t_\\text{wait}$ cut efficiency per run")
+    fig.tight_layout()
+    written.append(out_dir / "twait_efficiency.png")
+    fig.savefig(written[-1], dpi=150)
+    plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(10, 5))
+    means = [row["temp_mean_c"] for row in rows]
+    lows = [row["temp_mean_c"] - row["temp_min_c"] for row in rows]
+    highs = [row["temp_max_c"] - row["temp_mean_c"] for row in rows]
+    ax.errorbar(index, means, yerr=[lows, highs], fmt="o", capsize=3)
+    ax.set_ylabel("Temperature (C), mean and range")
+    ax.set_xticks(index, names, rotation=90, fontsize=6)
+    ax.grid()
+    ax.set_title("Temperature per run")
+    fig.tight_layout()
+    written.append(out_dir / "temperature.png")
+    fig.savefig(written[-1], dpi=150)
+    plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    total = spectra.sum(axis=0)
+    ax.stairs(total, V_EDGES, label=f"all runs ({int(total.sum())} events)")
+    for row, spectrum in zip(rows, spectra):
+        if spectrum.sum():
+            ax.stairs(spectrum * (total.sum() / spectrum.sum()), V_EDGES, alpha=0.3)
+    ax.set_yscale("log")
+    ax.set_xlabel("Measured pulse height V [Volts]")
+    ax.set_ylabel("Counts (runs scaled to the total)")
+    ax.legend()
+    ax.set_title("Pulse-height spectra")
+    fig.tight_layout()
+    written.append(out_dir / "spectra.png")
+    fig.savefig(written[-1], dpi=150)
+    plt.close(fig)
+    return written
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Summarize a directory of runs in parallel.")
+    parser.add_argument("directory", type=Path, help="Directory with run files")
+    parser.add_argument("--pattern", action="append", dest="patterns",
+                        help="Run file glob, can be repeated (default: muon_data_*.csv and muon_data_*.csv.gz)")
+    parser.add_argument("--recursive", action="store_true", help="Search subdirectories too")
+    parser.add_argument("--out", type=Path, default=Path("report"), help="Output directory (default: ./report)")
+    parser.add_argument("--wait-cut", type=int, default=60, help="t_wait cut for the efficiency (default: 60)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes (default: all cores)")
+    parser.add_argument("--chunk-mb", type=float, default=8.0, help="Chunk size per worker in MB (default: 8)")
+    parser.add_argument("--no-figures", action="store_true", help="Only write the tables")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    patterns = tuple(args.patterns or muon_data.RUN_PATTERNS)
+    paths = muon_data.find_runs(args.directory, patterns, args.recursive)
+    if not paths:
+        raise SystemExit(f"no files matching {' or '.join(patterns)} in {args.directory}")
+    # largest runs first so one big file does not start last and set the wall-clock time
+    paths.sort(key=lambda p: p.stat().st_size, reverse=True)
+    chunk_bytes = int(args.chunk_mb * (1 << 20))
+    tasks = [(path, args.wait_cut, chunk_bytes) for path in paths]
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = list(pool.map(_summarize_task, tasks))
+    elapsed = time.perf_counter() - start
+
+    rows = []
+    spectra = []
+    for row, spectrum in sorted(results, key=lambda item: item[0]["run"]):
+        if spectrum is None:
+            print(f"{row['run']}: skipped: {row['error']}")
+            continue
+        rows.append(row)
+        spectra.append(spectrum)
+    if not rows:
+        raise SystemExit("no runs could be read")
+    total_events = sum(row["events"] for row in rows)
+    print(f"{len(rows)} runs, {total_events} events in {elapsed:.1f} s with {args.jobs} workers")
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    table = write_table(args.out, rows)
+    spectra_array = np.array(spectra)
+    np.savez_compressed(args.out / "spectra.npz", runs=np.array([row["run"] for row in rows]),
+                        v_edges=V_EDGES, counts=spectra_array)
+    print(f"wrote {table} and {args.out / 'spectra.npz'}")
+    if not args.no_figures:
+        for path in write_figures(args.out, rows, spectra_array, args.wait_cut):
+            print(f"wrote {path}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Chunked, bounded-memory analysis of run files.
+
+``pepper_analyze.ipynb`` loads a whole run into a DataFrame and adds columns to
+it as it goes. That does not scale to a semester of fleet data. Here runs are
+read in fixed-size chunks (``muon_data.iter_chunks``) and every quantity of the
+notebook is accumulated incrementally, so memory use depends on the chunk size
+and the binning, not on the amount of data:
+
+- pulse-height histograms (V) per selection,
+- the 2-D ``wait_cnt`` vs V histogram,
+- histograms of the time between events,
+- rolling rates over the last N events, kept every ``stride`` events,
+- rates in fixed wall-clock bins.
+
+Selections are the notebook's cuts: ``all``, ``twait`` (``wait_cnt < cut``)
+and ``coinc`` (``coincidence > 0``). Input arrays are never modified.
+
+::
+
+    python stream_analysis.py runs/*.csv --wait-cut 60 --out semester.npz
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+import muon_data
+
+Selection = Callable[[np.ndarray], np.ndarray]
+
+
+class Hist1D:
+    """Fixed-binning 1-D histogram filled chunk by chunk."""
+
+    def __init__(self, edges: np.ndarray) -> None:
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+
+    def fill(self, values: np.ndarray) -> None:
+        self.counts += np.histogram(values, bins=self.edges)[0]
+
+
+class Hist2D:
+    """Fixed-binning 2-D histogram filled chunk by chunk."""
+
+    def __init__(self, xedges: np.ndarray, yedges: np.ndarray) -> None:
+        self.xedges = np.asarray(xedges, dtype=np.float64)
+        self.yedges = np.asarray(yedges, dtype=np.float64)
+        self.counts = np.zeros((len(self.xedges) - 1, len(self.yedges) - 1), dtype=np.int64)
+
+    def fill(self, x: np.ndarray, y: np.ndarray) -> None:
+        self.counts += np.histogram2d(x, y, bins=(self.xedges, self.yedges))[0].astype(np.int64)
+
+
+class RollingRate:
+    """Rate over the last ``window`` events, i.e. ``1 / mean(dt)``, like the notebook's
+    ``1/df['dt'].rolling(window).mean()``.
+
+    The last ``window`` timestamps are carried from chunk to chunk, and only
+    every ``stride``-th value is kept, so the stored series stays small.
+    """
+
+    def __init__(self, window: int = 100, stride: int = 100) -> None:
+        self.window = window
+        self.stride = stride
+        self._tail = np.empty(0, dtype=np.int64)   # last `window` event times of the current run, us
+        self._seen = 0                             # events of the current run so far
+        self._times: list[np.ndarray] = []
+        self._rates: list[np.ndarray] = []
+
+    def new_run(self) -> None:
+        self._tail = np.empty(0, dtype=np.int64)
+        self._seen = 0
+
+    def fill(self, t_us: np.ndarray) -> None:
+        t = np.concatenate((self._tail, t_us))
+        base = self._seen - len(self._tail)      # run-wide index of t[0]
+        if len(t) > self.window:
+            # the window ending at event i spans window intervals: t[i] - t[i - window]
+            idx = np.arange(self.window, len(t))
+            keep = idx[(idx + base) % self.stride == 0]
+            keep = keep[keep >= len(self._tail)]
+            span = (t[keep] - t[keep - self.window]).astype(np.float64)
+            with np.errstate(divide="ignore"):
+                rates = np.where(span > 0, self.window * 1e6 / span, np.nan)
+            self._times.append(t[keep])
+            self._rates.append(rates)
+        self._seen += len(t_us)
+        self._tail = t[-self.window:]
+
+    def series(self) -> tuple[np.ndarray, np.ndarray]:
+        if not self._times:
+            return np.empty(0, dtype="datetime64[us]"), np.empty(0)
+        return np.concatenate(self._times).astype("datetime64[us]"), np.concatenate(self._rates)
+
+
+class BinnedRate:
+    """Event counts in fixed wall-clock bins; the rate is ``counts / bin_s``."""
+
+    def __init__(self, bin_s: float = 60.0) -> None:
+        self.bin_us = int(bin_s * 1e6)
+        self.origin: Optional[int] = None
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def fill(self, t_us: np.ndarray) -> None:
+        if len(t_us) == 0:
+            return
+        if self.origin is None:
+            self.origin = int(t_us.min()) // self.bin_us * self.bin_us
+        low = int(t_us.min())
+        if low < self.origin:
+            # runs need not arrive in time order: extend the bins to the left
+            shift = -(-(self.origin - low) // self.bin_us)
+            self.counts = np.concatenate((np.zeros(shift, dtype=np.int64), self.counts))
+            self.origin -= shift * self.bin_us
+        index = (t_us - self.origin) // self.bin_us
+        counts = np.bincount(index)
+        if len(counts) > len(self.counts):
+            self.counts = np.concatenate((self.counts, np.zeros(len(counts) - len(self.counts), dtype=np.int64)))
+        self.counts[: len(counts)] += counts
+
+    def series(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.origin is None:
+            return np.empty(0, dtype="datetime64[us]"), np.empty(0)
+        starts = self.origin + np.arange(len(self.counts), dtype=np.int64) * self.bin_us
+        return starts.astype("datetime64[us]"), self.counts / (self.bin_us / 1e6)
+
+
+class SelectionAccumulators:
+    """All accumulators for one event selection."""
+
+    def __init__(self, v_edges, wait_edges, dt_edges, window: int, stride: int, bin_s: float) -> None:
+        self.events = 0
+        self.v = Hist1D(v_edges)
+        self.wait_v = Hist2D(wait_edges, v_edges)
+        self.dt = Hist1D(dt_edges)
+        self.rolling = RollingRate(window, stride)
+        self.binned = BinnedRate(bin_s)
+        self._last_us: Optional[int] = None
+
+    def new_run(self) -> None:
+        self.rolling.new_run()
+        self._last_us = None
+
+    def fill(self, events: np.ndarray) -> None:
+        if len(events) == 0:
+            return
+        self.events += len(events)
+        volts = muon_data.adc_to_volts(events["adc_v"])
+        t_us = events["ts"].astype(np.int64)
+        self.v.fill(volts)
+        self.wait_v.fill(events["wait_cnt"], volts)
+        # time between consecutive selected events, continued across chunks
+        prev = t_us[:-1] if self._last_us is None else np.concatenate(([self._last_us], t_us[:-1]))
+        self.dt.fill((t_us[len(t_us) - len(prev):] - prev) / 1e6)
+        self._last_us = int(t_us[-1])
+        self.rolling.fill(t_us)
+        self.binned.fill(t_us)
+
+
+class StreamAnalysis:
+    """Run the notebook's analysis over any number of runs in bounded memory."""
+
+    def __init__(
+        self,
+        wait_cut: int = 60,
+        window: int = 100,
+        stride: int = 100,
+        bin_s: float = 60.0,
+        v_edges: Optional[np.ndarray] = None,
+        wait_edges: Optional[np.ndarray] = None,
+        dt_edges: Optional[np.ndarray] = None,
+    ) -> None:
+        v_edges = np.linspace(0, 3.3, 101) if v_edges is None else v_edges
+        wait_edges = np.linspace(0.5, 150.5, 151) if wait_edges is None else wait_edges
+        dt_edges = np.linspace(0, 20, 201) if dt_edges is None else dt_edges
+        self.wait_cut = wait_cut
+        self.selections: dict[str, Selection] = {
+            "all": lambda e: np.ones(len(e), dtype=bool),
+            "twait": lambda e: e["wait_cnt"] < wait_cut,
+            "coinc": lambda e: e["coincidence"] > 0,
+        }
+        self.acc = {name: SelectionAccumulators(v_edges, wait_edges, dt_edges, window, stride, bin_s)
+                    for name in self.selections}
+        self.temperature = Hist1D(np.linspace(-10, 60, 141))
+        self.runs = 0
+
+    def process_events(self, events: np.ndarray) -> None:
+        events = events[~np.isnat(events["ts"])]
+        for name, select in self.selections.items():
+            self.acc[name].fill(events[select(events)])
+        self.temperature.fill(muon_data.temp_adc_to_celsius(events["temp_adc_v"]))
+
+    def process_run(self, path: Path, chunk_bytes: int = 4 << 20) -> None:
+        for acc in self.acc.values():
+            acc.new_run()
+        for _, events in muon_data.iter_chunks(path, chunk_bytes):
+            self.process_events(events)
+        self.runs += 1
+
+    def save(self, path: Path) -> None:
+        """Write all histograms and series to one ``.npz`` file."""
+
+        out: dict[str, np.ndarray] = {"wait_cut": np.array(self.wait_cut), "runs": np.array(self.runs)}
+        for name, acc in self.acc.items():
+            out[f"{name}_events"] = np.array(acc.events)
+            out[f"{name}_v_counts"] = acc.v.counts
+            out[f"{name}_wait_v_counts"] = acc.wait_v.counts
+            out[f"{name}_dt_counts"] = acc.dt.counts
+            out[f"{name}_rolling_t"], out[f"{name}_rolling_rate"] = acc.rolling.series()
+            out[f"{name}_binned_t"], out[f"{name}_binned_rate"] = acc.binned.series()
+        any_acc = self.acc["all"]
+        out["v_edges"] = any_acc.v.edges
+        out["wait_edges"] = any_acc.wait_v.xedges
+        out["dt_edges"] = any_acc.dt.edges
+        out["temperature_edges"] = self.temperature.edges
+        out["temperature_counts"] = self.temperature.counts
+        np.savez_compressed(path, **out)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Accumulate histograms and rates over many runs in bounded memory.")
+    parser.add_argument("files", nargs="+", type=Path, help="Run files")
+    parser.add_argument("--chunk-mb", type=float, default=4.0, help="Chunk size in MB of CSV text (default: 4)")
+    parser.add_argument("--wait-cut", type=int, default=60, help="t_wait cut for the twait selection (default: 60)")
+    parser.add_argument("--window", type=int, default=100, help="Events per rolling-rate window (default: 100)")
+    parser.add_argument("--stride", type=int, default=100, help="Keep every Nth rolling-rate value (default: 100)")
+    parser.add_argument("--bin-s", type=float, default=60.0, help="Wall-clock rate bin in seconds (default: 60)")
+    parser.add_argument("--out", type=Path, default=Path("stream_analysis.npz"), help="Output .npz file")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    analysis = StreamAnalysis(args.wait_cut, args.window, args.stride, args.bin_s)
+    chunk_bytes = int(args.chunk_mb * (1 << 20))
+    start = time.perf_counter()
+    for path in args.files:
+        analysis.process_run(path, chunk_bytes)
+    elapsed = time.perf_counter() - start
+    print(f"{analysis.runs} runs in {elapsed:.1f} s")
+    for name, acc in analysis.acc.items():
+        _, binned = acc.binned.series()
+        active = binned[binned > 0]
+        mean_rate = float(active.mean()) if len(active) else 0.0
+        print(f"  {name}: {acc.events} events, mean rate {mean_rate:.3f} Hz over {len(active)} active bins")
+    analysis.save(args.out)
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
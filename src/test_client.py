@@ -91,6 +91,10 @@ if len(sys.argv) > 1:
         device_number = int(sys.argv[1])
     except ValueError:
         print("Invalid device number argument, using default: 1")
+# optional second argument: broker host. For many devices at once, see load_generator.py
+broker_host = "192.168.4.62"
+if len(sys.argv) > 2:
+    broker_host = sys.argv[2]
 
 topic = f"telemetry/{device_number:03d}"
 userdata = {"device_number": device_number}
@@ -105,7 +109,7 @@ client.on_message = on_message
 # Set keepalive to detect disconnections faster
 #client.connect("localhost", 1883, 10)  # 10 second keepalive
 #client.connect("10.49.72.125", 1883, 10)  # 10 second keepalive
-client.connect("192.168.4.62", 1883, 10)  # 10 second keepalive
+client.connect(broker_host, 1883, 10)  # 10 second keepalive
 client.loop_start()
 
 try: